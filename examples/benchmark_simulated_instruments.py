@@ -0,0 +1,413 @@
+"""
+Benchmarks using simulated instruments
+======================================
+
+This script times some common acquisitions end-to-end, using the simulated
+stage, camera and spectrometer so that no hardware (or display) is needed.
+Run it with ``python examples/benchmark_simulated_instruments.py``; it writes
+its data to a temporary HDF5 file.
+
+The numbers are only as realistic as the simulation parameters, which are set
+in `make_instruments` - adjust them to match your own hardware.
+"""
+
+import os
+os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')  # run without a display
+
+import time
+import tempfile
+import numpy as np
+import cv2
+import nplab
+import nplab.datafile
+from nplab.modelling.synthetic_sample import SyntheticSample
+from nplab.instrument.stage.simulated import SimulatedStage
+from nplab.instrument.camera.simulated import SimulatedCamera
+from nplab.instrument.spectrometer.simulated import SimulatedSpectrometer
+
+
+def make_instruments(seed=0):
+    """Create a simulated stage, camera and spectrometer sharing one sample.
+
+    Distances are in microns.
+    """
+    sample = SyntheticSample.random(n_particles=2000, field_size=(400, 400), seed=seed,
+                                    focal_z=0.0, defocus_blur=0.5)
+    stage = SimulatedStage(velocity=[2000, 2000, 200], acceleration=[2e4, 2e4, 2e3],
+                           settling_time=0.02, communication_latency=0.002)
+    camera = SimulatedCamera(stage=stage, sample=sample, shape=(480, 640), pixel_size=0.1,
+                             frame_rate=30.0, readout_time=0.01)
+    spectrometer = SimulatedSpectrometer(stage=stage, sample=sample)
+    spectrometer.integration_time = 10
+    return stage, camera, spectrometer
+
+
+def make_camera_with_location(stage, camera):
+    """Wrap a simulated camera and stage, calibrated from the known geometry."""
+    from nplab.instrument.camera.camera_with_location import CameraWithLocation
+    cwl = CameraWithLocation(camera, stage)
+    # Image columns run along X, rows along Y (see SyntheticSample.render)
+    cwl.pixel_to_sample_displacement = np.array([[0, camera.pixel_size, 0],
+                                                 [camera.pixel_size, 0, 0],
+                                                 [0, 0, 1]], dtype=np.float64)
+    return cwl
+
+
+def report(name, duration, n, stage=None, unit="point"):
+    """Print a one-line summary of a benchmark."""
+    message = "{0}: {1:.2f} s, {2:.1f} ms per {3}".format(name, duration, 1000.0 * duration / n, unit)
+    if stage is not None:
+        message += ", {0:.1f} stage round trips per {1}".format(float(stage.round_trips) / n, unit)
+    print(message)
+
+
+def benchmark_grid_scan(shape=(20, 20)):
+    """A GridScan that fits a peak to the spectrum at each point and saves both to HDF5.
+
+    This is run with and without pipelining, i.e. with the fitting and saving
+    done while the stage moves on, or in between points.
+    """
+    from scipy.optimize import curve_fit
+    from nplab.experiment.scanning_experiment import GridScan
+    stage, camera, spectrometer = make_instruments()
+    group = nplab.datafile.current().create_group("grid_scan_benchmark_%d")
+    wavelengths = spectrometer.wavelengths
+
+    def lorentzian(x, amplitude, centre, width, offset):
+        return amplitude / (1 + ((x - centre) / width)**2) + offset
+
+    class SpectrumGridScan(GridScan):
+        def open_scan(self):
+            self.spectra = group.create_dataset("spectra_%d", shape=self.grid_shape + (wavelengths.size,))
+            self.peaks = group.create_dataset("peaks_%d", shape=self.grid_shape + (4,))
+
+        def acquire(self, *indices):
+            return spectrometer.read_spectrum()
+
+        def process_and_store(self, spectrum, *indices):
+            guess = [np.ptp(spectrum), wavelengths[np.argmax(spectrum)], 20, np.min(spectrum)]
+            try:
+                self.peaks[indices] = curve_fit(lorentzian, wavelengths, spectrum, p0=guess)[0]
+            except RuntimeError:  # the fit didn't converge
+                self.peaks[indices] = np.nan
+            self.spectra[indices] = spectrum
+
+    scan = SpectrumGridScan()
+    scan.set_stage(stage, axes=('x', 'y'))
+    scan.stage_units = 1e-6  # the scan works in metres, the stage in microns
+    scan.size[:] = np.array(shape) - 1
+    scan.step[:] = 1
+    scan.init[:] = 0
+    for pipelined in (False, True):
+        scan.pipelined = pipelined
+        stage.round_trips = 0
+        t0 = time.time()
+        scan.scan(scan.axes, scan.size, scan.step, scan.init)
+        report("GridScan {0}{1}".format(shape, ", pipelined" if pipelined else ""),
+               time.time() - t0, scan.total_points, stage)
+
+
+def benchmark_hyperspectral_scan(shape=(20, 20)):
+    """A HyperspectralScan, writing to HDF5 (needs Qt, but not a display).
+
+    This is run stepping from point to point, with and without pipelining,
+    and as a fly scan (sweeping along each line while reading spectra).
+    """
+    from nplab.utils.gui import get_qt_app
+    from nplab.experiment.hyperspectral_imaging import HyperspectralScan
+    app = get_qt_app()
+    stage, camera, spectrometer = make_instruments()
+    scan = HyperspectralScan()
+    scan.num_axes = 2
+    scan.set_stage(stage, axes=('x', 'y'))
+    scan.set_spectrometers(spectrometer)
+    scan.stage_units = 1e-6
+    scan.size[:] = np.array(shape) - 1
+    scan.step[:] = 1
+    scan.init[:] = 0
+    for pipelined, fly_scan in ((False, False), (True, False), (True, True)):
+        scan.pipelined = pipelined
+        scan.fly_scan = fly_scan
+        stage.round_trips = 0
+        t0 = time.time()
+        scan.run()
+        scan.acquisition_thread.join()
+        report("HyperspectralScan {0}{1}{2}".format(shape, ", pipelined" if pipelined else "",
+                                                   ", fly scan" if fly_scan else ""),
+               time.time() - t0, scan.total_points, stage)
+        print(scan.profiler.format_summary())
+
+
+def benchmark_adaptive_scan(size=20.0, coarse_step=1.0, refinement_levels=2):
+    """An AdaptiveScan of spectra, compared with a raster of the whole area at its finest step.
+
+    The full raster isn't run: its time is estimated from the time per point
+    of the adaptive scan.  A particle counts as found if a point was measured
+    within half a fine step (on each axis) of it.
+    """
+    from nplab.experiment.scanning_experiment import AdaptiveScan
+    stage, camera, spectrometer = make_instruments()
+
+    class SpectrumAdaptiveScan(AdaptiveScan):
+        def open_scan(self):
+            self.spectra = {}
+
+        def acquire(self, *indices):
+            return spectrometer.read_spectrum()
+
+        def process_and_store(self, spectrum, *indices):
+            self.spectra[indices] = spectrum
+
+    scan = SpectrumAdaptiveScan()
+    scan.set_stage(stage, axes=('x', 'y'))
+    scan.stage_units = 1e-6
+    scan.refinement_levels = refinement_levels
+    scan.size[:] = size
+    scan.step[:] = coarse_step
+    scan.init[:] = 0
+    scan.pipelined = True
+    stage.round_trips = 0
+    t0 = time.time()
+    scan.scan(scan.axes, scan.size, scan.step, scan.init)
+    duration = time.time() - t0
+    n_fine = int(np.prod(scan.grid_shape))
+    report("AdaptiveScan {0} um, {1} levels".format(size, refinement_levels), duration, len(scan.interest), stage)
+    fine_step = coarse_step / 2**refinement_levels
+    particles = spectrometer.sample.positions[np.all(abs(spectrometer.sample.positions) <= size / 2.0, axis=1)]
+    positions = scan.positions[:, ::-1] / scan.stage_units # (x, y) in microns, like the sample
+    found = [np.any(np.all(abs(positions - p) <= fine_step / 2.0 + 1e-9, axis=1)) for p in particles]
+    print("    {0} of {1} fine grid points measured ({2:.1f}x fewer, full raster ~{3:.0f} s); "
+          "{4} of {5} particles found".format(len(scan.interest), n_fine, float(n_fine) / len(scan.interest),
+                                              duration / len(scan.interest) * n_fine,
+                                              int(np.sum(found)), len(particles)))
+
+
+def benchmark_hyperspectral_writes(shape=(200, 200)):
+    """Saving HyperspectralScan spectra (1024 points each) one point, or one line, at a time.
+
+    This calls `process_and_store` directly, so it times the saving but not
+    the acquisition.  It then times updates of the live preview.
+    """
+    from nplab.utils.gui import get_qt_app
+    from nplab.experiment.hyperspectral_imaging import HyperspectralScan
+    from nplab.utils.path_planning import snake_raster
+    app = get_qt_app()
+    stage, camera, spectrometer = make_instruments()
+    spectrum = spectrometer.simulate_spectrum()
+    points = snake_raster(np.arange(shape[0]), np.arange(shape[1])).astype(int)
+    scan = HyperspectralScan()
+    scan.num_axes = 2
+    scan.set_stage(stage, axes=('x', 'y'))
+    scan.set_spectrometers(spectrometer)
+    scan.size[:] = np.array(shape[::-1]) - 1
+    scan.step[:] = 1
+    for line_buffered, storage_dtype in ((False, np.float64), (True, np.float64), (True, np.float32)):
+        scan.line_buffered = line_buffered
+        scan.storage_dtype = storage_dtype
+        scan.init_grid(scan.axes[::-1], scan.size[::-1], scan.step[::-1], scan.init[::-1])
+        scan.completed = np.zeros(scan.grid_shape, dtype=bool)
+        scan.open_scan()
+        t0 = time.time()
+        for indices in points:
+            scan.process_and_store(spectrum, *indices)
+        scan.write_line()
+        scan.data.file.flush()
+        report("HyperspectralScan writes {0}, {1}, {2}".format(
+                   shape, "line buffered" if line_buffered else "unbuffered", np.dtype(storage_dtype).name),
+               time.time() - t0, shape[0], unit="line")
+    t0 = time.time()
+    for i in range(100):
+        scan.set_latest_view(*points[-1])
+    report("HyperspectralScan preview {0}".format(shape), time.time() - t0, 100, unit="update")
+    t0 = time.time()
+    scan.view_wavelength += 50
+    report("HyperspectralScan preview {0}, changing wavelength".format(shape), time.time() - t0, 1, unit="change")
+
+
+def benchmark_autofocus(repeats=5, start_z=(1.5, -0.7, 2.2, 0.3, -2.6)):
+    """CameraWithLocation.autofocus, fast_autofocus and fly_autofocus, starting out of focus."""
+    stage, camera, spectrometer = make_instruments()
+    cwl = make_camera_with_location(stage, camera)
+    for name, autofocus in [("Autofocus", cwl.autofocus), ("Fast autofocus", cwl.fast_autofocus),
+                            ("Fly-through autofocus", cwl.fly_autofocus)]:
+        errors = []
+        stage.round_trips = 0
+        t0 = time.time()
+        for i in range(repeats):
+            stage.move(np.array([0, 0, start_z[i % len(start_z)]]))
+            autofocus()
+            errors.append(stage._true_position()[2] - camera.sample.focal_z)
+        report(name, time.time() - t0, repeats, stage, unit="autofocus")
+        print("    focus errors: {0}".format(np.round(errors, 3)))
+
+
+def benchmark_tiled_acquisition(n_tiles=(3, 3)):
+    """AcquireGridOfImages, saving tiles to the current datafile."""
+    from nplab.instrument.camera.camera_with_location import AcquireGridOfImages
+    stage, camera, spectrometer = make_instruments()
+    cwl = make_camera_with_location(stage, camera)
+    experiment = AcquireGridOfImages(cwl)
+    experiment.prepare_to_run(n_tiles=n_tiles, overlap_pixels=100)
+    stage.round_trips = 0
+    t0 = time.time()
+    experiment.run(n_tiles=n_tiles)
+    report("AcquireGridOfImages {0}".format(n_tiles), time.time() - t0,
+           n_tiles[0] * n_tiles[1], stage, unit="tile")
+
+
+def benchmark_stage_round_trips(shape=(10, 10)):
+    """Move, then grab an image with position metadata, at each point of a raster.
+
+    Compares polling the stage with waiting for move-completion events, with
+    and without the position cache.
+    """
+    for name, signals, lifetime in [("polling", False, None), ("completion events", True, None),
+                                    ("completion events + position cache", True, 0.1)]:
+        stage, camera, spectrometer = make_instruments()
+        stage.signals_move_completion = signals
+        stage.position_cache_lifetime = lifetime
+        cwl = make_camera_with_location(stage, camera)
+        stage.round_trips = 0
+        t0 = time.time()
+        for y in range(shape[0]):
+            for x in range(shape[1]):
+                stage.move(np.array([x, y]) * 5.0)
+                cwl.raw_image()
+        report("Raster {0}, {1}".format(shape, name), time.time() - t0, shape[0] * shape[1], stage)
+
+
+def benchmark_path_planning(n_points=(500, 10000)):
+    """Planning a route through randomly-placed particles, and the time the stage would take to follow it."""
+    from nplab.instrument.stage.simulated import trapezoidal_move_time
+    from nplab.utils.path_planning import nearest_neighbour_order, plan_path
+    stage, camera, spectrometer = make_instruments()
+    velocity, acceleration = stage.velocity[:2], stage.acceleration[:2]
+
+    def travel_time(positions):
+        legs = np.diff(np.concatenate([np.zeros((1, 2)), positions]), axis=0)
+        move_times = np.max(trapezoidal_move_time(legs, velocity, acceleration), axis=1)
+        return np.sum(move_times) + stage.settling_time * len(positions)
+
+    for n in n_points:
+        positions = np.random.RandomState(0).uniform(0, 400, (n, 2))  # in detection order
+        t0 = time.time()
+        nn_order = nearest_neighbour_order(positions, start=[0, 0], velocity=velocity)
+        t1 = time.time()
+        order = plan_path(positions, start=[0, 0], velocity=velocity)
+        t2 = time.time()
+        print("Path through {0} points: planned in {1:.3f} s ({2:.3f} s nearest-neighbour)".format(n, t2 - t1, t1 - t0))
+        print("    travel time: {0:.1f} s in detection order, {1:.1f} s nearest-neighbour, {2:.1f} s after 2-opt"
+              "".format(travel_time(positions), travel_time(positions[nn_order]), travel_time(positions[order])))
+
+
+def benchmark_trajectory(shape=(20, 20)):
+    """A snake raster with a spectrum at each point: separate moves vs. Stage.execute_trajectory."""
+    from nplab.utils.path_planning import snake_raster
+    waypoints = snake_raster(np.arange(shape[0]) * 1.0, np.arange(shape[1]) * 1.0)
+    n = len(waypoints)
+
+    stage, camera, spectrometer = make_instruments()
+    stage.signals_move_completion = False  # poll, as most drivers do
+    stage.round_trips = 0
+    t0 = time.time()
+    previous = None
+    for waypoint in waypoints:  # one blocking move per axis that changes, like GridScan
+        for axis, value, last in zip(('y', 'x'), waypoint, previous if previous is not None else [None] * 2):
+            if value != last:
+                stage.move(value, axis=axis)
+        previous = waypoint
+        spectrometer.read_spectrum()
+    report("Raster {0}, separate moves".format(shape), time.time() - t0, n, stage)
+
+    for name, callback in [("trajectory with callbacks", lambda i, waypoint: spectrometer.read_spectrum()),
+                           ("trajectory without callbacks", None)]:
+        stage, camera, spectrometer = make_instruments()
+        stage.round_trips = 0
+        t0 = time.time()
+        stage.execute_trajectory(waypoints, axes=('y', 'x'), callback=callback)
+        report("Raster {0}, {1}".format(shape, name), time.time() - t0, n, stage)
+
+
+def benchmark_video_recording(codecs=(None, 'gzip', 'jpeg'), duration=2.0):
+    """Camera.record from live view, compared with the camera's frame rate."""
+    stage, camera, spectrometer = make_instruments()
+    for codec in codecs:
+        frames = camera.record(duration=duration, codec=codec)
+        sequence_numbers = frames.parent['sequence_numbers'][...]
+        camera_rate = (sequence_numbers[-1] - sequence_numbers[0]) / duration
+        print("Recording with codec {0}: {1:.1f} frames/s saved, {2:.1f} frames/s from the camera, "
+              "{3} frames dropped".format(codec, frames.shape[0] / duration, camera_rate,
+                                          frames.attrs['frames_dropped']))
+
+
+def benchmark_feature_location(n_images=20, shape=(480, 640), max_shift=40.0):
+    """locate_feature_in_image, with each FeatureLocator method, on synthetic images with known sub-pixel shifts."""
+    from nplab.utils.image_with_location import FeatureLocator, datum_pixel
+    stage, camera, spectrometer = make_instruments()
+    rs = np.random.RandomState(0)
+    def image_at(shift):
+        """A noisy, 8-bit colour image with the sample moved by `shift` pixels (rows, columns)."""
+        centre = np.array([shift[1], shift[0]]) * camera.pixel_size # columns run along X
+        signal = camera.noise_model.apply(camera.sample.render(centre, shape, camera.pixel_size) * 1e-2)
+        gray = np.clip(signal * 255.0 / np.percentile(signal, 99.9), 0, 255).astype(np.uint8)
+        return np.dstack([gray] * 3)
+    reference = image_at((0, 0))
+    h, w = shape
+    feature = reference[h // 4:3 * h // 4, w // 4:3 * w // 4, ...]
+    feature_datum = datum_pixel(feature)
+    shifts = rs.uniform(-max_shift, max_shift, (n_images, 2))
+    images = [image_at(shift) for shift in shifts]
+    # The feature moves the opposite way to the sample
+    expected = [np.array([h // 4, w // 4]) + feature_datum - shift for shift in shifts]
+    for method in FeatureLocator.methods:
+        locator = FeatureLocator(feature, method=method)
+        locator.locate(images[0]) # the first call may need to set things up
+        t0 = time.time()
+        positions = [locator.locate(image) for image in images]
+        errors = np.sqrt(np.sum((np.array(positions) - np.array(expected))**2, axis=1))
+        report("Feature location ({0})".format(method), time.time() - t0, n_images, unit="image")
+        print("    error: {0:.3f} px RMS, {1:.3f} px max".format(np.sqrt(np.mean(errors**2)), np.max(errors)))
+
+
+def benchmark_stitching(n_tiles=(50, 50), tile_shape=(120, 160), overlap=0.25, jitter=3):
+    """Register and blend a grid of tiles cut from a random texture, with errors in their nominal positions."""
+    from nplab.utils import stitching
+    rs = np.random.RandomState(0)
+    step = (np.array(tile_shape) * (1 - overlap)).astype(int)
+    texture = rs.randint(0, 256, tuple(np.array(n_tiles) * step + np.array(tile_shape) + 2 * jitter)).astype(np.uint8)
+    texture = cv2.GaussianBlur(texture, (0, 0), 2)
+    grid = np.array([(i * step[0], j * step[1]) for i in range(n_tiles[0]) for j in range(n_tiles[1])]) + jitter
+    true_positions = grid + rs.randint(-jitter, jitter + 1, grid.shape)
+    tiles = nplab.current_datafile().create_group("stitching_tiles_%d")
+    for r, c in true_positions:
+        tiles.create_dataset("tile_%d", data=texture[r:r + tile_shape[0], c:c + tile_shape[1]], autoflush=False)
+    tile_list = stitching.tile_datasets(tiles)
+    t0 = time.time()
+    pairs, offsets, scores = stitching.register_tiles(tile_list, grid, max_shift=2 * jitter)
+    report("Tile registration {0}".format(n_tiles), time.time() - t0, len(pairs), unit="pair")
+    t0 = time.time()
+    fitted = stitching.solve_tile_positions(grid, pairs, offsets, scores)
+    report("Tile placement {0}".format(n_tiles), time.time() - t0, len(tile_list), unit="tile")
+    error = (fitted - fitted[0]) - (true_positions - true_positions[0])
+    print("    position error: {0:.3f} px RMS, {1:.3f} px max".format(np.sqrt(np.mean(error**2)), np.max(np.abs(error))))
+    t0 = time.time()
+    mosaic = stitching.write_mosaic(tile_list, fitted, nplab.current_datafile().create_group("mosaic_%d"))
+    report("Mosaic blending and pyramid {0}".format(mosaic.shape), time.time() - t0, len(tile_list), unit="tile")
+
+
+if __name__ == '__main__':
+    folder = tempfile.mkdtemp()
+    nplab.datafile.set_current(os.path.join(folder, "benchmark.h5"), mode='a')
+    benchmark_grid_scan()
+    benchmark_hyperspectral_scan()
+    benchmark_hyperspectral_writes()
+    benchmark_adaptive_scan()
+    benchmark_autofocus()
+    benchmark_tiled_acquisition()
+    benchmark_stage_round_trips()
+    benchmark_path_planning()
+    benchmark_trajectory()
+    benchmark_video_recording()
+    benchmark_feature_location()
+    benchmark_stitching()
+    nplab.close_current_datafile()
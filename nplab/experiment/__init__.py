@@ -3,4 +3,5 @@ Module containing the classes used to run experiments.
 """
 __author__ = 'alansanders'
 
-from .experiment import Experiment, ExperimentStopped
\ No newline at end of file
+from .experiment import Experiment, ExperimentStopped
+from .scheduler import ExperimentScheduler, ScheduledRun
@@ -10,10 +10,14 @@ lot of threading code.
 
 __author__ = 'alansanders, richard bowman'
 
-from nplab.utils.thread_utils import locked_action, background_action, background_actions_running
+from nplab.utils.thread_utils import locked_action, background_action, background_actions_running, \
+    LatestValueChannel
 from nplab.instrument import Instrument
 from nplab.utils.notified_property import NotifiedProperty, DumbNotifiedProperty
-from collections import deque
+try:
+    from Queue import Empty # Python 2
+except ImportError:
+    from queue import Empty
 import numpy as np
 import threading
 import warnings
@@ -110,11 +114,45 @@ class Experiment(Instrument):
         
         This is important in order to keep the GUI responsive.
         """
+        self.run_in_foreground(*args, **kwargs)
+
+    @locked_action
+    def run_in_foreground(self, *args, **kwargs):
+        """Run the experiment in the current thread, and return when it has finished.
+
+        This is what run_in_background does in its thread.  Unlike start(),
+        it doesn't call prepare_to_run(), and errors are raised here rather
+        than being lost in a background thread.  `ExperimentScheduler` uses
+        it to run experiments in its own threads.
+        """
         self.log_messages = ""
         self._stop_event.clear()
         self._finished_event.clear()
         self.run(*args, **kwargs)
         self._finished_event.set()
+
+    def required_instruments(self):
+        """Return the instruments this experiment needs to itself while it runs.
+
+        `ExperimentScheduler` won't run two experiments at once if they need
+        any of the same instruments.  By default, this is every `Instrument`
+        that is an attribute of the experiment (or is in a list, tuple or
+        dict that is); override it if the experiment finds its instruments
+        some other way, or doesn't need all of them.
+        """
+        instruments = []
+        for value in self.__dict__.values():
+            if isinstance(value, dict):
+                candidates = list(value.values())
+            elif isinstance(value, (list, tuple)):
+                candidates = list(value)
+            else:
+                candidates = [value]
+            for candidate in candidates:
+                if isinstance(candidate, Instrument) and candidate is not self \
+                        and not any(candidate is i for i in instruments):
+                    instruments.append(candidate)
+        return instruments
         
     def start(self, *args, **kwargs):
         """Start the experiment running in a background thread.  See run_in_background."""
@@ -146,18 +184,23 @@ class Experiment(Instrument):
 
 
 class ExperimentWithDataDeque(Experiment):
-    """Alan's Experiment class, using a deque for data management."""
+    """Alan's Experiment class, which passes its latest data to the GUI.
+
+    The experiment thread publishes data with `set_latest_data` (or
+    `check_for_data_request`) whenever it has something new, and the GUI
+    picks up the newest data, if there is any, with `request_data`.  Data
+    goes through a `LatestValueChannel`, so neither side ever waits for the
+    other, and nothing is copied.
+    """
 
     latest_data = None    
     
     def __init__(self):
         super(Experiment, self).__init__()
-        #self.queue = Queue()
-        self.latest_data = deque([], maxlen=1)
+        self.data_channel = LatestValueChannel()
+        self._data_version_read = 0 # the version of the data that request_data last returned
         self.lock = threading.Lock()  # useful in threaded experiments
         self.acquiring = threading.Event()
-        self.data_requested = False
-        self.request_complete = False
 
     def run(self, *args, **kwargs):
         raise NotImplementedError()
@@ -167,56 +210,53 @@ class ExperimentWithDataDeque(Experiment):
     def run_in_background(self, *args, **kwargs):
         self.run(*args, **kwargs)
 
+    @locked_action
+    def run_in_foreground(self, *args, **kwargs):
+        self.run(*args, **kwargs)
+
     def set_latest_data(self, *data):
-        self.latest_data.append(data)
+        """Publish data (a tuple of the arguments) for the GUI, replacing any it hasn't picked up yet."""
+        self.data_channel.publish(data)
 
     def check_for_data(self):
-        #self.notifier.wait()
-        if len(self.latest_data):
-            return self.latest_data.pop()
-        else:
+        """Return the latest data, if it's been published since this was last called, otherwise False."""
+        latest = self.data_channel.get_if_newer(self._data_version_read)
+        if latest is None:
             return False
+        self._data_version_read, data = latest
+        return data
 
     def request_data(self):
-        if not self.request_complete:
-            self.data_requested = True
-            return False
-        self.request_complete = False
-        data = self.check_for_data()
-        return data
+        """Return the newest data from the experiment, or False if there's been nothing new (call from the GUI)."""
+        return self.check_for_data()
 
     def check_for_data_request(self, *data):
+        """Publish data for the GUI (call from the experiment thread).
+
+        The data are not copied, so the GUI may see changes made to them
+        afterwards: to give it a snapshot, pass a copy (or a new array).
         """
-        Be careful when giving sequences/iterables e.g. lists, arrays as these are passed
-        by reference and can cause threading issues. Be sure to send a copy.
-        :param data:
-        :return:
-        """
-        if self.data_requested:
-            data = tuple(d.copy() if hasattr(d, 'copy') else np.array(d) for d in data)
-            self.set_latest_data(*data)
-            self.data_requested = False
-            self.request_complete = True
+        self.set_latest_data(*data)
 
     @staticmethod
     def queue_data(queue, *data):
-        with queue.mutex:
-            queue.queue.clear()
-            queue.all_tasks_done.notify_all()
-            queue.unfinished_tasks = 0
+        """Replace anything waiting in a Queue with `data`."""
+        try:
+            while True:
+                queue.get_nowait()
+        except Empty:
+            pass
         queue.put(data)
-        queue.task_done()
 
     @staticmethod
     def check_queue(queue):
-        queue.join()
-        if not queue.empty():
-            while not queue.empty():
-                #print queue.qsize()
-                item = queue.get()
+        """Return the newest item in a Queue (discarding any older ones), or False if it's empty."""
+        item = False
+        try:
+            while True:
+                item = queue.get_nowait()
+        except Empty:
             return item
-        else:
-            return False
 
     @staticmethod
     def append_dataset(h5object, name, value, shape=(0,)):
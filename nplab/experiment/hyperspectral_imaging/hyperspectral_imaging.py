@@ -9,9 +9,11 @@ from nplab.utils.gui import *
 from nplab.utils.gui import uic
 from nplab.ui.ui_tools import UiTools
 import numpy as np
+import numpy.ma as ma
 import matplotlib
 import warnings
 import time
+import threading
 
 matplotlib.use('Qt4Agg')
 from matplotlib.backends.backend_qt4agg import FigureCanvasQTAgg as FigureCanvas
@@ -31,7 +33,36 @@ pg.setConfigOption('foreground', 'k')
 
 
 class HyperspectralScan(GridScanQt, ScanningExperimentHDF5):
+    """A grid scan that saves a spectrum (from each spectrometer) at every point.
+
+    If `line_buffered` is True, the spectra from each line of the scan are
+    kept in memory and saved in one go when the line is complete (or when
+    the scan finishes), in a dataset with one chunk per line.  Otherwise,
+    each spectrum is saved as soon as it is taken.  Set `storage_dtype` to
+    np.float32 to halve the size of the file.
+
+    The scan's parameters are saved as attributes of its group, and the
+    points that have been saved are marked in its 'completed' dataset (the
+    file is flushed after every line), so an interrupted scan can be
+    carried on with `resume`.
+
+    With `fly_scan` set (see GridScan), spectra are read continuously while
+    the stage sweeps along each line, and averaged onto the points of the
+    line, so `hs_image` has the same layout as for a stepped scan.
+
+    The live preview never reads the file.  As each spectrum is processed,
+    its value at `view_wavelength` goes into `preview_images`, and its
+    integral over each (min, max) wavelength range in `preview_bands` into
+    `band_images`.  A copy of the spectra, averaged over every
+    `preview_decimation` points, is also kept in memory, so that the
+    preview can be redrawn (approximately) if `view_wavelength` changes.
+    """
     view_layer_updated = QtCore.Signal(int)
+    pipelined = True # spectra are processed and saved while the stage moves to the next point
+    line_buffered = True
+    storage_dtype = np.float64
+    preview_decimation = 8
+    preview_bands = ()
 
     def __init__(self):
         GridScanQt.__init__(self)
@@ -41,6 +72,13 @@ class HyperspectralScan(GridScanQt, ScanningExperimentHDF5):
         self.num_spectrometers = 1
         self.safe_exit = False
         self.delay = 0.
+        self._line_buffers = []
+        self._line_filled = np.zeros(0, dtype=bool)
+        self._line_index = None
+        self.preview_images = []
+        self.band_images = []
+        self._previews = []
+        self._preview_lock = threading.Lock()
 
         self.fig = None#Figure()
         self._created = False
@@ -48,6 +86,20 @@ class HyperspectralScan(GridScanQt, ScanningExperimentHDF5):
         self.view_layer = 0
         self.override_view_layer = False  # used to manually show a specific layer instead of current one scanning
 
+    @property
+    def view_wavelength(self):
+        return self._view_wavelength
+
+    @view_wavelength.setter
+    def view_wavelength(self, value):
+        self._view_wavelength = value
+        with self._preview_lock:
+            for i, preview in enumerate(self._previews):
+                preview['view_index'] = abs(preview['wavelengths'] - value).argmin()
+                # redraw the points we've already scanned from the decimated spectra
+                b = np.searchsorted(preview['bin_starts'], preview['view_index'], side='right') - 1
+                self.preview_images[i][...] = preview['decimated_spectra'][..., b]
+
     @property
     def view_layer(self):
         return self._view_layer
@@ -86,24 +138,44 @@ class HyperspectralScan(GridScanQt, ScanningExperimentHDF5):
 
     def open_scan(self):
         super(HyperspectralScan, self).open_scan()
-        group = self.f.require_group('hyperspectral_images')
-        self.data = group.create_group('scan_%d', attrs=dict(description=self.description))
-        print 'Saving scan to: {}'.format(self.f.file.filename), self.data
-        raw_group = self.data.create_group('raw_data')
-        for axis_name, axis_values in zip(self.axes_names, self.scan_axes):
-            self.data.create_dataset(axis_name, data=axis_values)
+        if self.resume_group is not None:
+            self.data = self.resume_group
+            print 'Resuming scan in: {}'.format(self.data.file.filename), self.data
+            self.completed = self.data['completed'][...].astype(bool)
+        else:
+            group = self.f.require_group('hyperspectral_images')
+            attrs = dict(description=self.description, **self.scan_parameters())
+            self.data = group.create_group('scan_%d', attrs=attrs)
+            print 'Saving scan to: {}'.format(self.f.file.filename), self.data
+            raw_group = self.data.create_group('raw_data')
+            for axis_name, axis_values in zip(self.axes_names, self.scan_axes):
+                self.data.create_dataset(axis_name, data=axis_values)
+            # which points have been saved, so the scan can be resumed if it's interrupted
+            self.data.create_dataset('completed', shape=self.grid_shape, dtype=bool,
+                                     chunks=(1,) * (len(self.grid_shape) - 1) + self.grid_shape[-1:])
+        self._line_buffers = []
+        self._line_filled = np.zeros(self.grid_shape[-1], dtype=bool)
+        self._line_index = None
         for i in xrange(self.num_spectrometers):
             suffix = self._suffix(i)
             spectrometer = self.spectrometer.spectrometers[i]\
                 if isinstance(self.spectrometer, Spectrometers) else self.spectrometer
+            line_shape = (self.grid_shape[-1], spectrometer.wavelengths.size)
+            self._line_buffers.append((np.zeros(line_shape, dtype=self.storage_dtype),
+                                       np.zeros(line_shape, dtype=self.storage_dtype)))
+            if self.resume_group is not None:
+                continue
+            chunks = None
+            if self.line_buffered:
+                chunks = (1,) * (len(self.grid_shape) - 1) + line_shape # one chunk per line of the scan
             self.data.create_dataset('wavelength'+suffix, data=spectrometer.wavelengths)
             self.data.create_dataset('hs_image'+suffix,
                                      shape=self.grid_shape + (spectrometer.wavelengths.size,),
-                                     dtype=np.float64,
+                                     dtype=self.storage_dtype, chunks=chunks,
                                      attrs=spectrometer.metadata)
             self.data.create_dataset('raw_data/hs_image'+suffix,
                                      shape=self.grid_shape + (spectrometer.wavelengths.size,),
-                                     dtype=np.float64,
+                                     dtype=self.storage_dtype, chunks=chunks,
                                      attrs=spectrometer.metadata)
         if isinstance(self.spectrometer, Spectrometer):
             self.read_spectra = self.spectrometer.read_spectrum
@@ -111,9 +183,64 @@ class HyperspectralScan(GridScanQt, ScanningExperimentHDF5):
         elif isinstance(self.spectrometer, Spectrometers):
             self.read_spectra = self.spectrometer.read_spectra
             self.process_spectra = self.spectrometer.process_spectra
+        self._profiled_exposure = self.get_max_exposure()
+        self.init_preview()
+        if self.resume_group is not None:
+            self.load_preview()
         self.init_figure()
 
+    def init_preview(self):
+        """Set up the in-memory preview of the scan (see the class docstring)."""
+        with self._preview_lock:
+            self._previews = []
+            self.preview_images = []
+            self.band_images = []
+            for i in xrange(self.num_spectrometers):
+                spectrometer = self.spectrometer.spectrometers[i]\
+                    if isinstance(self.spectrometer, Spectrometers) else self.spectrometer
+                wavelengths = np.asarray(spectrometer.wavelengths)
+                bin_starts = np.arange(0, wavelengths.size, self.preview_decimation)
+                # mask_spectrum hides the points where the reference is too dim; work this out once
+                mask = ma.getmaskarray(spectrometer.mask_spectrum(np.zeros(wavelengths.size), 0.05))
+                self._previews.append(dict(
+                    wavelengths=wavelengths,
+                    view_index=abs(wavelengths - self.view_wavelength).argmin(),
+                    bin_starts=bin_starts,
+                    bin_sizes=np.diff(np.append(bin_starts, wavelengths.size)),
+                    band_masks=[(wavelengths >= min(band)) & (wavelengths <= max(band))
+                                for band in self.preview_bands],
+                    mask=mask,
+                    latest_spectrum=np.full(wavelengths.size, np.nan),
+                    decimated_spectra=np.full(self.grid_shape + (bin_starts.size,), np.nan, dtype=np.float32),
+                ))
+                self.preview_images.append(np.full(self.grid_shape, np.nan))
+                self.band_images.append(np.full(self.grid_shape + (len(self.preview_bands),), np.nan))
+
+    def load_preview(self):
+        """Fill in the preview with the points that have already been saved (when resuming a scan)."""
+        for line_index in np.ndindex(*self.grid_shape[:-1]):
+            done = np.flatnonzero(self.completed[line_index])
+            if len(done) == 0:
+                continue
+            lines = [self.data['hs_image'+self._suffix(i)][line_index] for i in xrange(self.num_spectrometers)]
+            for j in done:
+                self.update_preview([line[j] for line in lines], *(line_index + (j,)))
+
+    def update_preview(self, spectra, *indices):
+        """Add the processed spectra (one from each spectrometer) from a point to the preview."""
+        with self._preview_lock:
+            for i, (preview, spectrum) in enumerate(zip(self._previews, spectra)):
+                spectrum = np.asarray(spectrum, dtype=np.float64)
+                preview['latest_spectrum'] = spectrum
+                self.preview_images[i][indices] = spectrum[preview['view_index']]
+                preview['decimated_spectra'][indices] = \
+                    np.add.reduceat(spectrum, preview['bin_starts']) / preview['bin_sizes']
+                for b, band_mask in enumerate(preview['band_masks']):
+                    self.band_images[i][indices + (b,)] = np.trapz(spectrum[band_mask],
+                                                                   preview['wavelengths'][band_mask])
+
     def close_scan(self):
+        self.write_line()
         super(HyperspectralScan, self).close_scan()
         self.data.file.flush()
         time.sleep(0.1)
@@ -123,43 +250,83 @@ class HyperspectralScan(GridScanQt, ScanningExperimentHDF5):
             else:
                 self.light_source.power = 0
 
-    def scan_function(self, *indices):
-        time.sleep(self.delay)
-        raw_spectra = self.read_spectra()
+    def acquire(self, *indices):
+        with self.profile_phase('settle', *indices):
+            time.sleep(self.delay)
+        return self.read_spectra()
+
+    def acquire_on_the_fly(self, *indices):
+        return self.read_spectra() # there's no point waiting for the stage to settle
+
+    def process_and_store(self, raw_spectra, *indices):
         spectra = self.process_spectra(raw_spectra)
-        self.data['raw_data/hs_image'+self._suffix(0)][indices] = raw_spectra
-        self.data['hs_image'+self._suffix(0)][indices] = spectra
-#        for i, (spectrum, raw_spectrum) in enumerate(zip(spectra, raw_spectra)):
-#            try:
-#                suffix = self._suffix(i)
-#                self.data['raw_data/hs_image'+suffix][indices] = raw_spectrum
-#                self.data['hs_image'+suffix][indices] = spectrum
-#            except Exception as e:
-#                print e
-        self.check_for_data_request(*self.set_latest_view(*indices))
+        if not isinstance(self.spectrometer, Spectrometers):
+            raw_spectra, spectra = [raw_spectra], [spectra]
+        if indices[:-1] != self._line_index:
+            if np.any(self._line_filled): # we've moved on before the last line was finished
+                with self.profile_phase('write', *indices):
+                    self.write_line()
+            self._line_index = indices[:-1]
+        if self.line_buffered:
+            for (raw_line, line), raw_spectrum, spectrum in zip(self._line_buffers, raw_spectra, spectra):
+                raw_line[indices[-1]] = raw_spectrum
+                line[indices[-1]] = spectrum
+        else:
+            with self.profile_phase('write', *indices):
+                for i, (raw_spectrum, spectrum) in enumerate(zip(raw_spectra, spectra)):
+                    suffix = self._suffix(i)
+                    self.data['raw_data/hs_image'+suffix][indices] = raw_spectrum
+                    self.data['hs_image'+suffix][indices] = spectrum
+        self._line_filled[indices[-1]] = True
+        if np.all(self._line_filled | self.completed[self._line_index]):
+            with self.profile_phase('write', *indices):
+                self.write_line()
+        with self.profile_phase('gui', *indices):
+            self.update_preview(spectra, *indices)
+            self.set_latest_data(*self.set_latest_view(*indices))
+
+    def write_line(self):
+        """Save the points scanned on the current line, and mark them as completed.
+
+        If the scan is line buffered, this saves the buffered spectra; otherwise they have already been saved,
+        and this just updates the "completed" dataset.  The file is then flushed, so that the scan can be
+        resumed if it's interrupted.
+        """
+        if self._line_index is None or not np.any(self._line_filled):
+            return
+        filled = np.flatnonzero(self._line_filled)
+        # a line is scanned from one end, so the points are contiguous unless we resumed half way along
+        for run in np.split(filled, np.flatnonzero(np.diff(filled) > 1) + 1):
+            columns = self._line_index + (slice(run[0], run[-1] + 1),)
+            if self.line_buffered:
+                for i, (raw_line, line) in enumerate(self._line_buffers):
+                    suffix = self._suffix(i)
+                    self.data['raw_data/hs_image'+suffix][columns] = raw_line[columns[-1]]
+                    self.data['hs_image'+suffix][columns] = line[columns[-1]]
+            self.data['completed'][columns] = True
+        self.data.file.flush()
+        self._line_filled[:] = False
+        self._line_index = None
 
     def set_latest_view(self, *indices):
+        """Return the preview image, wavelengths and latest spectrum from each spectrometer.
+
+        The images are not copied, so they carry on filling in as the scan progresses.
+        """
         view_data = []
-        for i in xrange(self.num_spectrometers):
-            suffix = self._suffix(i)
-            spectrometer = self.spectrometer.spectrometers[i]\
-                if isinstance(self.spectrometer, Spectrometers) else self.spectrometer
-            w = abs(spectrometer.wavelengths - self.view_wavelength).argmin()
-            data = self.data['hs_image'+suffix]
-            if self.num_axes == 2:
-                latest_view = data[:, :, w]
-                spectrum = self.data['hs_image'+suffix][indices[-2], indices[-1], :]
-            elif self.num_axes == 3:
-                if self.override_view_layer:
-                    k = self.view_layer
-                else:
-                    k = self.indices[0]
-                    if self.view_layer != k:
-                        self.view_layer = k
-                latest_view = data[k, :, :, w]
-                spectrum = self.data['hs_image'+suffix][k, indices[-2], indices[-1], :]
-            spectrum = spectrometer.mask_spectrum(spectrum, 0.05)
-            view_data += [latest_view, spectrometer.wavelengths, spectrum]
+        with self._preview_lock:
+            for i, preview in enumerate(self._previews):
+                latest_view = self.preview_images[i]
+                if self.num_axes == 3:
+                    if self.override_view_layer:
+                        k = self.view_layer
+                    else:
+                        k = self.indices[0]
+                        if self.view_layer != k:
+                            self.view_layer = k
+                    latest_view = latest_view[k]
+                spectrum = ma.array(preview['latest_spectrum'], mask=preview['mask'])
+                view_data += [latest_view, preview['wavelengths'], spectrum]
         return tuple(view_data)
 
     def init_figure(self):
@@ -252,18 +419,25 @@ class HyperspectralScan(GridScanQt, ScanningExperimentHDF5):
             #self.fig.canvas.flush_events()
             self.fig.canvas.draw()
 
-    @property
-    def estimated_step_time(self):
+    def get_max_exposure(self):
+        """The longest integration time of the spectrometers, in seconds."""
         if isinstance(self.spectrometer, Spectrometer):
-            max_exposure = self.spectrometer.integration_time
+            return 1e-3 * self.spectrometer.integration_time
         elif isinstance(self.spectrometer, Spectrometers):
-            max_exposure = 1e-3 * max([s.integration_time for s in self.spectrometer.spectrometers])
+            return 1e-3 * max([s.integration_time for s in self.spectrometer.spectrometers])
         else:
-            max_exposure = 0
             warnings.warn('No integration time as spectrometer is not a valid instance of Spectrometer or Spectrometers.')
-        max_travel = 100e-3
-        #self.estimated_step_time = max_exposure + max_travel
-        return max_exposure + max_travel
+            return 0
+
+    @property
+    def estimated_step_time(self):
+        """The integration time, plus the rest of the time per step as measured in the last scan (or 100 ms)."""
+        max_exposure = self.get_max_exposure()
+        overhead = 100e-3
+        if self.profiler.steps_started > 1:
+            # the integration time may have changed since, so only use the time spent on everything else
+            overhead = self.profiler.step_interval(window=self.total_points) - self._profiled_exposure
+        return max_exposure + max(overhead, 0)
 
     @estimated_step_time.setter
     def estimated_step_time(self, value):
@@ -7,7 +7,9 @@ __author__ = 'alansanders'
 
 from .scanning_experiment import ScanningExperiment, ScanningExperimentHDF5
 from .scan_timing import TimedScan
+from .step_profiler import StepProfiler
 from .linear_scanner import LinearScan, LinearScanQt
 from .continuous_linear_scanner import ContinuousLinearScan, ContinuousLinearScanQt
 from .continuous_linear_stage_scanner import ContinuousLinearStageScan, ContinuousLinearStageScanQt
 from .grid_scanner import GridScan, GridScanQt
+from .adaptive_scanner import AdaptiveScan
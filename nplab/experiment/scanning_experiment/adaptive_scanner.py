@@ -0,0 +1,195 @@
+"""
+Adaptive Scanning
+=================
+
+Maps of particles or hotspots spend most of their points on empty
+substrate.  `AdaptiveScan` starts with a coarse raster, works out how
+interesting each point is (by default, its integrated intensity), and then
+samples more finely only around the interesting points, halving the step
+at each level of refinement, like a quadtree.
+
+The points all lie on a regular "fine" grid, whose step is the coarse step
+divided by ``2**refinement_levels``, so the usual `GridScan` indices (and
+`acquire`/`process_and_store`) still work: they just skip most of the
+grid.  The points that were measured are kept as a list (`positions`,
+`point_indices`, `interest` and `levels`), and `resampled_interest`
+interpolates them back onto the whole fine grid for display.
+"""
+
+import time
+import itertools
+import numpy as np
+from scipy.interpolate import griddata
+from nplab.experiment.scanning_experiment.grid_scanner import GridScan
+from nplab.utils import path_planning
+
+
+class AdaptiveScan(GridScan):
+    """A grid scan that measures a coarse grid, then refines it where the signal is.
+
+    `size`, `step` and `init` define the coarse grid, as for `GridScan`.
+    Subclasses implement `acquire(*indices)` and `process_and_store(data,
+    *indices)` (which may be pipelined), where `indices` are indices into the
+    fine grid (`grid_shape`, `scan_axes`).
+
+    After the coarse pass, points whose interest (see `measure_interest`) is
+    above `threshold` are refined: at each level, the points within
+    `refinement_radius` steps of each interesting point (at that level's
+    step, which is half the last one) are measured, and the new points that
+    are interesting are refined in turn.  If `threshold` is None, it is set
+    after the coarse pass to the median plus `threshold_mads` median absolute
+    deviations of the interest, i.e. anything that stands out from the
+    background.
+
+    `interest_metric` may be 'integrated' (the sum of the data), 'peak' (its
+    maximum minus its median), or a function that takes the data from a point
+    and returns a number.
+    """
+    refinement_levels = 2
+    refinement_radius = 1
+    interest_metric = 'integrated'
+    threshold = None
+    threshold_mads = 5.0
+
+    def __init__(self):
+        GridScan.__init__(self)
+        self.coarse_shape = (0, 0)
+        self.interest_threshold = None
+        self._level = 0
+        self._clear_points()
+
+    def _clear_points(self):
+        self._points = [] # (fine grid indices, interest, level) of each point that has been measured
+        self.measured = np.zeros(self.grid_shape, dtype=bool)
+        self.interest_map = np.full(self.grid_shape, np.nan)
+
+    def init_grid(self, axes, size, step, init):
+        """Create the coarse grid, and the fine grid that the refined points lie on."""
+        coarse_axes = GridScan.init_grid(self, axes, size, step, init)
+        self.coarse_shape = self.grid_shape
+        factor = 2**self.refinement_levels
+        scan_axes = [np.linspace(ax[0], ax[-1], (ax.size - 1) * factor + 1) if ax.size > 1 else ax
+                     for ax in coarse_axes]
+        self.grid_shape = tuple(ax.size for ax in scan_axes)
+        self.total_points = int(np.prod(self.grid_shape))
+        self.scan_axes = scan_axes
+        return scan_axes
+
+    def measure_interest(self, data, *indices):
+        """Return a number saying how interesting the data from a point is (see `interest_metric`)."""
+        if callable(self.interest_metric):
+            return float(self.interest_metric(data))
+        data = np.asarray(data, dtype=np.float64)
+        if self.interest_metric == 'integrated':
+            return float(np.sum(data))
+        elif self.interest_metric == 'peak':
+            return float(np.max(data) - np.median(data))
+        raise ValueError("interest_metric must be 'integrated', 'peak' or a function")
+
+    def automatic_threshold(self, values):
+        """The threshold used if `threshold` is None: anything that stands out from most of the points."""
+        values = np.asarray(values, dtype=np.float64)
+        values = values[np.isfinite(values)]
+        if len(values) == 0:
+            return np.inf
+        median = np.median(values)
+        return median + self.threshold_mads * np.median(np.abs(values - median))
+
+    def _scan_grid(self, axes, scan_axes):
+        """Measure the coarse grid, then refine it (the inner part of scan)."""
+        self.acquiring.set()
+        scan_start_time = time.time()
+        self._clear_points()
+        factor = 2**self.refinement_levels
+        coarse = path_planning.snake_raster(*[np.arange(0, n, factor) for n in self.grid_shape]).astype(int)
+        self.total_points = len(coarse)
+        self.status = 'Coarse pass: {0:d} points'.format(len(coarse))
+        self._measure_points(axes, scan_axes, coarse, level=0)
+        self.interest_threshold = self.threshold
+        if self.interest_threshold is None:
+            self.interest_threshold = self.automatic_threshold(self.interest)
+        for level in range(1, self.refinement_levels + 1):
+            if self.abort_requested:
+                break
+            points = self.refinement_points(factor // 2**level)
+            if len(points) == 0:
+                break
+            # visit the new points in a short path, starting from where we are
+            positions = np.array([[scan_axes[d][i] for d, i in enumerate(p)] for p in points])
+            start = np.array([scan_axes[d][i] for d, i in enumerate(self._points[-1][0])])
+            points = points[path_planning.plan_path(positions, start=start)]
+            self.total_points += len(points)
+            self.status = 'Refinement {0:d}/{1:d}: {2:d} points'.format(level, self.refinement_levels, len(points))
+            self._measure_points(axes, scan_axes, points, level)
+        self.print_scan_time(time.time() - scan_start_time)
+        self.acquiring.clear()
+
+    def refinement_points(self, spacing):
+        """Return the unmeasured points within `refinement_radius` steps of `spacing` of an interesting point."""
+        interesting = self.point_indices[self.interest > self.interest_threshold]
+        if len(interesting) == 0:
+            return np.zeros((0, len(self.grid_shape)), dtype=int)
+        radius = self.refinement_radius
+        offsets = spacing * np.array(list(itertools.product(range(-radius, radius + 1), repeat=len(self.grid_shape))))
+        candidates = (interesting[:, np.newaxis, :] + offsets[np.newaxis, :, :]).reshape(-1, len(self.grid_shape))
+        inside = np.all((candidates >= 0) & (candidates < np.array(self.grid_shape)), axis=1)
+        candidates = np.unique(candidates[inside], axis=0)
+        return candidates[~self.measured[tuple(candidates.T)]]
+
+    def _measure_points(self, axes, scan_axes, points, level):
+        """Visit each of a list of points on the fine grid, and acquire (and process) the data there."""
+        self._level = level
+        self._visit_points(axes, scan_axes, points, call_loop_hooks=False)
+
+    def _scan_point(self, *indices):
+        """Take the data at the current point, and work out how interesting it is."""
+        self.profiler.start_step(self._point_number(indices))
+        with self.profile_phase('acquire', *indices):
+            data = self.acquire(*indices)
+        value = self.measure_interest(data, *indices)
+        self.measured[indices] = True
+        self.interest_map[indices] = value
+        self._points.append((indices, value, self._level))
+        if self._pipeline is not None:
+            self._pipeline.put(data, indices)
+        else:
+            self._process_point(data, indices)
+
+    @property
+    def point_indices(self):
+        """The fine grid indices of the points measured so far (n_points x n_axes)."""
+        return np.array([p[0] for p in self._points], dtype=int).reshape(-1, len(self.grid_shape))
+
+    @property
+    def positions(self):
+        """The positions of the points measured so far (n_points x n_axes, in the order of the grid's dimensions)."""
+        indices = self.point_indices
+        return np.stack([self.scan_axes[d][indices[:, d]] for d in range(len(self.grid_shape))], axis=1)
+
+    @property
+    def interest(self):
+        """How interesting each point measured so far is."""
+        return np.array([p[1] for p in self._points], dtype=np.float64)
+
+    @property
+    def levels(self):
+        """The level of refinement at which each point was measured (0 for the coarse grid)."""
+        return np.array([p[2] for p in self._points], dtype=int)
+
+    def resampled_interest(self, method='linear'):
+        """Interpolate the interest of the measured points onto the whole fine grid, for display."""
+        indices, values = self.point_indices, self.interest
+        grid = tuple(np.indices(self.grid_shape))
+        resampled = griddata(indices, values, grid, method=method)
+        missing = np.isnan(resampled) # outside the points, or where linear interpolation fails
+        if np.any(missing):
+            resampled[missing] = griddata(indices, values, tuple(g[missing] for g in grid), method='nearest')
+        return resampled
+
+    def save_points(self, group):
+        """Save the measured points, and the resampled interest, to an HDF5 group."""
+        group.create_dataset('positions', data=self.positions, attrs=dict(axes=[str(ax) for ax in self.axes[::-1]]))
+        group.create_dataset('point_indices', data=self.point_indices)
+        group.create_dataset('interest', data=self.interest, attrs=dict(threshold=self.interest_threshold))
+        group.create_dataset('levels', data=self.levels)
+        group.create_dataset('resampled_interest', data=self.resampled_interest())
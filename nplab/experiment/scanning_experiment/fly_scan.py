@@ -0,0 +1,63 @@
+"""
+Fly Scanning
+============
+
+In a fly scan, the stage doesn't stop at each point of a line: it moves
+along the line at constant speed while the detector acquires as fast as it
+can.  Each acquisition is timestamped, its position is worked out from the
+stage positions read during the move (or from the commanded speed), and
+the acquisitions are then re-binned onto the points of the line, so the
+result has the same layout as a stepped scan.  See `GridScan.fly_scan`.
+"""
+
+import numpy as np
+
+
+def bin_onto_axis(positions, data, axis_values, fill=True):
+    """Average the data from acquisitions at arbitrary positions onto the points of a scan axis.
+
+    Arguments:
+    positions : array (n_acquisitions)
+        The position at which each acquisition was taken.
+    data : array (n_acquisitions x ...)
+        The data from each acquisition, e.g. a spectrum.
+    axis_values : array (n_points)
+        The positions of the points on the line.  Each point gets the
+        acquisitions that are closer to it than to any other point, and no
+        more than half a step beyond the ends of the line.
+    fill : bool, optional
+        If True (the default), points that got no acquisitions are linearly
+        interpolated from their neighbours; otherwise they are NaN.
+
+    Returns the binned data (n_points x ...) and the number of acquisitions
+    that were averaged for each point.
+    """
+    positions = np.asarray(positions, dtype=np.float64)
+    data = np.asarray(data, dtype=np.float64)
+    axis_values = np.asarray(axis_values, dtype=np.float64)
+    n = axis_values.size
+    order = np.argsort(axis_values)
+    values = axis_values[order]
+    edges = (values[1:] + values[:-1]) / 2.0
+    half_step = (values[-1] - values[0]) / (2.0 * (n - 1)) if n > 1 else np.inf
+    inside = (positions >= values[0] - half_step) & (positions <= values[-1] + half_step)
+    bins = np.searchsorted(edges, positions[inside])
+    counts = np.bincount(bins, minlength=n)
+    sums = np.zeros((n,) + data.shape[1:])
+    np.add.at(sums, bins, data[inside])
+    binned = np.full(sums.shape, np.nan)
+    binned[counts > 0] = sums[counts > 0] / counts[counts > 0].reshape((-1,) + (1,) * (data.ndim - 1))
+    filled, empty = np.flatnonzero(counts > 0), np.flatnonzero(counts == 0)
+    if fill and len(filled) > 0 and len(empty) > 0:
+        # interpolate between the nearest filled points on either side (or copy the nearest, at the ends)
+        after = np.clip(np.searchsorted(filled, empty), 0, len(filled) - 1)
+        before = np.clip(np.searchsorted(filled, empty) - 1, 0, len(filled) - 1)
+        lo, hi = filled[before], filled[after]
+        span = np.where(hi == lo, 1, values[hi] - values[lo])
+        weight = np.clip(np.where(hi == lo, 0, (values[empty] - values[lo]) / span), 0, 1)
+        weight = weight.reshape((-1,) + (1,) * (data.ndim - 1))
+        binned[empty] = binned[lo] * (1 - weight) + binned[hi] * weight
+    # put the points back in the order of axis_values
+    result, result_counts = np.empty_like(binned), np.empty_like(counts)
+    result[order], result_counts[order] = binned, counts
+    return result, result_counts
@@ -17,12 +17,61 @@ from functools import partial
 from nplab.utils.gui import *
 from nplab.ui.ui_tools import UiTools
 from nplab import inherit_docstring
+from nplab.utils.thread_utils import OrderedWorker
+from nplab.utils import path_planning
+from nplab.experiment.scanning_experiment.fly_scan import bin_onto_axis
 
 
 class GridScan(ScanningExperiment, TimedScan):
     """
     Note that the axes (x,y,z) will relate to the indices (z,y,x) as per array standards.
+
+    At each point, the scan calls `scan_function(*indices)`.  Alternatively, subclasses can split the work into
+    `acquire(*indices)`, which returns the data, and `process_and_store(data, *indices)`.  If `pipelined` is True,
+    only `acquire` runs on the scan thread, so the stage can move on as soon as it returns; `process_and_store` is
+    run on a worker thread, one point at a time and in the order the points were acquired.  No more than
+    `max_pending_points` points are queued for processing at once.  Points that have been acquired are always
+    processed, even if the scan is aborted, before `analyse_scan` and `close_scan` are called.
+
+    The time spent moving to, acquiring and processing each point is recorded by `profiler` (a StepProfiler, with
+    one record per point of the grid, in C order).  Subclasses can time other phases (e.g. 'settle' or 'write')
+    with `profile_phase`.
+
+    `completed` records which points of the grid have been done.  A scan that was saved to HDF5 but not finished
+    (because it was aborted, or crashed) can be continued with `resume`, which skips the completed points.  For this
+    to work, `open_scan` must save `scan_parameters()` as attributes of the scan's group, keep a record of the
+    completed points, and, if `resume_group` is set, reopen that group and load `completed` instead of starting a
+    new scan (see HyperspectralScan).
+
+    The order in which the points are visited is set by `scan_path`: 'snake' (the default, back and forth along
+    each line, and each layer), 'raster', 'spiral' (out from the middle of each layer), 'hilbert' (along a
+    space-filling curve, so points close together on the sample are measured close together in time, which stops
+    slow drift from showing up as stripes), 'random' (with `scan_path_seed`), or an (n_points x n_axes) array of
+    grid indices.  See `path_planning.grid_path_indices`; `path_indices()` returns the points in order.  Only the
+    axes that change are moved between points.  `outer_loop_start` etc. are called whenever the outermost (or
+    middle) index changes, which, for the paths other than snake and raster, can be at almost every point.
+
+    If `fly_scan` is True, the stage doesn't stop at each point of the innermost (fastest) axis: it sweeps along each
+    line, from half a step before the first point to half a step after the last (plus a run-up, if the stage has an
+    `acceleration` attribute), while `acquire_on_the_fly` is called as often as possible.  The position of each
+    acquisition is found from the stage positions read during the sweep (`fly_position_source='poll'`) or from its
+    speed and acceleration ('trajectory'), and the acquisitions are averaged
+    onto the points of the line (see `fly_scan.bin_onto_axis`), which are then processed and stored as usual.
+    `acquisitions_per_point` records how many acquisitions went into each point; points that got none are
+    interpolated from their neighbours.  The sweep speed is `fly_velocity` (in stage units per second) or, if that
+    is None, is chosen to give `fly_samples_per_point` acquisitions per point; either way, the stage must have a
+    `velocity` attribute (one value per axis, like SimulatedStage) for the speed to be set.  A line that is
+    interrupted by an abort is discarded.
     """
+    scan_path = 'snake'
+    scan_path_seed = None
+    pipelined = False
+    max_pending_points = 16
+    fly_scan = False
+    fly_velocity = None
+    fly_samples_per_point = 2
+    fly_position_source = 'poll'
+    fly_latency = 0.0 # the time between the middle of an exposure and the middle of the call to acquire
 
     def __init__(self):
         ScanningExperiment.__init__(self)
@@ -40,6 +89,11 @@ class GridScan(ScanningExperiment, TimedScan):
         self._unit_conversion = {'nm': 1e-9, 'um': 1e-6, 'mm': 1e-3}
         self._size_unit, self._step_unit, self._init_unit = ('um', 'um', 'um')
         self.grid_shape = (0,0)
+        self.completed = np.zeros(self.grid_shape, dtype=bool)
+        self.resume_group = None
+        self._pipeline = None
+        self._fly_acquisition_time = None
+        self.acquisitions_per_point = np.zeros(self.grid_shape, dtype=int)
         #self.init_grid(self.axes, self.size, self.step, self.init)
 
     def _update_axes(self, num_axes):
@@ -114,6 +168,18 @@ class GridScan(ScanningExperiment, TimedScan):
                                                    args=(self.axes, self.size, self.step, self.init))
         self.acquisition_thread.start()
 
+    def run_in_foreground(self):
+        """Run the grid scan in the current thread, and return when it has finished.
+
+        Errors in the scan are raised here, rather than being lost in the
+        acquisition thread.  This is how `ExperimentScheduler` runs scans.
+        """
+        if isinstance(self.acquisition_thread, threading.Thread) and self.acquisition_thread.is_alive():
+            raise RuntimeError('scan already running')
+        self.init_scan()
+        self.acquisition_thread = threading.current_thread() # so abort() waits for this thread
+        self.scan(self.axes, self.size, self.step, self.init)
+
     def init_grid(self, axes, size, step, init):
         """Create a grid on which to scan."""
         scan_axes = []
@@ -157,8 +223,201 @@ class GridScan(ScanningExperiment, TimedScan):
         self.stage.move(position/self.stage_units, axis=axis)
 
     def get_position(self, axis):
-        return self.stage.get_position(axis=axis) * self.stage_units
+        return self.stage.cached_position(axis=axis) * self.stage_units
     
+    def scan_function(self, *indices):
+        """Applied at each position in the grid scan (by default, acquires then processes and stores the data)."""
+        with self.profile_phase('acquire', *indices):
+            data = self.acquire(*indices)
+        self._process_point(data, indices)
+
+    def acquire(self, *indices):
+        """Acquire and return the data at a point (on the scan thread)."""
+        raise NotImplementedError
+
+    def process_and_store(self, data, *indices):
+        """Process and save the data from `acquire` (on a worker thread if the scan is pipelined)."""
+        raise NotImplementedError
+
+    def acquire_on_the_fly(self, *indices):
+        """Acquire and return data while the stage is moving, in a fly scan (by default, this calls `acquire`).
+
+        `indices` are those of the point nearest to the stage when the acquisition starts.
+        """
+        return self.acquire(*indices)
+
+    def profile_phase(self, phase, *indices):
+        """Return a context manager that times a phase of the step at `indices` (by default, the current point).
+
+        For example, ``with self.profile_phase('write', *indices):`` would time saving the data from a point.
+        """
+        return self.profiler.phase(phase, self._point_number(indices or getattr(self, 'indices', ())))
+
+    def _point_number(self, indices):
+        """The position of a point in the (flattened) grid, or None if the indices aren't valid."""
+        if len(indices) != len(self.grid_shape) or \
+                not all(0 <= i < n for i, n in zip(indices, self.grid_shape)):
+            return None
+        return int(np.ravel_multi_index(tuple(indices), self.grid_shape))
+
+    def _scan_point(self, *indices):
+        """Take the data at the current point."""
+        self.profiler.start_step(self._point_number(indices))
+        if self._pipeline is not None:
+            with self.profile_phase('acquire', *indices):
+                data = self.acquire(*indices)
+            self._pipeline.put(data, indices)
+        else:
+            with self.profile_phase('acquire', *indices): # phases timed by scan_function are subtracted
+                self.scan_function(*indices)
+            self.completed[indices] = True
+
+    def _process_point(self, data, indices):
+        with self.profile_phase('process', *indices):
+            self.process_and_store(data, *indices)
+        self.completed[indices] = True
+
+    def _fly_line(self, line_indices, axis, scan_axis, columns):
+        """Sweep along a line of the grid (visiting `columns` in order), and store the re-binned data."""
+        columns = list(columns)
+        first_point = tuple(line_indices) + (columns[0],)
+        if len(columns) < 2: # there's nothing to sweep over
+            with self.profile_phase('move', *first_point):
+                self.move(scan_axis[columns[0]], axis)
+            self.indices = first_point
+            self._scan_point(*first_point)
+            self._index += 1
+            return
+        first, last = scan_axis[columns[0]], scan_axis[columns[-1]]
+        half_step = (last - first) / (2.0 * (len(columns) - 1))
+        direction = np.sign(half_step)
+        velocity = self.fly_velocity
+        if velocity is None and hasattr(self.stage, 'velocity'):
+            if self._fly_acquisition_time is None: # time an acquisition, to choose the speed
+                t0 = time.time()
+                if self.fly_position_source == 'poll':
+                    self.stage.get_position(axis)
+                self.acquire_on_the_fly(*first_point)
+                self._fly_acquisition_time = time.time() - t0
+            velocity = abs(2 * half_step / self.stage_units) / \
+                (self.fly_samples_per_point * max(self._fly_acquisition_time, 1e-6))
+        if self.fly_position_source == 'trajectory' and velocity is None:
+            raise ValueError("The trajectory can only be calculated if we can set the stage's velocity.")
+        # if we know the acceleration, start far enough back to be up to speed by the first point
+        ramp_time = 0.0
+        if velocity is not None and hasattr(self.stage, 'acceleration'):
+            ramp_time = velocity / self.stage.acceleration[self.stage.axis_names.index(axis)]
+        run_up = 0.5 * velocity * ramp_time * self.stage_units if velocity is not None else 0.0
+        start, end = first - half_step - direction * run_up, last + half_step + direction * run_up
+        with self.profile_phase('move', *first_point):
+            self.move(start, axis)
+        old_velocity = None
+        if velocity is not None and hasattr(self.stage, 'velocity'):
+            old_velocity = np.array(self.stage.velocity, copy=True)
+            self.stage.velocity[self.stage.axis_names.index(axis)] = velocity
+
+        # sweep along the line in a background thread, acquiring (and reading the position) until it's done
+        times, positions, acquisition_times, acquisitions = [], [], [], []
+        sweep_times = []
+        def sweep_line():
+            sweep_times.append(time.time())
+            self.move(end, axis)
+        sweep = threading.Thread(target=sweep_line)
+        column = columns[0]
+        try:
+            sweep.start()
+            while sweep.is_alive() and not self.abort_requested:
+                if self.fly_position_source == 'poll':
+                    before = time.time()
+                    position = self.stage.get_position(axis) * self.stage_units # not .position, which may be cached
+                    times.append((before + time.time()) / 2.0)
+                    positions.append(position)
+                    column = int(np.argmin(abs(scan_axis - position)))
+                t0 = time.time()
+                data = self.acquire_on_the_fly(*(tuple(line_indices) + (column,)))
+                acquisition_times.append((t0 + time.time()) / 2.0 - self.fly_latency)
+                acquisitions.append(data)
+            sweep.join()
+            sweep_started, sweep_finished = sweep_times[0], time.time()
+        finally:
+            if old_velocity is not None:
+                self.stage.velocity[:] = old_velocity
+        self._fly_acquisition_time = (sweep_finished - sweep_started) / max(len(acquisitions), 1)
+        if self.abort_requested:
+            return
+
+        # work out where each acquisition was taken, and average them onto the points of the line
+        acquisition_times = np.array(acquisition_times)
+        if self.fly_position_source == 'poll':
+            acquisition_positions = np.interp(acquisition_times, np.concatenate([[sweep_started], times,
+                                                                                 [sweep_finished]]),
+                                              np.concatenate([[start], positions, [end]]))
+        else:
+            # accelerate uniformly up to speed (deceleration happens after the last point, so we ignore it)
+            t = acquisition_times - sweep_started
+            speed = velocity * self.stage_units
+            distance = np.where(t < ramp_time, 0.5 * speed * t**2 / max(ramp_time, 1e-12),
+                                speed * (t - ramp_time / 2.0))
+            acquisition_positions = start + direction * np.clip(distance, 0, abs(end - start))
+        if len(acquisitions) > 0 and isinstance(acquisitions[0], (list, tuple)): # e.g. from several spectrometers
+            binned = [bin_onto_axis(acquisition_positions, [a[c] for a in acquisitions], scan_axis)
+                      for c in range(len(acquisitions[0]))]
+            counts = binned[0][1]
+            point_data = lambda i: [b[0][i] for b in binned]
+        else:
+            binned, counts = bin_onto_axis(acquisition_positions, acquisitions, scan_axis) if acquisitions \
+                else (np.full(len(scan_axis), np.nan), np.zeros(len(scan_axis), dtype=int))
+            point_data = lambda i: binned[i]
+        self.acquisitions_per_point[tuple(line_indices)] = counts
+
+        # the time spent sweeping is shared between the points of the line
+        step_time = (sweep_finished - sweep_started) / len(columns)
+        for n, i in enumerate(columns):
+            indices = tuple(line_indices) + (i,)
+            if self.completed[indices]:
+                continue
+            self.indices = indices
+            point = self._point_number(indices)
+            self.profiler.start_step(point, sweep_started + n * step_time)
+            self.profiler.add('acquire', point, step_time)
+            if self._pipeline is not None:
+                self._pipeline.put(point_data(i), indices)
+            else:
+                self._process_point(point_data(i), indices)
+            self._step_times[indices] = time.time()
+            self._index += 1
+
+    def scan_parameters(self):
+        """Return a dictionary of the parameters needed to repeat (or resume) the current scan."""
+        return dict(axes=[str(ax) for ax in self.axes], axes_names=[str(name) for name in self.axes_names],
+                    size=self.size, step=self.step, init=self.init,
+                    size_unit=self.size_unit, step_unit=self.step_unit, init_unit=self.init_unit,
+                    stage_units=self.stage_units, grid_shape=self.grid_shape,
+                    scan_path=str(self.scan_path) if np.ndim(self.scan_path) == 0 else 'list')
+
+    def resume(self, scan_group):
+        """Carry on with an unfinished scan that was saved to `scan_group`, skipping the points already done.
+
+        The scan's parameters are read from the attributes of the group, and the scan is run as usual, except
+        that `open_scan` should reopen the group (`resume_group`) rather than starting a new one.
+        """
+        def as_str(value):
+            return value.decode() if isinstance(value, bytes) else str(value)
+        attrs = scan_group.attrs
+        self.num_axes = len(attrs['axes'])
+        self.axes = [as_str(ax) for ax in attrs['axes']]
+        self.axes_names = [as_str(name) for name in attrs['axes_names']]
+        # set the units directly, as setting the properties would rescale the parameters
+        self._size_unit, self._step_unit, self._init_unit = [as_str(attrs[unit])
+                                                              for unit in ('size_unit', 'step_unit', 'init_unit')]
+        self.size, self.step, self.init = [np.array(attrs[param], dtype=np.float64)
+                                           for param in ('size', 'step', 'init')]
+        self.stage_units = attrs['stage_units']
+        if as_str(attrs.get('scan_path', 'list')) != 'list': # a list of points isn't saved, so keep the current one
+            self.scan_path = as_str(attrs['scan_path'])
+        self.resume_group = scan_group
+        self.run()
+
     def outer_loop_start(self):
         """This function is called before the scan happens, for each value of the outermost variable (usually Z)"""
         pass
@@ -177,61 +436,137 @@ class GridScan(ScanningExperiment, TimedScan):
         axes, size, step, init = (axes[::-1], size[::-1], step[::-1], init[::-1])
         scan_axes = self.init_grid(axes, size, step, init)
         print scan_axes
-        self.open_scan()
-        # get the indices of points along each of the scan axes for use with snaking over array
-        pnts = [range(axis.size) for axis in scan_axes]
-
-        self.indices = [-1,] * len(axes)
-        self._index = 0
+        self.completed = np.zeros(self.grid_shape, dtype=bool)
+        try:
+            self.open_scan() # if we're resuming a scan, this loads the completed points
+        finally:
+            self.resume_group = None
+        self.indices = (-1,) * len(axes)
+        self._index = int(np.sum(self.completed))
+        self.acquisitions_per_point = np.zeros(self.grid_shape, dtype=int)
+        self._fly_acquisition_time = None
         self._step_times = np.zeros(self.grid_shape)
         self._step_times.fill(np.nan)
+        self.profiler.reset(self.total_points)
         self.status = 'acquiring data'
+        self._pipeline = None
+        if self.pipelined:
+            self._pipeline = OrderedWorker(self._process_point, self.max_pending_points,
+                                           name=self.__class__.__name__ + " processing")
+            self._pipeline.start()
+        try:
+            self._scan_grid(axes, scan_axes)
+            # move back to initial positions
+            for i in range(len(axes)):
+                self.move(init[i]*self._unit_conversion[self._init_unit], axes[i])
+        finally:
+            if self._pipeline is not None:
+                self.status = 'processing data'
+                pipeline, self._pipeline = self._pipeline, None
+                pipeline.finish()
+        # finish the scan
+        self.analyse_scan()
+        self.close_scan()
+        self.status = 'scan complete'
+
+    def path_indices(self):
+        """Return the grid indices of the points of the scan, in the order they'll be visited (n_points x n_axes).
+
+        This is set by `scan_path`.
+        """
+        if np.ndim(self.scan_path) == 0: # the name of a kind of path
+            indices = path_planning.grid_path_indices(self.grid_shape, self.scan_path, self.scan_path_seed)
+            if self.scan_path == 'snake':
+                # GridScan has always started the lines (and layers) backwards
+                indices[:, 1:] = np.array(self.grid_shape[1:]) - 1 - indices[:, 1:]
+            return indices
+        indices = np.asarray(self.scan_path)
+        if indices.ndim != 2 or indices.shape[1] != len(self.grid_shape) or \
+                not np.issubdtype(indices.dtype, np.integer):
+            raise ValueError('scan_path must be one of {0}, or an (n_points x n_axes) array of grid indices'.format(
+                path_planning.PATH_KINDS))
+        if np.any(indices < 0) or np.any(indices >= np.array(self.grid_shape)):
+            raise ValueError('scan_path includes points outside the grid')
+        return indices
+
+    def _scan_grid(self, axes, scan_axes):
+        """Visit each point in the grid (the inner part of scan)."""
         self.acquiring.set()
         scan_start_time = time.time()
-        for k in pnts[0]:  # outer most axis
-            self.indices = list(self.indices)
-            self.indices[0] = k # Make sure indices is always up-to-date, for the drift compensation
+        if self.fly_scan:
+            self._fly_lines(axes, scan_axes)
+        else:
+            self._visit_points(axes, scan_axes, self.path_indices())
+        self.print_scan_time(time.time() - scan_start_time)
+        self.acquiring.clear()
+
+    def _visit_points(self, axes, scan_axes, points, call_loop_hooks=True):
+        """Visit each of a list of points (grid indices, n_points x n_axes) that isn't completed, and scan it.
+
+        If `call_loop_hooks` is True, `outer_loop_start` etc. are called whenever the point's outermost (or, for
+        3D grids, middle) index changes.
+        """
+        points = np.asarray(points, dtype=int).reshape(-1, len(axes))
+        previous = (-1,) * len(axes)
+        for indices in map(tuple, points[~self.completed[tuple(points.T)]].tolist()):
             if self.abort_requested:
                 break
-            self.outer_loop_start()
-            self.status = 'Scanning layer {0:d}/{1:d}'.format(k + 1, len(pnts[0]))
-            self.move(scan_axes[0][k], axes[0])
-            pnts[1] = pnts[1][::-1]  # reverse which way is iterated over each time
-            for j in pnts[1]:
-                if self.abort_requested:
-                    break
-                self.move(scan_axes[1][j], axes[1])
-                self.indices = list(self.indices)
-                self.indices[1] = j
-                if len(axes) == 3:  # for 3d grid (volume) scans
-                    self.middle_loop_start()
-                    pnts[2] = pnts[2][::-1]  # reverse which way is iterated over each time
-                    for i in pnts[2]:
-                        if self.abort_requested:
-                            break
-                        self.move(scan_axes[2][i], axes[2])
-                        self.indices[2] = i # These two lines are redundant.  TODO: pick one...
-                        #self.indices = (k, j, i) # keeping it as a list allows index assignment
-                        self.scan_function(k, j, i)
-                        self._step_times[k,j,i] = time.time()
-                        self._index += 1
-                    self.middle_loop_end()
-                elif len(axes) == 2:  # for regular 2d grid scans ignore third axis i
-                    self.indices = (k, j)
-                    self.scan_function(k, j)
-                    self._step_times[k,j] = time.time()
-                    self._index += 1
+            self.indices = indices # set before the hooks, for the drift compensation
+            if call_loop_hooks:
+                self._call_loop_hooks(indices, previous)
+            # only move the axes that change
+            with self.profile_phase('move', *indices):
+                for axis, axis_values, i, j in zip(axes, scan_axes, indices, previous):
+                    if i != j:
+                        self.move(axis_values[i], axis)
+            self._scan_point(*indices)
+            self._step_times[indices] = time.time()
+            self._index += 1
+            previous = indices
+        if call_loop_hooks:
+            self._call_loop_hooks(None, previous)
+
+    def _call_loop_hooks(self, indices, previous):
+        """Call the hooks for the layers and lines of the grid we're leaving and entering (None means neither)."""
+        middle = len(self.grid_shape) == 3
+        new_layer = previous[0] >= 0 and (indices is None or indices[0] != previous[0])
+        new_line = middle and previous[0] >= 0 and (indices is None or indices[:2] != previous[:2])
+        if new_line:
+            self.middle_loop_end()
+        if new_layer:
             self.outer_loop_end()
-
-        self.print_scan_time(time.time() - scan_start_time)
-        self.acquiring.clear()
-        # move back to initial positions
-        for i in range(len(axes)):
-            self.move(init[i]*self._unit_conversion[self._init_unit], axes[i])
-        # finish the scan
-        self.analyse_scan()
-        self.close_scan()
-        self.status = 'scan complete'
+        if indices is None:
+            return
+        if indices[0] != previous[0]:
+            self.outer_loop_start()
+            self.status = 'Scanning layer {0:d}/{1:d}'.format(indices[0] + 1, self.grid_shape[0])
+        if middle and indices[:2] != previous[:2]:
+            self.middle_loop_start()
+
+    def _fly_lines(self, axes, scan_axes):
+        """Sweep along each line of the grid (along the innermost axis), in snake order."""
+        if np.ndim(self.scan_path) != 0 or self.scan_path != 'snake':
+            raise ValueError('fly scans sweep along the lines of the grid, so scan_path must be snake')
+        columns = np.arange(self.grid_shape[-1])
+        lines = path_planning.grid_path_indices(self.grid_shape[:-1], 'snake')
+        lines[:, 1:] = np.array(self.grid_shape[1:-1]) - 1 - lines[:, 1:] # as in path_indices
+        previous = (-1,) * len(axes)
+        for n, line in enumerate(map(tuple, lines.tolist())):
+            if self.abort_requested:
+                break
+            if np.all(self.completed[line]):
+                continue
+            # reverse which way the line is swept each time (starting backwards, like the stepped scan)
+            line_columns = columns[::-1] if n % 2 == 0 else columns
+            self.indices = line + (int(line_columns[0]),)
+            self._call_loop_hooks(self.indices, previous)
+            with self.profile_phase('move'):
+                for axis, axis_values, i, j in zip(axes[:-1], scan_axes[:-1], line, previous):
+                    if i != j:
+                        self.move(axis_values[i], axis)
+            self._fly_line(line, axes[-1], scan_axes[-1], line_columns)
+            previous = line + (-1,)
+        self._call_loop_hooks(None, previous)
 
     def vary_axes(self, name, multiplier=2.):
         if 'increase_size' in name:
@@ -263,12 +598,18 @@ class GridScanQt(GridScan, QtCore.QObject):
     total_points_updated = QtCore.Signal(int)
     status_updated = QtCore.Signal(str)
     timing_updated = QtCore.Signal(str)
+    profile_updated = QtCore.Signal(str)
 
     def __init__(self):
         GridScan.__init__(self)
         QtCore.QObject.__init__(self)
         self.timer = QtCore.QTimer()
-        self.timer.timeout.connect(self.update)
+        self.timer.timeout.connect(self._timed_update)
+
+    def _timed_update(self):
+        """Update the GUI, timing it as part of the current point."""
+        with self.profile_phase('gui'):
+            self.update()
 
     def run(self, rate=0.1):
         super(GridScanQt, self).run()
@@ -306,6 +647,7 @@ class GridScanQt(GridScan, QtCore.QObject):
             self.timer.stop()
         self.timing_updated.emit(self.get_formatted_estimated_time_remaining())
         self.status_updated.emit('')
+        self.profile_updated.emit(self.profiler.format_summary())
 
     def rescale_parameter(self, param, value):
         """
@@ -392,6 +734,13 @@ class GridScanUI(QtWidgets.QWidget, UiTools):
         self.abort_button.clicked.connect(self.grid_scanner.abort)
         self.grid_scanner.status_updated.connect(self.update_status)
         self.grid_scanner.timing_updated.connect(self.update_timing)
+        # a live breakdown of the time spent on each phase of the scan steps
+        self.step_profile = QtWidgets.QLabel(self.grid_scanner.profiler.format_summary())
+        font = QtGui.QFont('Monospace')
+        font.setStyleHint(QtGui.QFont.TypeWriter)
+        self.step_profile.setFont(font)
+        QtWidgets.QWidget.layout(self).addWidget(self.step_profile)
+        self.grid_scanner.profile_updated.connect(self.step_profile.setText)
 
         self.num_axes.setText(str(self.grid_scanner.num_axes))
         self.status.setText(self.grid_scanner.status)
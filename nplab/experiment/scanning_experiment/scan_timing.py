@@ -22,7 +22,10 @@ class TimedScan(object):
         return self.format_time(estimated_time)
 
     def get_estimated_time_remaining(self):
-        """Estimate the time remaining of the current scan."""
+        """Estimate the time remaining of the current scan, from the rate at which recent points were scanned."""
+        profiler = getattr(self, 'profiler', None)
+        if profiler is not None and profiler.steps_started > 1:
+            return profiler.estimated_time_remaining(self.total_points - self._index)
         if not hasattr(self, '_step_times'):
             return np.inf
         mask = np.isfinite(self._step_times)
@@ -5,7 +5,8 @@ of scanning experiments and adding supporting for utilising HDF5 files for data
 __author__ = 'alansanders'
 
 from nplab.experiment.experiment import ExperimentWithDataDeque
-from threading import Thread
+from nplab.experiment.scanning_experiment.step_profiler import StepProfiler
+from threading import Thread, current_thread
 import time
 from nplab import datafile
 
@@ -13,12 +14,15 @@ from nplab import datafile
 class ScanningExperiment(ExperimentWithDataDeque):
     """
     This class defines the core methods required for a threaded scanning experiment.
+
+    `profiler` is a StepProfiler, which records how long each phase of each step of the scan takes.
     """
     def __init__(self):
         super(ScanningExperiment, self).__init__()
         self.status = 'inactive'
         self.abort_requested = False
         self.acquisition_thread = None
+        self.profiler = StepProfiler()
 
     def run(self):
         """
@@ -33,6 +37,12 @@ class ScanningExperiment(ExperimentWithDataDeque):
         self.acquisition_thread = Thread(target=self.scan, args=())
         self.acquisition_thread.start()
         
+    def run_in_foreground(self, *args, **kwargs):
+        """Run the scan, and return when it has finished (used by `ExperimentScheduler`)."""
+        self.run(*args, **kwargs)
+        if isinstance(self.acquisition_thread, Thread) and self.acquisition_thread is not current_thread():
+            self.acquisition_thread.join()
+
     def abort(self):
         """Requests an abort of the currently running grid scan."""
         if not hasattr(self, 'acquisition_thread'):
@@ -113,6 +123,12 @@ class ScanningExperimentHDF5(ScanningExperiment):
         self.data = None
         self.description = ''
 
+    def close_scan(self):
+        """Saves the step profile with the scan data (if the scan has a data group), then closes the scan."""
+        if isinstance(self.data, datafile.Group):
+            self.profiler.save(self.data)
+        super(ScanningExperimentHDF5, self).close_scan()
+
     def __del__(self):
         if isinstance(self.f, datafile.DataFile):
             self.f.close()
\ No newline at end of file
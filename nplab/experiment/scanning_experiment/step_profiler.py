@@ -0,0 +1,123 @@
+"""
+Step Profiling
+==============
+
+`StepProfiler` records how long each phase of each step of a scan takes -
+moving, settling, acquiring, processing, writing and updating the GUI - so
+that it's clear where the time goes, and how long the rest of the scan will
+take.  Durations are kept in a compact structured array (one record per
+point, a float32 per phase) that can be saved alongside the data.
+
+Phases are timed with the `phase` context manager.  Phases can be nested
+(on the same thread): time spent in an inner phase is not counted towards
+the outer one, so the phases of a step add up to the time it took.
+"""
+
+import time
+import threading
+from contextlib import contextmanager
+import numpy as np
+
+PHASES = ('move', 'settle', 'acquire', 'process', 'write', 'gui')
+
+
+class StepProfiler(object):
+    """Record the time taken by each phase of each step of a scan.
+
+    Arguments:
+    phases : sequence of str
+        The names of the phases to record.
+
+    `steps` is a structured array with one record per point: 'start' is
+    the time (in seconds since `reset`) at which the point was started, and
+    there is a field for the time spent in each phase.  Points that haven't
+    been reached (and phases that weren't timed) are NaN.
+    """
+    def __init__(self, phases=PHASES):
+        self.phases = tuple(phases)
+        self.dtype = np.dtype([('start', np.float64)] + [(phase, np.float32) for phase in self.phases])
+        self._local = threading.local()
+        self.reset(0)
+
+    def reset(self, n_points):
+        """Clear the profile, ready for a scan of `n_points` points."""
+        steps = np.zeros(n_points, dtype=self.dtype)
+        for name in self.dtype.names:
+            steps[name] = np.nan
+        self.steps = steps
+        self.start_time = time.time()
+
+    def start_step(self, point, t=None):
+        """Record the time (by default, now) at which a point was started."""
+        if point is not None and 0 <= point < len(self.steps):
+            self.steps['start'][point] = (time.time() if t is None else t) - self.start_time
+
+    def add(self, phase, point, duration):
+        """Add `duration` seconds to the time spent on `phase` at `point` (which may be None)."""
+        if point is None or not 0 <= point < len(self.steps):
+            return
+        previous = self.steps[phase][point]
+        self.steps[phase][point] = duration if np.isnan(previous) else previous + duration
+
+    @contextmanager
+    def phase(self, phase, point):
+        """Time the code in a ``with`` block as part of `phase` at `point`."""
+        stack = getattr(self._local, 'stack', None)
+        if stack is None:
+            stack = self._local.stack = []
+        stack.append(0.0)  # time spent in nested phases
+        t0 = time.time()
+        try:
+            yield
+        finally:
+            elapsed = time.time() - t0
+            nested = stack.pop()
+            if stack:
+                stack[-1] += elapsed
+            self.add(phase, point, elapsed - nested)
+
+    @property
+    def steps_started(self):
+        """The number of points that have been started."""
+        return int(np.sum(np.isfinite(self.steps['start'])))
+
+    def step_interval(self, window=50):
+        """The median time between the starts of the last `window` points (NaN if unknown)."""
+        starts = np.sort(self.steps['start'][np.isfinite(self.steps['start'])])
+        if len(starts) < 2:
+            return np.nan
+        return float(np.median(np.diff(starts[-window - 1:])))
+
+    def estimated_time_remaining(self, n_remaining, window=50):
+        """Estimate how long the next `n_remaining` points will take, from recent points."""
+        return n_remaining * self.step_interval(window)
+
+    def summary(self):
+        """Return a dict of (median, 90th percentile, total) time for each phase that was timed."""
+        summary = {}
+        for phase in self.phases:
+            durations = self.steps[phase][np.isfinite(self.steps[phase])]
+            if len(durations) > 0:
+                summary[phase] = (float(np.median(durations)), float(np.percentile(durations, 90)),
+                                  float(np.sum(durations, dtype=np.float64)))
+        return summary
+
+    def format_summary(self):
+        """Return a table of the median and 90th percentile time per point, and share of the total, per phase."""
+        summary = self.summary()
+        if not summary:
+            return 'no steps timed'
+        total = sum(s[2] for s in summary.values())
+        lines = ['{0:<8} {1:>9} {2:>9} {3:>5}'.format('phase', 'median', '90%', 'share')]
+        for phase in self.phases:
+            if phase in summary:
+                median, p90, phase_total = summary[phase]
+                lines.append('{0:<8} {1:>6.1f} ms {2:>6.1f} ms {3:>4.0f}%'.format(
+                    phase, 1e3 * median, 1e3 * p90, 100 * phase_total / total if total > 0 else 0))
+        return '\n'.join(lines)
+
+    def save(self, group, name='step_profile'):
+        """Save the profile as a dataset in an HDF5 group."""
+        return group.create_dataset(name, data=self.steps,
+                                    attrs=dict(phases=[str(p) for p in self.phases],
+                                               start_time=self.start_time))
@@ -0,0 +1,313 @@
+"""
+Experiment Scheduler
+====================
+
+`ExperimentScheduler` keeps a queue of experiment runs - an `Experiment`,
+the arguments to run it with, and the instruments it needs - and works
+through it in the background, so a night's worth of scans can be queued up
+and left.  Runs that need none of the same instruments (say, DLS on the
+Adlink card and a mosaic that only uses the camera) run at the same time;
+a run waits while any of its instruments are in use.
+
+Higher-priority runs go first.  A run that is waiting for an instrument
+reserves it, so runs of lower priority can use the other instruments in the
+meantime, but can't keep the one it's waiting for busy indefinitely.
+
+Pausing the scheduler stops it from starting any more runs (the ones that
+have started carry on), and resuming it carries on through the queue.  The
+outcome of each run - whether it finished, failed or was stopped, when, and
+any error - is recorded as a group in the data file.
+"""
+import datetime
+import itertools
+import threading
+import time
+import traceback
+import nplab.datafile
+from nplab.experiment.experiment import ExperimentStopped
+
+QUEUED, RUNNING, FINISHED, FAILED, STOPPED, CANCELLED = \
+    'queued', 'running', 'finished', 'failed', 'stopped', 'cancelled'
+
+
+class ScheduledRun(object):
+    """A request to run an experiment, and its outcome.
+
+    These are created by `ExperimentScheduler.submit`.  `status` is one of
+    'queued', 'running', 'finished', 'failed' (in which case `error` and
+    `traceback` say why), 'stopped' or 'cancelled'.  `submitted`, `started`
+    and `finished` are times, as from ``time.time()``, or None.
+    """
+    def __init__(self, experiment, args, kwargs, instruments, priority, name, number):
+        self.experiment = experiment
+        self.args = tuple(args)
+        self.kwargs = dict(kwargs)
+        self.instruments = list(instruments)
+        self.priority = priority
+        self.name = name
+        self.number = number
+        self.status = QUEUED
+        self.submitted = time.time()
+        self.started = None
+        self.finished = None
+        self.error = None
+        self.traceback = None
+        self.result = None
+        self.record = None # the group in the data file where the outcome is recorded
+        self.stop_requested = False
+        self.thread = None
+        self._done = threading.Event()
+
+    def __repr__(self):
+        return '<ScheduledRun {0} ({1})>'.format(self.name, self.status)
+
+    @property
+    def resources(self):
+        """The objects this run has to itself: its instruments, and the experiment."""
+        return [self.experiment] + self.instruments
+
+    @property
+    def done(self):
+        """Whether the run has finished (successfully or not), or been cancelled."""
+        return self._done.is_set()
+
+    @property
+    def duration(self):
+        """How long the run took (or has taken so far) in seconds, or None if it hasn't started."""
+        if self.started is None:
+            return None
+        return (self.finished if self.finished is not None else time.time()) - self.started
+
+    def wait(self, timeout=None):
+        """Wait until the run is done, and return its status."""
+        self._done.wait(timeout)
+        return self.status
+
+
+class ExperimentScheduler(object):
+    """Run a queue of experiments, in parallel where they don't share instruments.
+
+    Arguments:
+    max_concurrent : int, optional
+        The most runs that may happen at once (by default, there is no limit
+        other than the instruments).
+    record_group : nplab.datafile.Group, optional
+        Where to record the outcome of each run.  By default, this is the
+        'ExperimentScheduler' group of the current data file.  If it is
+        False, nothing is recorded.
+
+    Experiments are run with their `run_in_foreground` method, in a thread
+    for each run, after calling their `prepare_to_run` method in the same
+    thread.  Runs are stopped with `Experiment.stop`, or by setting
+    `abort_requested` for scans.
+    """
+    def __init__(self, max_concurrent=None, record_group=None):
+        self.max_concurrent = max_concurrent
+        self.record_group = record_group
+        self.runs = [] # every run that has been submitted, in order
+        self._queue = []
+        self._running = []
+        self._paused = False
+        self._condition = threading.Condition(threading.RLock())
+        self._record_lock = threading.Lock()
+        self._numbers = itertools.count()
+
+    def submit(self, experiment, args=(), kwargs=None, instruments=None, priority=0, name=None):
+        """Add a run of an experiment to the queue, and return it (as a `ScheduledRun`).
+
+        Arguments:
+        experiment : Experiment
+            The experiment to run.  The same experiment may be queued several
+            times (e.g. with different arguments), but will only run once at a
+            time.
+        args, kwargs : tuple, dict, optional
+            The arguments to pass to the experiment's `run` method.
+        instruments : list of Instrument, optional
+            The instruments that no other run may use while this one runs.  By
+            default, these are the experiment's `required_instruments()`.
+        priority : number, optional
+            Runs with higher priorities are started first; runs with the same
+            priority are started in the order they were submitted.
+        name : str, optional
+            A name for the run, used in its record (by default, the name of
+            the experiment's class and the number of the run).
+        """
+        if instruments is None:
+            instruments = experiment.required_instruments()
+        number = next(self._numbers)
+        if name is None:
+            name = '{0}_{1:d}'.format(type(experiment).__name__, number)
+        run = ScheduledRun(experiment, args, kwargs or {}, instruments, priority, name, number)
+        with self._condition:
+            self.runs.append(run)
+            self._queue.append(run)
+            self._dispatch()
+        return run
+
+    @property
+    def queued(self):
+        """The runs waiting to start, in the order they would be started if nothing was busy."""
+        with self._condition:
+            return sorted(self._queue, key=self._queue_order)
+
+    @property
+    def running(self):
+        """The runs that are in progress."""
+        with self._condition:
+            return list(self._running)
+
+    @property
+    def paused(self):
+        """Whether the scheduler has been paused (see `pause`)."""
+        return self._paused
+
+    def pause(self):
+        """Stop starting new runs.  Runs that have already started carry on."""
+        with self._condition:
+            self._paused = True
+
+    def resume(self):
+        """Start working through the queue again after `pause`."""
+        with self._condition:
+            self._paused = False
+            self._dispatch()
+
+    def cancel(self, run):
+        """Remove a run from the queue, if it hasn't started yet.  Returns True if it was cancelled."""
+        with self._condition:
+            if run not in self._queue:
+                return False
+            self._queue.remove(run)
+            run.status = CANCELLED
+            self._condition.notify_all()
+        self._record(run)
+        run._done.set()
+        return True
+
+    def stop(self, run=None, cancel_queued=True):
+        """Stop a run if it's in progress (or cancel it if it's queued).
+
+        If `run` is None, every run in progress is stopped, and (if
+        `cancel_queued` is True) the queue is emptied; otherwise, the
+        scheduler is paused, so the queue is kept for later.
+        """
+        if run is not None:
+            if not self.cancel(run):
+                self._stop_run(run)
+            return
+        with self._condition:
+            if cancel_queued:
+                queued = list(self._queue)
+            else:
+                queued = []
+                self._paused = True
+            running = list(self._running)
+        for r in queued:
+            self.cancel(r)
+        for r in running:
+            self._stop_run(r)
+
+    def wait(self, timeout=None):
+        """Wait until nothing is running, and nothing more will start.  Returns False if it timed out.
+
+        If the scheduler is paused, this waits only for the runs in progress.
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        with self._condition:
+            while self._running or (self._queue and not self._paused):
+                remaining = None if deadline is None else deadline - time.time()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._condition.wait(remaining)
+            return True
+
+    @staticmethod
+    def _queue_order(run):
+        return (-run.priority, run.number)
+
+    def _dispatch(self):
+        """Start any queued runs whose instruments are free (call with the condition held)."""
+        if self._paused:
+            return
+        busy = set(id(r) for run in self._running for r in run.resources)
+        reserved = set() # instruments that higher-priority runs are waiting for
+        for run in sorted(self._queue, key=self._queue_order):
+            if self.max_concurrent is not None and len(self._running) >= self.max_concurrent:
+                break
+            resources = set(id(r) for r in run.resources)
+            if resources & (busy | reserved):
+                reserved |= resources
+                continue
+            busy |= resources
+            self._start_run(run)
+
+    def _start_run(self, run):
+        self._queue.remove(run)
+        self._running.append(run)
+        run.status = RUNNING
+        run.started = time.time()
+        run.thread = threading.Thread(target=self._execute, args=(run,), name='ExperimentScheduler ' + run.name)
+        run.thread.start()
+
+    def _execute(self, run):
+        """Run an experiment (in the run's thread), then record what happened and start the next runs."""
+        self._record(run)
+        experiment = run.experiment
+        try:
+            experiment.prepare_to_run(*run.args, **run.kwargs)
+            if not run.stop_requested:
+                run.result = experiment.run_in_foreground(*run.args, **run.kwargs)
+            run.status = STOPPED if run.stop_requested else FINISHED
+        except ExperimentStopped:
+            run.status = STOPPED
+        except Exception as e:
+            run.status = FAILED
+            run.error = '{0}: {1}'.format(type(e).__name__, e)
+            run.traceback = traceback.format_exc()
+            print('Scheduled run {0} failed:\n{1}'.format(run.name, run.traceback))
+        finally:
+            run.finished = time.time()
+            self._record(run)
+            with self._condition:
+                self._running.remove(run)
+                run._done.set()
+                self._dispatch()
+                self._condition.notify_all()
+
+    def _stop_run(self, run):
+        if run.status != RUNNING:
+            return
+        run.stop_requested = True
+        experiment = run.experiment
+        if hasattr(experiment, 'abort_requested'): # scans are stopped with a flag, rather than stop()
+            experiment.abort_requested = True
+        else:
+            experiment.stop()
+
+    def _record(self, run):
+        """Save (or update) the record of a run in the data file."""
+        if self.record_group is False:
+            return
+        with self._record_lock:
+            try:
+                if self.record_group is None:
+                    self.record_group = nplab.datafile.current().require_group('ExperimentScheduler')
+                if run.record is None:
+                    run.record = self.record_group.create_group('run_%d')
+                attrs = dict(name=run.name, experiment=type(run.experiment).__name__,
+                             status=run.status, priority=run.priority,
+                             instruments=[type(i).__name__ for i in run.instruments] or '',
+                             args=repr(run.args), kwargs=repr(run.kwargs),
+                             submitted=_isoformat(run.submitted), started=_isoformat(run.started),
+                             finished=_isoformat(run.finished), duration=run.duration,
+                             error=run.error, traceback=run.traceback,
+                             log_messages=getattr(run.experiment, 'log_messages', None) or None)
+                nplab.datafile.attributes_from_dict(run.record, attrs)
+                run.record.file.flush()
+            except Exception as e:
+                # not being able to save the record shouldn't stop the queue
+                print('Could not record scheduled run {0}: {1}'.format(run.name, e))
+
+
+def _isoformat(t):
+    return None if t is None else datetime.datetime.fromtimestamp(t).isoformat()
@@ -5,11 +5,13 @@ from nplab.utils.notified_property import NotifiedProperty
 from nplab.utils.thread_utils import background_action, locked_action
 import nplab.datafile as df
 from nplab.utils.array_with_attrs import ArrayWithAttrs
+from nplab.utils.frame_buffer import FrameRingBuffer, FrameSpooler
 from nplab.utils.notified_property import register_for_property_changes
 
 import os
 import platform
 import time
+import threading
 from ctypes import *
 import numpy as np
 import pyqtgraph
@@ -391,26 +393,17 @@ class AndorBase:
         self.CoolerON()
         #      self.GetAllParameters()
 
-    # @background_action
-    @locked_action
-    def capture(self):
-        """Capture function for Andor
+    def get_acquisition_shape(self):
+        """Return the number of images an acquisition will produce, and the shape of each image
 
-        Wraps the three steps required for a camera acquisition: StartAcquisition, WaitForAcquisition and
-        GetAcquiredData. The function also takes care of ensuring that the correct shape of array is passed to the
-        GetAcquiredData call, according to the currently set parameters of the camera.
+        This depends on the currently set AcquisitionMode, ReadMode, binning and cropping parameters.
 
         Returns
         -------
-        A numpy array containing the captured image(s)
         The number of images taken
         The shape of the images taken
 
         """
-        self._dllWrapper('StartAcquisition')
-        self._dllWrapper('WaitForAcquisition')
-        self.WaitForDriver()
-
         if self.parameters['AcquisitionMode']['value'] == 4:
             num_of_images = 1  # self.parameters['FastKinetics']['value'][1]
             image_shape = (self.parameters['FastKinetics']['value'][-1], self.parameters['DetectorShape']['value'][0])
@@ -448,27 +441,118 @@ class AndorBase:
                         self.parameters['Image']['value'][0],)
             else:
                 raise NotImplementedError('Read Mode %g' % self.parameters['ReadMode']['value'])
+        return int(num_of_images), tuple(int(s) for s in image_shape)
+
+    # @background_action
+    @locked_action
+    def capture(self, out=None):
+        """Capture function for Andor
 
-        dim = num_of_images * np.prod(image_shape)
-        cimageArray = c_int * dim
-        cimage = cimageArray()
+        Wraps the three steps required for a camera acquisition: StartAcquisition, WaitForAcquisition and
+        GetAcquiredData. The function also takes care of ensuring that the correct shape of array is passed to the
+        GetAcquiredData call, according to the currently set parameters of the camera.
+
+        The data are read by the dll straight into a numpy array (no copying), which is returned with shape
+        (number of images,) + image shape.
+
+        Parameters
+        ----------
+        out     optional, a C-contiguous numpy array of dtype np.intc with the right number of elements, which the
+                data are read into.  Passing the same array repeatedly avoids allocating memory for every frame (e.g.
+                for kinetic series) but note that each capture then overwrites the previous one.
+
+        Returns
+        -------
+        A numpy array containing the captured image(s)
+        The number of images taken
+        The shape of the images taken
+
+        """
+        self._dllWrapper('StartAcquisition')
+        self._dllWrapper('WaitForAcquisition')
+        self.WaitForDriver()
+
+        num_of_images, image_shape = self.get_acquisition_shape()
+        shape = (num_of_images,) + image_shape
+        dim = int(np.prod(shape))
+        if out is None:
+            out = np.empty(shape, dtype=np.intc)
+        elif out.dtype != np.intc or out.size != dim or not out.flags['C_CONTIGUOUS']:
+            raise ValueError('The output buffer must be a C-contiguous array of %i elements of dtype %s'
+                             % (dim, np.dtype(np.intc)))
+        imageArray = out.reshape(shape)  # a view, so the dll writes into out
+        cimage = np.ctypeslib.as_ctypes(imageArray.reshape(-1))
         if '_logger' in self.__dict__:
             self._logger.debug('Getting AcquiredData for %i images with dimension %s' % (num_of_images, image_shape))
         try:
             self._dllWrapper('GetAcquiredData', inputs=({'type': c_int, 'value': dim},), outputs=(cimage,),
                              reverse=True)
-            imageArray = []
-            for i in range(len(cimage)):
-                imageArray.append(cimage[i])
         except RuntimeWarning as e:
             if '_logger' in self.__dict__:
                 self._logger.warn('Had a RuntimeWarning: %s' % e)
-            imageArray = []
-            for i in range(len(cimage)):
-                imageArray.append(0)
+            imageArray.fill(0)
 
         return imageArray, num_of_images, image_shape
 
+    def stream_acquisition(self, ring_buffer, n_frames=None, timeout=10):
+        """Run a kinetic series, copying each image into a FrameRingBuffer as soon as it is ready
+
+        Unlike capture, which waits for the whole series and then reads all the images at once, this reads the
+        images one at a time (using GetNumberNewImages and GetOldestImage) while the acquisition is running, so
+        memory use is set by the size of the ring buffer rather than the length of the series.  Each image is read
+        by the dll straight into the next slot of the ring buffer.
+
+        Parameters
+        ----------
+        ring_buffer     a nplab.utils.frame_buffer.FrameRingBuffer, with frames of dtype np.intc and the shape
+                        given by get_acquisition_shape
+        n_frames        number of images to acquire (defaults to NKin)
+        timeout         maximum time (in seconds) to wait for each image
+
+        Returns
+        -------
+        The number of images read, which is less than n_frames if the acquisition was aborted
+
+        """
+        if self.parameters['AcquisitionMode']['value'] != 3:
+            raise ValueError('Streaming only works in Kinetic mode (AcquisitionMode 3)')
+        num_of_images, image_shape = self.get_acquisition_shape()
+        if n_frames is None:
+            n_frames = num_of_images
+        if ring_buffer.frame_shape != image_shape or ring_buffer.dtype != np.intc:
+            raise ValueError('The ring buffer must hold frames of shape %s and dtype %s'
+                             % (image_shape, np.dtype(np.intc)))
+        frame_size = int(np.prod(image_shape))
+
+        self._dllWrapper('StartAcquisition')
+        frames_read = 0
+        try:
+            while frames_read < n_frames:
+                wait_error = self.dll.WaitForAcquisitionTimeOut(c_int(int(timeout * 1000)))
+                if ERROR_CODE[wait_error] not in ['DRV_SUCCESS', 'DRV_NO_NEW_DATA']:
+                    raise AndorWarning(wait_error, 'WaitForAcquisitionTimeOut', ERROR_CODE[wait_error])
+                first, last = c_long(), c_long()
+                error = self.dll.GetNumberNewImages(byref(first), byref(last))
+                if ERROR_CODE[error] == 'DRV_SUCCESS':
+                    for i in range(min(last.value - first.value + 1, n_frames - frames_read)):
+                        cimage = np.ctypeslib.as_ctypes(ring_buffer.writable_frame().reshape(-1))
+                        self._dllWrapper('GetOldestImage', inputs=({'type': c_ulong, 'value': frame_size},),
+                                         outputs=(cimage,), reverse=True)
+                        ring_buffer.commit_frame()
+                        frames_read += 1
+                elif ERROR_CODE[error] != 'DRV_NO_NEW_DATA':
+                    raise AndorWarning(error, 'GetNumberNewImages', ERROR_CODE[error])
+                elif self.GetStatus() != 'DRV_ACQUIRING':
+                    break  # the acquisition has been aborted
+                elif ERROR_CODE[wait_error] == 'DRV_NO_NEW_DATA':
+                    raise IOError('Timed out waiting for image %i of the kinetic series' % frames_read)
+        finally:
+            if frames_read < n_frames:
+                self.abort()
+        if '_logger' in self.__dict__:
+            self._logger.debug('Streamed %i of %i images' % (frames_read, n_frames))
+        return frames_read
+
     # @locked_action
     def SetImage(self, *params):
         """Set camera parameters for either the IsolatedCrop mode or Image mode
@@ -713,17 +797,18 @@ class Andor(Camera, AndorBase):
         self.isAborted = True
         self.abort()
 
-    def raw_snapshot(self):
+    def raw_snapshot(self, out=None):
+        """Capture an image (or series of images), see AndorBase.capture for the `out` argument"""
         try:
-            imageArray, num_of_images, image_shape = self.capture()
+            imageArray, num_of_images, image_shape = self.capture(out=out)
 
             self.imageArray = imageArray
 
             # The image is reversed depending on whether you read in the conventional CCD register or the EM register, so we reverse it back
             if self.parameters['OutAmp']['value']:
-                self.CurImage = np.reshape(self.imageArray, (num_of_images,) + image_shape)[..., ::-1]
+                self.CurImage = self.imageArray[..., ::-1]
             else:
-                self.CurImage = np.reshape(self.imageArray, (num_of_images,) + image_shape)
+                self.CurImage = self.imageArray
             self.CurImage = self.bundle_metadata(self.CurImage)
             if len(self.CurImage) == 1:
                 return 1, self.CurImage[0]
@@ -732,6 +817,69 @@ class Andor(Camera, AndorBase):
         except Exception as e:
             self._logger.warn("Couldn't Capture because %s" % e)
 
+    def stream_kinetic_series(self, n_frames=None, data_group=None, buffer_frames=64, chunk_frames=16,
+                              compression=None, preview_callback=None, preview_interval=0.2):
+        """Acquire a kinetic series, saving it to HDF5 as it is acquired
+
+        The images go into a ring buffer as soon as they are read out (see AndorBase.stream_acquisition), from
+        which a background thread appends them to a chunked dataset, so series longer than will fit in memory
+        can be taken.  While the series runs, CurImage is updated with the latest image every preview_interval
+        seconds, and preview_callback (if given) is called with no arguments, e.g. to refresh a display.
+
+        Parameters
+        ----------
+        n_frames            number of images to take (defaults to NKin)
+        data_group          the group in which to save the "frames" and "timestamps" datasets (by default, a new
+                            "kinetic_series_%d" group is created in the current datafile)
+        buffer_frames       size of the ring buffer, i.e. how far the writer can fall behind before images are lost
+        chunk_frames        number of images in each HDF5 chunk
+        compression         passed to h5py, e.g. 'gzip' or 'lzf'
+        preview_callback    optional function called after each preview update
+        preview_interval    time between preview updates
+
+        Returns
+        -------
+        The "frames" dataset
+
+        """
+        num_of_images, image_shape = self.get_acquisition_shape()
+        ring_buffer = FrameRingBuffer(buffer_frames, image_shape, dtype=np.intc)
+        if data_group is None:
+            data_group = self.create_data_group('kinetic_series_%d')
+        # The image is reversed when reading from the conventional CCD register (see raw_snapshot)
+        reverse = self.parameters['OutAmp']['value']
+        spooler = FrameSpooler(ring_buffer, data_group, chunk_frames=chunk_frames, compression=compression,
+                               transform=(lambda frames: frames[..., ::-1]) if reverse else None,
+                               attrs=self.get_metadata())
+        spooler.start()
+
+        stop_preview = threading.Event()
+
+        def update_preview():
+            last_previewed = -1
+            while not stop_preview.wait(preview_interval):
+                frame, sequence_number, timestamp = ring_buffer.latest_frame()
+                if sequence_number > last_previewed:
+                    last_previewed = sequence_number
+                    self.CurImage = self.bundle_metadata(frame[np.newaxis, ..., ::-1] if reverse
+                                                         else frame[np.newaxis])
+                    if preview_callback is not None:
+                        preview_callback()
+        preview_thread = threading.Thread(target=update_preview)
+        preview_thread.daemon = True
+        preview_thread.start()
+        try:
+            frames_read = self.stream_acquisition(ring_buffer, n_frames)
+        finally:
+            stop_preview.set()
+            spooler.stop()
+            preview_thread.join()
+        data_group.attrs['frames_acquired'] = frames_read
+        if spooler.frames_dropped > 0:
+            self._logger.warn('%i of %i images were lost while saving the kinetic series, try a larger '
+                              'buffer_frames' % (spooler.frames_dropped, frames_read))
+        return spooler.dataset
+
     def get_camera_parameter(self, parameter_name):
         return self.GetParameter(parameter_name)
 
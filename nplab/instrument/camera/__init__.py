@@ -20,7 +20,10 @@ import pyqtgraph as pg
 from weakref import WeakSet
 
 from nplab.instrument import Instrument
+from nplab.utils.frame_buffer import FrameRingBuffer, FrameBufferReader
+from nplab.utils.video import HDF5VideoWriter
 from nplab.utils.notified_property import NotifiedProperty, DumbNotifiedProperty, register_for_property_changes
+from nplab.utils.thread_utils import background_action
 
 
 class CameraParameter(NotifiedProperty):
@@ -81,13 +84,26 @@ class Camera(Instrument):
     filter_function = None 
     """This function is run on the image before it's displayed in live view.  
     It should accept, and return, an RGB image as its argument."""
+
+    frame_buffer_length = 16
+    """The number of recent frames kept in memory (see `get_frames_since`)."""
+
+    preview_frame_rate = 20.0
+    """The maximum rate (in Hz) at which preview widgets are updated.  If the
+    camera is faster than this, frames are skipped rather than queued."""
+
+    preview_max_size = 1024
+    """Frames bigger than this (in pixels, along either side) are downsampled
+    before they are displayed.  None disables downsampling."""
     
     def __init__(self):
         super(Camera,self).__init__()
         self.acquisition_lock = threading.Lock()    
         self._latest_frame_update_condition = threading.Condition()
         self._live_view = False
-        self._frame_counter = 0
+        self._frame_counter = 0 # the sequence number of the next frame
+        self._frame_buffer = None
+        self.unavailable_camera_parameters = set() # parameters that can't be read on this camera
         # Ensure camera parameters get saved in the metadata.  You may want to override this in subclasses
         # to remove junk (e.g. if some of the parameters are meaningless)
 #        self.metadata_property_names = self.metadata_property_names + tuple(self.camera_parameter_names())
@@ -131,22 +147,103 @@ class Camera(Instrument):
         with self._latest_frame_update_condition:
             # We use the Condition object to block until a new frame appears
             # However we need to check that a new frame has actually been taken
-            # so we use the frame counter.
-            # NB the current implementation may be vulnerable to dropped frames
-            # which will probably cause a timeout error.
-            # Checking for frame_counter being >= target_frame is vulnerable to
-            # overflow.
+            # so we use the frame counter, which only ever increases.
             target_frame = self._frame_counter + 1 + discard_frames
             expiry_time = time.time() + timeout
-            while self._frame_counter != target_frame and time.time() < expiry_time:
-                self._latest_frame_update_condition.wait(timeout) #wait for a new frame
-            if time.time() >= expiry_time:
+            while self._frame_counter < target_frame and time.time() < expiry_time:
+                self._latest_frame_update_condition.wait(expiry_time - time.time()) #wait for a new frame
+            if self._frame_counter < target_frame:
                 raise IOError("Timed out waiting for a fresh frame from the video stream.")
             if raw:
                 return self.latest_raw_frame
             else:
                 return self.latest_frame
-        
+
+    def record(self, duration=None, n_frames=None, codec=None, quality=None,
+               data_group=None, n_workers=4):
+        """Record video from the live view stream into the current datafile.
+
+        Recording stops after `duration` seconds or `n_frames` frames,
+        whichever comes first (at least one must be given).  Live view is
+        started if it's not already running (and stopped again afterwards).
+        Frames are taken from the stream as they arrive, so recording doesn't
+        slow the camera down, and saved by an `HDF5VideoWriter` into a group
+        (by default a new "video_%d" group), along with their timestamps.
+
+        @param: codec: None (uncompressed), 'gzip' or 'lzf' (lossless), or
+        'jpeg' or 'png' (each frame encoded as an image) - see
+        `nplab.utils.video`.  Compression is done by `n_workers` threads.
+        @param: quality: JPEG quality, PNG compression or gzip level.
+
+        Returns the "frames" dataset.  Its "frames_dropped" attribute is the
+        number of frames that arrived too quickly to be recorded.
+        """
+        assert duration is not None or n_frames is not None, "You must specify duration or n_frames"
+        started_live_view = not self.live_view
+        if started_live_view:
+            self.live_view = True
+        reader = self.get_frame_reader()
+        writer = None
+        try:
+            if data_group is None:
+                data_group = self.create_data_group("video_%d")
+            expiry_time = None if duration is None else time.time() + duration
+            while (n_frames is None or reader.frames_read < n_frames) and \
+                  (expiry_time is None or time.time() < expiry_time):
+                timeout = 1.0 if expiry_time is None else max(min(expiry_time - time.time(), 1.0), 0)
+                max_frames = None if n_frames is None else n_frames - reader.frames_read
+                frames, sequence_numbers, timestamps = reader.read(max_frames=max_frames, timeout=timeout)
+                if len(sequence_numbers) == 0:
+                    continue
+                if writer is None:
+                    writer = HDF5VideoWriter(data_group, frames.shape[1:], frames.dtype, codec=codec,
+                                             quality=quality, n_workers=n_workers, attrs=self.metadata)
+                writer.write(frames, timestamps, sequence_numbers)
+        finally:
+            if started_live_view:
+                self.live_view = False
+            if writer is not None:
+                writer.close()
+        if writer is None:
+            raise IOError("No frames were recorded from the video stream.")
+        writer.frames.attrs['frames_dropped'] = reader.frames_dropped
+        return writer.frames
+
+    @property
+    def latest_sequence_number(self):
+        """The sequence number of the latest frame (-1 if there hasn't been one)."""
+        return self._frame_counter - 1
+
+    @property
+    def frame_buffer(self):
+        """The `FrameRingBuffer` holding recent frames (None until the first frame)."""
+        return self._frame_buffer
+
+    def get_frames_since(self, sequence_number=-1, max_frames=None):
+        """Return the frames acquired since the given sequence number.
+
+        Every frame that passes through `latest_raw_frame` (live view, or
+        images taken with update_latest_frame) is stored in a ring buffer of
+        the last `frame_buffer_length` frames.  This returns copies of the
+        frames newer than `sequence_number`, as a tuple of (frames,
+        sequence_numbers, timestamps, n_dropped) - see
+        `FrameRingBuffer.get_frames_since`.  To consume the stream
+        continuously, it's simpler to use `get_frame_reader`.
+        """
+        if self._frame_buffer is None:
+            return np.zeros((0,)), np.zeros((0,), dtype=np.int64), np.zeros((0,)), 0
+        return self._frame_buffer.get_frames_since(sequence_number, max_frames=max_frames)
+
+    def get_frame_reader(self, start_after=None):
+        """Return a `FrameBufferReader` that reads each new frame once.
+
+        Readers are independent, so live view, recording and autofocus can
+        all consume the same stream; each one counts the frames it missed in
+        its `frames_dropped` attribute.  By default the reader starts with
+        the next frame to arrive.
+        """
+        return FrameBufferReader(lambda: self._frame_buffer, start_after=start_after)
+
     def raw_snapshot(self):
         """Take a snapshot and return it.  No filtering or conversion."""
         raise NotImplementedError("Cameras must subclass raw_snapshot!")
@@ -229,27 +326,52 @@ class Camera(Instrument):
     @latest_raw_frame.setter
     def latest_raw_frame(self, frame):
         """Set the latest raw frame, and update the preview widget if any."""
+        self.set_latest_raw_frame(frame)
+
+    def set_latest_raw_frame(self, frame, timestamp=None):
+        """Set the latest raw frame, optionally with the time it was taken.
+
+        Frames in the frame buffer are timestamped when they arrive, unless
+        `timestamp` (in seconds, as returned by `time.time()`) is given.
+        Cameras that know when each frame was exposed should use this rather
+        than setting `latest_raw_frame`, so that frames can be matched up with
+        e.g. stage positions (see `CameraWithLocation.fly_autofocus`)."""
         with self._latest_frame_update_condition:
             self._latest_raw_frame = frame
-            self._frame_counter += 1
+            if frame is not None:
+                self._store_in_frame_buffer(frame, timestamp)
+                self._frame_counter += 1
             self._latest_frame_update_condition.notify_all()
-        
-        # TODO: use the NotifiedProperty to do this with less code?
-        if self._preview_widgets is not None:
-            for w in self._preview_widgets:
-                try:
-                    w.update_image(self.latest_frame)
-                except Exception as e:
-                    print "something went wrong updating the preview widget"
-                    print e
-                
+
+    def _store_in_frame_buffer(self, frame, timestamp=None):
+        """Copy a frame into the ring buffer, making a new one if the frame size changes."""
+        frame = np.asarray(frame)
+        buf = self._frame_buffer
+        if buf is None or buf.frame_shape != frame.shape or buf.dtype != frame.dtype:
+            buf = FrameRingBuffer(self.frame_buffer_length, frame.shape, dtype=frame.dtype,
+                                  first_sequence_number=self._frame_counter)
+            self._frame_buffer = buf
+        buf.put(frame, timestamp)
+
+    _filtered_frame_cache = None
     @property
     def latest_frame(self):
-        """The last frame acquired (in live view/from GUI), after filtering."""
-        if self.filter_function is not None:
-            return self.filter_function(self.latest_raw_frame)
-        else:
+        """The last frame acquired (in live view/from GUI), after filtering.
+
+        The filter function is run at most once per frame: the result is
+        kept until a new frame arrives (or the filter function changes)."""
+        if self.filter_function is None:
             return self.latest_raw_frame
+        with self._latest_frame_update_condition:
+            raw_frame, frame_counter = self._latest_raw_frame, self._frame_counter
+        if raw_frame is None:
+            return None
+        cache = self._filtered_frame_cache
+        if cache is not None and cache[0] == frame_counter and cache[1] == self.filter_function:
+            return cache[2]
+        filtered_frame = self.filter_function(raw_frame)
+        self._filtered_frame_cache = (frame_counter, self.filter_function, filtered_frame)
+        return filtered_frame
     
     
     def update_latest_frame(self, frame=None):
@@ -273,12 +395,17 @@ class Camera(Instrument):
         else:
             print "Failed to get an image from the camera"    
     
+    _camera_parameter_names_cache = {}
+
     def camera_parameter_names(self):
         """Return a list of names of parameters that may be set/read.
         
         This will list the names of all the members of this class that are 
         `CameraParameter`s - you should define one of these for each of the 
-        properties of the camera you'd like to expose.
+        properties of the camera you'd like to expose.  Parameters that have
+        been found not to work on this camera (see `get_camera_parameters`)
+        are left out.  No parameters are read from the camera: the class is
+        only inspected once, and the list is cached.
         
         If you need to support dynamic properties, I suggest you use a class
         factory, and add CameraParameters at runtime.  You could do this from
@@ -287,20 +414,62 @@ class Camera(Instrument):
         If you need more sophisticated control, I suggest subclassing
         `CameraParameter`, though I can't currently see how that would help...
         """
-        # first, identify all the CameraParameter properties we've got
-        p_list = []
-        for p in dir(self.__class__):
+        cls = self.__class__
+        if cls not in Camera._camera_parameter_names_cache:
+            Camera._camera_parameter_names_cache[cls] = [p for p in dir(cls)
+                            if isinstance(getattr(cls, p, None), CameraParameter)]
+        unavailable = getattr(self, "unavailable_camera_parameters", ())
+        return [p for p in Camera._camera_parameter_names_cache[cls] if p not in unavailable]
+
+    def get_camera_parameters(self, parameter_names=None):
+        """Read several camera parameters, and return them in a dictionary.
+        
+        Parameters that can't be read are left out of the dictionary, and
+        added to `unavailable_camera_parameters` so they are not tried again
+        (and no longer appear in `camera_parameter_names`).  By default, all
+        the camera parameters are read.  Cameras that can read many parameters
+        in one call should override this.
+        """
+        if parameter_names is None:
+            parameter_names = self.camera_parameter_names()
+        values = {}
+        for p in parameter_names:
+            if p in self.unavailable_camera_parameters:
+                continue
             try:
-                if isinstance(getattr(self.__class__, p), CameraParameter):
-                    getattr(self,p)
-                    p_list.append(p)
-            except:
-                delattr(self.__class__,p)
-                pass
-        return p_list
-   #     return [p for p in dir(self.__class__)
-    #              if isinstance(getattr(self.__class__, p), CameraParameter)]
-    
+                values[p] = getattr(self, p)
+            except Exception as e:
+                self._logger.info("Camera parameter %s is not available: %s" % (p, e))
+                self.unavailable_camera_parameters.add(p)
+        return values
+
+    @background_action
+    def probe_camera_parameters(self):
+        """Find out which camera parameters can be read, in a background thread.
+        
+        This returns a thread straight away; call its `join_and_return_result`
+        method to wait for it, and get a dictionary of the parameters' values.
+        Parameters that fail are recorded in `unavailable_camera_parameters`.
+        """
+        return self.get_camera_parameters()
+
+    def get_metadata(self, property_names=[], include_default_names=True, exclude=None):
+        """A dictionary of settings, properties, etc. to save along with data.
+        
+        This is `Instrument.get_metadata`, except that camera parameters that
+        can't be read are left out rather than raising an error.
+        """
+        exclude = list(exclude) if exclude is not None else []
+        parameter_names = [p for p in self.camera_parameter_names() if p not in exclude
+                           and (include_default_names or p in property_names)]
+        metadata = super(Camera, self).get_metadata(property_names, include_default_names,
+                                                    exclude + self.camera_parameter_names()
+                                                    + list(self.unavailable_camera_parameters))
+        metadata.update(self.get_camera_parameters(parameter_names))
+        return metadata
+
+    metadata = property(get_metadata)
+
     def get_camera_parameter(self, parameter_name):
         """Return the named property from the camera"""
         raise NotImplementedError("You must override get_camera_parameter to use it")
@@ -326,7 +495,6 @@ class Camera(Instrument):
                 return # do nothing if it's going already.
             print "starting live view thread"
             try:
-                self._frame_counter = 0
                 self._live_view_stop_event = threading.Event()
                 self._live_view_thread = threading.Thread(target=self._live_view_function)
                 self._live_view_thread.start()
@@ -372,16 +540,60 @@ class Camera(Instrument):
         """A Qt Widget that can be used as a viewfinder for the camera.
         
         In live mode, this is continuously updated.  It's also updated whenever
-        a snapshot is taken using update_latest_frame.  Currently this returns
-        a single widget instance - in future it might be able to generate (and
-        keep updated) multiple widgets."""
+        a snapshot is taken using update_latest_frame.  Each call returns a new
+        widget, and all of them are kept updated."""
         if self._preview_widgets is None:
             self._preview_widgets = WeakSet()
         new_widget = CameraPreviewWidget()
         self._preview_widgets.add(new_widget)
         if self.legacy_click_callback is not None:
             new_widget.add_legacy_click_callback(self.legacy_click_callback)
+        self._start_preview_thread()
         return new_widget
+
+    _preview_thread = None
+    def _start_preview_thread(self):
+        """Make sure the thread that updates the preview widgets is running."""
+        if self._preview_thread is None or not self._preview_thread.is_alive():
+            self._preview_thread = threading.Thread(target=self._preview_function)
+            self._preview_thread.daemon = True
+            self._preview_thread.start()
+
+    def _preview_function(self):
+        """Send the latest frame to the preview widgets, at up to preview_frame_rate.
+
+        This runs in its own thread (until there are no preview widgets left),
+        so the acquisition thread never waits for the display.  Filtering and
+        downsampling happen here too, once per displayed frame, leaving the GUI
+        thread to just draw the image.
+        """
+        displayed_frame = 0 # the value of _frame_counter when we last updated
+        next_update_time = 0
+        while self._preview_widgets:
+            with self._latest_frame_update_condition:
+                if self._frame_counter == displayed_frame:
+                    self._latest_frame_update_condition.wait(0.5)
+                if self._frame_counter == displayed_frame:
+                    continue
+            delay = next_update_time - time.time()
+            if delay > 0:
+                time.sleep(delay) # skip any frames that arrive in the meantime
+            displayed_frame = self._frame_counter
+            next_update_time = time.time() + 1.0/self.preview_frame_rate
+            try:
+                frame = self.latest_frame
+                if frame is None:
+                    continue
+                image, downsampling = downsample_for_display(frame, self.preview_max_size)
+                self._update_preview_widgets(image, downsampling)
+            except Exception as e:
+                print "something went wrong updating the preview widget"
+                print e
+
+    def _update_preview_widgets(self, image, downsampling):
+        """Send a (prepared) image to all the preview widgets."""
+        for w in list(self._preview_widgets):
+            w.update_image(image, downsampling)
     
     def get_control_widget(self):
         """Return a widget that contains the camera controls but no image."""
@@ -469,31 +681,58 @@ class CameraControlWidget(QtWidgets.QWidget, UiTools):
 class CameraParametersTableModel(QtCore.QAbstractTableModel):
     """Class to manage a Qt table of a camera's parameters.
     
+    Parameter values are cached, so that redrawing the table never talks to
+    the camera.  The values are read all together, in a background thread,
+    the first time they are displayed (or when `refresh` is called); after
+    that, the cache is kept up to date by property change notifications.
+    Parameters that turn out not to be readable are removed from the table.
+    
     With thanks to http://stackoverflow.com/questions/11736560/edit-table-in-
     pyqt-using-qabstracttablemodel"""
+    values_read = QtCore.Signal(dict)
+
     def __init__(self, camera, parent=None):
         super(CameraParametersTableModel, self).__init__(parent)
         self.camera = camera
         self.parameter_names = self.camera.camera_parameter_names()
-        for parameter_name in self.parameter_names[:]:   #Added to prevent properties the camera does not posses from trying to appear in the list of parameters
-            try:
-                getattr(self.camera, parameter_name)
-            except:
-                self.parameter_names.remove(parameter_name)
+        self._values = dict()
+        self._refresh_thread = None
+        self.values_read.connect(self._update_values, QtCore.Qt.QueuedConnection)
         
         # Here, we register to get a callback if any of the parameters change
         # so that we stay in sync with the camera.
         self._callback_functions = dict()       
-        for i, pn in enumerate(self.parameter_names):
-            callback = self.callback_to_update_row(i)
+        for pn in self.parameter_names:
+            callback = self.callback_to_update_parameter(pn)
             register_for_property_changes(self.camera, pn, callback)
             self._callback_functions[pn] = callback
+
+    def refresh(self):
+        """Read all the parameters from the camera, in a background thread."""
+        if self._refresh_thread is not None and self._refresh_thread.is_alive():
+            return
+        self._refresh_thread = threading.Thread(target=self._read_values)
+        self._refresh_thread.daemon = True
+        self._refresh_thread.start()
+
+    def _read_values(self):
+        self.values_read.emit(self.camera.get_camera_parameters(self.parameter_names))
+
+    def _update_values(self, values):
+        """Update the cache with values read from the camera, dropping unreadable parameters."""
+        self.beginResetModel()
+        self._values.update(values)
+        self.parameter_names = [pn for pn in self.parameter_names
+                                if pn not in self.camera.unavailable_camera_parameters]
+        self.endResetModel()
     
-    def callback_to_update_row(self, i):
-        """Return a callback function that refreshes the i-th parameter."""
+    def callback_to_update_parameter(self, parameter_name):
+        """Return a callback function that updates the cached value of a parameter."""
         def callback(value=None):
-            index = self.createIndex(i, 1)
-            self.dataChanged.emit(index, index)
+            self._values[parameter_name] = value
+            if parameter_name in self.parameter_names:
+                index = self.createIndex(self.parameter_names.index(parameter_name), 1)
+                self.dataChanged.emit(index, index)
         return callback
     
     def rowCount(self, parent):
@@ -509,8 +748,11 @@ class CameraParametersTableModel(QtCore.QAbstractTableModel):
         parameter_name = self.parameter_names[index.row()]
         if index.column() == 0:
             return parameter_name
+        elif parameter_name in self._values:
+            return self._values[parameter_name]
         else:
-            return getattr(self.camera, parameter_name)
+            self.refresh()
+            return None
     
     def headerData(self, i, orientation, role=QtCore.Qt.DisplayRole):
         "Return data for the headers."
@@ -557,6 +799,26 @@ class CameraParametersWidget(QtWidgets.QWidget, UiTools):
         layout.addWidget(self.table_view)
         self.setLayout(layout)
 
+def downsample_for_display(image, max_size=None):
+    """Prepare an image for display in a `CameraPreviewWidget`.
+
+    If either side of the image is bigger than `max_size`, it is decimated by
+    an integer factor.  Images that aren't 8-bit are converted to floating
+    point (see `CameraPreviewWidget.update_widget`).  Returns the new image
+    and the downsampling factor.
+    """
+    image = np.asarray(image)
+    downsampling = 1
+    if max_size is not None:
+        downsampling = max(int(np.ceil(max(image.shape[:2])/float(max_size))), 1)
+    if downsampling > 1:
+        image = image[::downsampling, ::downsampling, ...]
+    if image.dtype == np.uint8:
+        return np.array(image), downsampling # copy, in case the camera re-uses its buffer
+    else:
+        return image.astype(float), downsampling
+
+
 class PreviewViewBox(pg.ViewBox):
     """A pyqtgraph ViewBox for use in the preview widget."""
     def suggestPadding(self, axis):
@@ -567,11 +829,12 @@ class PreviewViewBox(pg.ViewBox):
         
 class PreviewImageItem(pg.ImageItem):
     legacy_click_callback = None
+    downsampling = 1 # each displayed pixel is this many camera pixels across
     click_callback_signal = QtCore.Signal(np.ndarray)
     def mouseClickEvent(self, ev):
         """Handle a mouse click on the image."""
         if ev.button() == QtCore.Qt.LeftButton:
-            pos = np.array(ev.pos())
+            pos = np.array(ev.pos()) * self.downsampling
             if self.legacy_click_callback is not None:
         #        size = np.array(self.image.shape[:2])
      #           point = pos/size
@@ -587,7 +850,7 @@ class PreviewImageItem(pg.ImageItem):
 
 class CameraPreviewWidget(pg.GraphicsView):
     """A Qt Widget to display the live feed from a camera."""
-    update_data_signal = QtCore.Signal(np.ndarray)
+    update_data_signal = QtCore.Signal(np.ndarray, int)
     
     def __init__(self):
         super(CameraPreviewWidget, self).__init__()
@@ -607,14 +870,15 @@ class CameraPreviewWidget(pg.GraphicsView):
         # This is done using the signal/slot mechanism
         self.update_data_signal.connect(self.update_widget, type=QtCore.Qt.QueuedConnection)
 
-    def update_widget(self, newimage):
+    def update_widget(self, newimage, downsampling=1):
         """Set the image, but do so in the Qt main loop to avoid threading nasties."""
         # I've explicitly dealt with the datatype of the source image, to avoid
         # a bug in the way pyqtgraph interacts with numpy 1.10.  This means
         # scaling the display values will fail for integer data.  I've thus
         # forced floating-point for anything that isn't a u8, and assumed u8
         # wants to be displayed raw.  You can always use filter_function to
-        # tweak the brightness/contrast.
+        # tweak the brightness/contrast.  The conversion is done by
+        # downsample_for_display, before the image reaches the GUI thread.
         if len(newimage.shape)==2:
             newimage = newimage.transpose()
         elif len(newimage.shape)==3:
@@ -622,15 +886,25 @@ class CameraPreviewWidget(pg.GraphicsView):
         if newimage.dtype =="uint8":
             self.image_item.setImage(newimage, autoLevels=False)
         else:
-            self.image_item.setImage(newimage.astype(float))
-        if newimage.shape != self._image_shape:
-            self._image_shape = newimage.shape
-            self.set_crosshair_centre((newimage.shape[1]/2.0, newimage.shape[0]/2.0))
-    def update_image(self, newimage):
-        """Update the image displayed in the preview widget."""
-        # NB compared to previous versions, pyqtgraph flips in y, hence the
-        # funny slice on the next line.
-        self.update_data_signal.emit(newimage)
+            self.image_item.setImage(newimage)
+        # Display downsampled images at full size, so coordinates are in camera pixels
+        self.image_item.downsampling = downsampling
+        self.image_item.setRect(QtCore.QRectF(0, 0, newimage.shape[0]*downsampling,
+                                              newimage.shape[1]*downsampling))
+        if (newimage.shape, downsampling) != self._image_shape:
+            self._image_shape = (newimage.shape, downsampling)
+            self.set_crosshair_centre((newimage.shape[1]*downsampling/2.0,
+                                       newimage.shape[0]*downsampling/2.0))
+    def update_image(self, newimage, downsampling=None):
+        """Update the image displayed in the preview widget.
+
+        If `downsampling` is None, the image is prepared for display (see
+        `downsample_for_display`) in the calling thread.  Otherwise, it should
+        already have been prepared, with the given downsampling factor.
+        """
+        if downsampling is None:
+            newimage, downsampling = downsample_for_display(newimage)
+        self.update_data_signal.emit(newimage, downsampling)
         
     def add_legacy_click_callback(self, function):
         """Add an old-style (coordinates in fractions-of-an-image) callback."""
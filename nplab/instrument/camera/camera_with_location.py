@@ -20,7 +20,7 @@ import nplab.instrument.camera
 from nplab.instrument.stage import Stage
 from nplab.instrument import Instrument
 import numpy as np
-from nplab.utils.image_with_location import ImageWithLocation, ensure_3d, ensure_2d, locate_feature_in_image, datum_pixel
+from nplab.utils.image_with_location import ImageWithLocation, ensure_3d, ensure_2d, locate_feature_in_image, datum_pixel, FeatureLocator
 from nplab.experiment import Experiment, ExperimentStopped
 from nplab.experiment.gui import ExperimentWithProgressBar, run_function_modally
 from nplab.utils.gui import QtCore, QtGui, QtWidgets
@@ -31,6 +31,8 @@ from scipy.signal import argrelextrema
 from nplab.ui.ui_tools import QuickControlBox, UiTools
 from nplab.utils.notified_property import DumbNotifiedProperty
 import time
+import threading
+from multiprocessing.pool import ThreadPool
 
 # Autofocus merit functions
 def af_merit_squared_laplacian(image):
@@ -43,6 +45,27 @@ def af_merit_squared_laplacian(image):
     return np.sum(cv2.Laplacian(image, ddepth=cv2.CV_32F) ** 2)
 
 
+def af_central_thumbnail(image, roi_size=256, downsample=2):
+    """Return a grayscale, float32, downsampled copy of the centre of an image, for fast focus measurements.
+
+    roi_size : int or None
+        The size (in pixels of the original image) of the square region that's kept.  None keeps the whole image.
+    downsample : int
+        The region is reduced in size by this factor (averaging blocks of pixels, which also reduces noise).
+    """
+    image = np.asarray(image)
+    if roi_size is not None:
+        top, left = [max((n - roi_size) // 2, 0) for n in image.shape[:2]]
+        image = image[top:top + roi_size, left:left + roi_size, ...]
+    if len(image.shape) == 3:
+        image = np.mean(image, axis=2, dtype=np.float32)
+    image = image.astype(np.float32)
+    if downsample > 1:
+        image = cv2.resize(image, (image.shape[1] // downsample, image.shape[0] // downsample),
+                           interpolation=cv2.INTER_AREA)
+    return image
+
+
 class CameraWithLocation(Instrument):
     """
     A class wrapping a camera and a stage, allowing them to work together.
@@ -58,6 +81,7 @@ class CameraWithLocation(Instrument):
     settling_time = 0.0 # How long to wait for the stage to stop vibrating.
     frames_to_discard = 1 # How many frames to discard from the camera after a move.
     disable_live_view = DumbNotifiedProperty(False) # Whether to disable live view while calibrating/autofocusing/etc.
+    feature_location_method = "template" # How to find features in images: "template", "pyramid" or "phase" (see FeatureLocator)
     af_step_size = DumbNotifiedProperty(1) # The size of steps to take when autofocusing
     af_steps = DumbNotifiedProperty(7) # The number of steps to take during autofocus
 
@@ -146,11 +170,10 @@ class CameraWithLocation(Instrument):
     @property
     def datum_location(self):
         """The location in the sample of the datum point (i.e. the current stage position, corrected for drift)"""
-        if self.drift_estimate == None:
-            return self.stage.position
-        else:
-            return self.stage.position-self.drift_estimate
-        return self.stage.position - self.drift_estimate
+        position = self.stage.position
+        if self.drift_estimate is None:
+            return position
+        return position - self.drift_estimate
 
     ####### Useful functions for closed-loop stage control #######
     def settle(self, flush_camera=True, *args, **kwargs):
@@ -161,8 +184,28 @@ class CameraWithLocation(Instrument):
         those things (except if flush_camera is False).
         """
         time.sleep(self.settling_time)
-        for i in range(self.frames_to_discard):
-            self.camera.raw_image(*args, **kwargs)
+        if flush_camera:
+            for i in range(self.frames_to_discard):
+                self.camera.raw_image(*args, **kwargs)
+
+    def plan_path_through_pixels(self, pixels, image=None, **kwargs):
+        """Find the sample locations of some pixels, and a short route to visit them.
+
+        pixels : array (n_points x 2)
+            Pixel coordinates in `image`, e.g. particle centres from
+            `Image_Filter_box.STBOC_with_size_filter(return_centers=True)`.
+        image : ImageWithLocation (optional)
+            The image the pixels refer to - by default, we take a new one.
+
+        Returns the (n_points x 3) sample locations of the pixels, sorted in the order in which they should be
+        visited, starting from the current position.  The route is planned in X and Y; other arguments are passed to
+        `Stage.plan_path`.
+        """
+        if image is None:
+            image = self.color_image()
+        locations = np.array([image.pixel_to_location(p) for p in pixels]).reshape(-1, 3)
+        order = self.stage.plan_path(locations[:, :2], **kwargs)
+        return locations[order]
 
     def move_to_feature(self, feature, ignore_position=False, ignore_z_pos = False, margin=50, tolerance=0.5, max_iterations = 10):
         """Bring the feature in the supplied image to the centre of the camera
@@ -198,13 +241,14 @@ class CameraWithLocation(Instrument):
                 print "Warning: no position data in feature image, skipping initial move."
         image = self.color_image()
         assert isinstance(image, ImageWithLocation), "CameraWithLocation should return an ImageWithLocation...?"
+        locator = FeatureLocator(feature, method=self.feature_location_method) # prepare the feature only once
 
         last_move = np.infty
         for i in range(max_iterations):
             try:
                 self.settle()
                 image = self.color_image()
-                pixel_position = locate_feature_in_image(image, feature, margin=margin, restrict=margin>0)
+                pixel_position = locator.locate(image, margin=margin, restrict=margin>0)
              #   pixel_position = locate_feature_in_image(image, feature,margin=margin)
                 new_position = image.pixel_to_location(pixel_position)
                 self.move(new_position)
@@ -298,6 +342,289 @@ class CameraWithLocation(Instrument):
         self.camera.exposure = self.camera.exposure*exposure_factor
         return new_position - here, positions, powers
 
+    def _focus_image(self, roi_size, downsample, flush_camera=False):
+        """Wait for the stage to settle, then return a fresh thumbnail (see `af_central_thumbnail`) for autofocus.
+
+        If live view is running, we wait for new frames from the video stream rather than taking snapshots.  Otherwise,
+        a snapshot is taken once the stage has settled, without discarding frames first unless `flush_camera` is set.
+        """
+        if self.camera.live_view:
+            time.sleep(self.settling_time)
+            image = self.camera.get_next_frame(discard_frames=self.frames_to_discard)
+        else:
+            self.settle(flush_camera=flush_camera)
+            image = self.camera.raw_image()
+        return af_central_thumbnail(image, roi_size=roi_size, downsample=downsample)
+
+    def fast_autofocus(self, step=None, max_range=None, tolerance=None, merit_function=af_merit_squared_laplacian,
+                       roi_size=256, downsample=2, min_contrast=0.2, max_moves=15, flush_camera=False,
+                       update_progress=lambda p:p):
+        """Find the best focus with as few moves as possible, then move there.
+
+        Instead of measuring focus at a fixed list of positions, like `autofocus`, this measures it at the current
+        position and one `step` either side (looking further out, on both sides, if none of them stands out from the
+        background), walks further if the focus is better at one end, and then homes in on the peak by fitting a
+        parabola through the best point and its neighbours, falling back on a golden-section step when the fit isn't
+        sensible.  Focus is measured on a downsampled, grayscale region in the centre of the image, and while one
+        image's merit is being calculated the stage is moving to the next position (when the position is known in
+        advance).
+
+        Arguments:
+        step : float, optional
+            The initial distance between Z positions.  Defaults to `af_step_size`.
+        max_range : float, optional
+            The furthest we will go from the starting position.  Defaults to the range used by `autofocus`.
+        tolerance : float, optional
+            We stop once the estimate of the best position changes by less than this.  Defaults to step/20.
+        merit_function : function, optional
+            A function that takes an image and returns a focus score, which we maximise.
+        roi_size, downsample : int, optional
+            The region of the image used to measure focus (see `af_central_thumbnail`).
+        min_contrast : float, optional
+            The best merit must be this fraction above the worst before we believe we've seen the peak.
+        max_moves : int, optional
+            The maximum number of positions to measure.
+        flush_camera : bool, optional
+            Discard `frames_to_discard` frames before each snapshot (see `settle`) - only needed for cameras whose
+            snapshots might have started before the stage stopped.  Frames are always discarded in live view.
+        update_progress : function, optional
+            This will be called each time we take an image - for use with run_function_modally.
+
+        Returns the shift in position, the positions measured and the merit at each one, like `autofocus`.  The time
+        taken is logged, and saved (with the number of moves) in `last_autofocus_report`.
+        """
+        t0 = time.time()
+        if step is None:
+            step = float(self.af_step_size)
+        if max_range is None:
+            max_range = max((self.af_steps - 1) / 2.0, 1) * self.af_step_size
+        if tolerance is None:
+            tolerance = step / 20.0
+        here = np.array(self.stage.position, dtype=np.float64)
+        z0 = here[2]
+        positions = [] # every position measured, in order
+        merits = []
+        pool = ThreadPool(1) # calculates merit functions while the stage moves
+
+        def measure(z_values):
+            """Measure focus at each Z position, overlapping the merit calculation with the next move."""
+            pending = []
+            for z in z_values:
+                self.stage.move(np.array([here[0], here[1], z]))
+                image = self._focus_image(roi_size, downsample, flush_camera)
+                positions.append(self.stage.position)
+                pending.append(pool.apply_async(merit_function, (image,)))
+                update_progress(len(positions))
+            merits.extend(float(p.get()) for p in pending)
+
+        def bracket():
+            """The Z positions measured so far (sorted), their merits, and the index of the best one."""
+            z = np.array(positions)[:, 2]
+            order = np.argsort(z)
+            z, m = z[order], np.array(merits)[order]
+            i = int(np.argmax(m))
+            return z, m, i
+
+        try:
+            measure([z0 - step, z0, z0 + step])
+            # If we're so far out of focus that nothing stands out from the background, look further out
+            n = 2
+            while (max(merits) - min(merits) < min_contrast * abs(min(merits)) and n * step <= max_range
+                   and len(positions) + 2 <= max_moves):
+                measure([z0 + n * step, z0 - n * step])
+                n += 1
+            # Walk towards the peak until it is bracketed
+            z, m, i = bracket()
+            while (i == 0 or i == len(z) - 1) and len(positions) < max_moves:
+                new_z = z[i] + (step if i > 0 else -step)
+                if abs(new_z - z0) > max_range + step: # we may look one step further, to bracket a peak at the edge
+                    break
+                measure([new_z])
+                z, m, i = bracket()
+            # Refine with parabolic fits (or golden-section steps) until two successive estimates agree
+            best_z = z[i]
+            previous_estimate = None
+            golden = 0.381966 # (3 - sqrt(5))/2
+            while 0 < i < len(z) - 1 and len(positions) < max_moves:
+                (za, zb, zc), (ma, mb, mc) = z[i - 1:i + 2], m[i - 1:i + 2]
+                denominator = (zb - za) * (mb - mc) - (zb - zc) * (mb - ma)
+                estimate = None
+                if denominator != 0:
+                    estimate = zb - 0.5 * ((zb - za)**2 * (mb - mc) - (zb - zc)**2 * (mb - ma)) / denominator
+                if estimate is None or not (za < estimate < zc):
+                    estimate = zb # the parabola isn't sensible - fall back on the best point
+                best_z = estimate
+                if previous_estimate is not None and abs(estimate - previous_estimate) < tolerance:
+                    break
+                previous_estimate = estimate
+                new_z = estimate
+                if np.min(np.abs(z - new_z)) < tolerance:
+                    # We've already measured here, so narrow the bracket with a golden-section step instead
+                    new_z = zb + golden * ((zc - zb) if zc - zb > zb - za else (za - zb))
+                measure([new_z])
+                z, m, i = bracket()
+            if not (0 < i < len(z) - 1):
+                self.log("Fast autofocus couldn't bracket the peak; using the best position measured.",
+                         level="warn")
+                best_z = z[i]
+        finally:
+            pool.close()
+            pool.join()
+        new_position = np.array([here[0], here[1], best_z])
+        self.stage.move(new_position)
+        update_progress(max_moves + 1)
+        duration = time.time() - t0
+        self.last_autofocus_report = {'duration': duration, 'moves': len(positions) + 1,
+                                      'shift': best_z - z0}
+        self.log("Fast autofocus moved by {:.3g} in {:.3f} s, measuring {} positions".format(
+            best_z - z0, duration, len(positions)))
+        return new_position - here, np.array(positions), np.array(merits)
+
+    def fast_autofocus_gui(self):
+        """Run a fast autofocus using default parameters, with a GUI progress bar."""
+        run_function_modally(self.fast_autofocus, progress_maximum=16)
+
+    def fly_autofocus(self, dz=None, n_samples=20, merit_function=af_merit_squared_laplacian, roi_size=256,
+                      downsample=2, position_source="poll", frame_latency=0.0, update_progress=lambda p:p):
+        """Sweep through focus at constant speed, measuring the focus of each live view frame, then go to the best.
+
+        The stage makes one continuous move through the Z range, while the camera streams frames.  Each frame's
+        timestamp is converted to a Z position, either by interpolating between stage positions that are read (in a
+        background thread) throughout the move, or from the commanded trajectory.  A parabola is then fitted to the
+        focus merit around its peak.  No time is spent waiting for the stage to settle, so a sweep takes one camera
+        frame time per sample.
+
+        The sweep speed is set to give `n_samples` frames, if the stage has a `velocity` attribute (one value per
+        axis, like `SimulatedStage`).  Other stages move at their normal speed, which must be slow enough for the
+        camera to take several frames.
+
+        Arguments:
+        dz : float, optional
+            We sweep from `dz` below the current position to `dz` above it.  Defaults to the range used by `autofocus`.
+        n_samples : int, optional
+            The number of frames we aim to take during the sweep.
+        merit_function : function, optional
+            A function that takes an image and returns a focus score, which we maximise.
+        roi_size, downsample : int, optional
+            The region of the image used to measure focus (see `af_central_thumbnail`).
+        position_source : "poll" or "trajectory"
+            Find each frame's Z position from stage positions read during the move ("poll"), or from the start time
+            and speed of the move ("trajectory", which needs a stage with a `velocity` attribute).
+        frame_latency : float, optional
+            The time (in seconds) between the middle of a frame's exposure and its timestamp.
+        update_progress : function, optional
+            This will be called as frames are analysed - for use with run_function_modally.
+
+        Returns the shift in position, the Z position of each frame and the merit of each frame.  The time taken is
+        logged, and saved (with the number of frames) in `last_autofocus_report`.
+        """
+        t0 = time.time()
+        if dz is None:
+            dz = max((self.af_steps - 1) / 2.0, 1) * self.af_step_size
+        here = np.array(self.stage.position, dtype=np.float64)
+        z_start, z_end = here[2] - dz, here[2] + dz
+        camera_live_view = self.camera.live_view
+        self.camera.live_view = True
+        reader = self.camera.get_frame_reader()
+        old_velocity = None
+        pool = ThreadPool(2) # calculates merit functions during the sweep
+        try:
+            self.stage.move(np.array([here[0], here[1], z_start]))
+            # Measure the frame rate, so we can choose the speed of the sweep
+            reader.read(timeout=5) # skip a frame, so the next ones are consecutive
+            frames, sequence_numbers, timestamps = reader.read(timeout=5)
+            while len(timestamps) < 3 and reader.wait(1, timeout=5):
+                new_frames, new_sequence_numbers, new_timestamps = reader.read()
+                timestamps = np.concatenate([timestamps, new_timestamps])
+            frame_period = np.median(np.diff(timestamps)) if len(timestamps) > 1 else None
+            velocity = None
+            if hasattr(self.stage, "velocity") and frame_period:
+                velocity = 2 * dz / (n_samples * frame_period)
+                old_velocity = np.array(self.stage.velocity, copy=True)
+                self.stage.velocity[2] = velocity
+            if position_source == "trajectory" and velocity is None:
+                raise ValueError("The trajectory can only be calculated if we can set the stage's velocity.")
+
+            # Start the sweep in a background thread, and poll the position while it runs
+            times, z_positions = [], []
+            def sweep():
+                self.stage.move(np.array([here[0], here[1], z_end]))
+            sweep_thread = threading.Thread(target=sweep)
+            reader.read() # discard frames from before the sweep
+            sweep_started = time.time()
+            sweep_thread.start()
+            pending = []
+            while sweep_thread.is_alive():
+                if position_source == "poll":
+                    before = time.time()
+                    z = self.stage.get_position()[2] # not .position, which may be cached
+                    times.append((before + time.time()) / 2.0)
+                    z_positions.append(z)
+                frames, sequence_numbers, timestamps = reader.read()
+                pending += [(timestamp, pool.apply_async(merit_function,
+                                                        (af_central_thumbnail(frame, roi_size, downsample),)))
+                            for frame, timestamp in zip(frames, timestamps)]
+                update_progress(len(pending))
+                time.sleep(frame_period / 4.0 if frame_period else 0.01) # a few position readings per frame
+            sweep_thread.join()
+            sweep_finished = time.time()
+            frames, sequence_numbers, timestamps = reader.read()
+            pending += [(timestamp, pool.apply_async(merit_function,
+                                                    (af_central_thumbnail(frame, roi_size, downsample),)))
+                        for frame, timestamp in zip(frames, timestamps)]
+        finally:
+            if old_velocity is not None:
+                self.stage.velocity[:] = old_velocity
+            self.camera.live_view = camera_live_view
+            pool.close()
+            pool.join()
+
+        # Work out where the stage was when each frame was taken
+        frame_times = np.array([timestamp for timestamp, result in pending]) - frame_latency
+        merits = np.array([float(result.get()) for timestamp, result in pending])
+        if position_source == "poll":
+            times = np.concatenate([[sweep_started], times, [sweep_finished]])
+            z_positions = np.concatenate([[z_start], z_positions, [z_end]])
+            frame_z = np.interp(frame_times, times, z_positions)
+        else:
+            frame_z = np.clip(z_start + velocity * (frame_times - sweep_started), z_start, z_end)
+        during_sweep = (frame_times >= sweep_started) & (frame_times <= sweep_finished)
+        frame_z, merits = frame_z[during_sweep], merits[during_sweep]
+
+        # Fit a parabola to the points around the peak that are more than halfway up it
+        best_z = here[2]
+        if len(merits) >= 3:
+            i = int(np.argmax(merits))
+            threshold = merits.min() + 0.5 * (merits.max() - merits.min())
+            first, last = i, i
+            while first > 0 and merits[first - 1] > threshold:
+                first -= 1
+            while last < len(merits) - 1 and merits[last + 1] > threshold:
+                last += 1
+            first, last = max(min(first, i - 1), 0), min(max(last, i + 1), len(merits) - 1)
+            best_z = frame_z[i]
+            if last - first >= 2:
+                coefficients = np.polyfit(frame_z[first:last + 1], merits[first:last + 1], deg=2)
+                if coefficients[0] < 0:
+                    vertex = -coefficients[1] / (2 * coefficients[0])
+                    if frame_z[first] <= vertex <= frame_z[last]:
+                        best_z = vertex
+        else:
+            self.log("Fly-through autofocus only got {} frames; returning to the start.".format(len(merits)),
+                     level="warn")
+        new_position = np.array([here[0], here[1], best_z])
+        self.stage.move(new_position)
+        duration = time.time() - t0
+        self.last_autofocus_report = {'duration': duration, 'moves': 3, 'frames': len(merits),
+                                      'sweep_duration': sweep_finished - sweep_started, 'shift': best_z - here[2]}
+        self.log("Fly-through autofocus moved by {:.3g} in {:.3f} s, using {} frames".format(
+            best_z - here[2], duration, len(merits)))
+        return new_position - here, frame_z, merits
+
+    def fly_autofocus_gui(self):
+        """Run a fly-through autofocus using default parameters, with a GUI progress bar."""
+        run_function_modally(self.fly_autofocus, progress_maximum=20)
+
     def quick_autofocus(self, dz=0.5, full_dz = None, trigger_full_af=True, update_progress=lambda p:p, **kwargs):
         """Do a quick 3-step autofocus, performing a full autofocus if needed
 
@@ -341,6 +668,7 @@ class CameraWithLocation(Instrument):
         starting_location = self.datum_location
         w, h = starting_image.shape[:2]
         template = starting_image[w/4:3*w/4,h/4:3*h/4, ...] # Use the central 50%x50% as template
+        template = FeatureLocator(template, method=self.feature_location_method)
         threshold_shift = w*0.02 # Require a shift of at least 2% of the image's width ,changed s[0] to w
         target_shift = w*0.1 # Aim for a shift of about 10%
 #Swapping images[-1] for starting_image
@@ -426,6 +754,8 @@ class CameraWithLocationControlUI(QtWidgets.QWidget):
         fc.add_spinbox("af_steps")
         fc.add_button("autofocus_gui", "Autofocus")
         fc.add_button("quick_autofocus_gui", "Quick Autofocus")
+        fc.add_button("fast_autofocus_gui", "Fast Autofocus")
+        fc.add_button("fly_autofocus_gui", "Fly-through Autofocus")
         fc.auto_connect_by_name(self.cwl)
         self.focus_controls = fc
 
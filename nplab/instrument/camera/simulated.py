@@ -0,0 +1,104 @@
+"""
+Simulated Camera
+================
+
+A camera that images a `SyntheticSample` through a stage, taking a realistic
+amount of time to do so.  `DummyCamera` returns random noise immediately;
+`SimulatedCamera` waits for the exposure and readout, streams live view at a
+fixed frame rate, blurs the sample when the stage is out of focus and adds
+detector noise.  It is meant for benchmarking autofocus, tiling and
+closed-loop positioning code without hardware.
+"""
+
+import time
+import numpy as np
+from nplab.instrument.camera import Camera, CameraParameter
+from nplab.modelling.synthetic_sample import SyntheticSample, NoiseModel
+
+
+class SimulatedCamera(Camera):
+    """A camera looking at a synthetic sample, mounted on a (simulated) stage.
+
+    Arguments:
+    stage : Stage, optional
+        The stage whose position sets the field of view.  Its x, y (and z, if
+        present) positions are read without any communication latency, so
+        that the camera doesn't disturb stage benchmarks.
+    sample : SyntheticSample, optional
+        The sample to image - a random one is created if none is given.
+    shape : (rows, columns)
+        The size of the image.
+    pixel_size : float
+        The size of one pixel, in stage units.
+    frame_rate : float
+        The frame rate (Hz) of the live view stream.
+    readout_time : float
+        The time (in seconds) taken to read out each frame.
+    noise_model : NoiseModel, optional
+        Noise added to each frame.
+    """
+    exposure = CameraParameter("exposure", "The exposure time in ms.")
+    gain = CameraParameter("gain", "The gain (counts per photoelectron).")
+
+    def __init__(self, stage=None, sample=None, shape=(480, 640), pixel_size=0.1,
+                 frame_rate=30.0, readout_time=0.01, noise_model=None, monochrome=False):
+        self.stage = stage
+        self.sample = sample if sample is not None else SyntheticSample.random()
+        self.shape = tuple(shape)
+        self.pixel_size = pixel_size
+        self.frame_rate = frame_rate
+        self.readout_time = readout_time
+        self.noise_model = noise_model if noise_model is not None else NoiseModel()
+        self.monochrome = monochrome
+        self._camera_parameters = {'exposure': 10.0, 'gain': 0.2}
+        self.frames_acquired = 0
+        super(SimulatedCamera, self).__init__()
+
+    def get_camera_parameter(self, name):
+        return self._camera_parameters[name]
+
+    def set_camera_parameter(self, name, value):
+        self._camera_parameters[name] = float(value)
+
+    def sample_position(self):
+        """The position of the sample at the centre of the field of view."""
+        if self.stage is None:
+            return np.zeros(3)
+        if hasattr(self.stage, "_true_position"):
+            return self.stage._true_position()  # avoid charging latency
+        return np.asarray(self.stage.position)
+
+    def render_frame(self, position=None):
+        """Generate a frame for a given stage position (no waiting)."""
+        if position is None:
+            position = self.sample_position()
+        photoelectrons = self.sample.render(position, self.shape, self.pixel_size)
+        photoelectrons *= self.exposure / 1000.0
+        counts = self.noise_model.apply(photoelectrons) * self.gain
+        frame = np.clip(counts, 0, 255).astype(np.uint8)
+        self.frames_acquired += 1
+        if self.monochrome:
+            return frame
+        return np.repeat(frame[:, :, np.newaxis], 3, axis=2)
+
+    def raw_snapshot(self):
+        """Wait for an exposure and readout, then return the frame."""
+        time.sleep(self.exposure / 1000.0)
+        position = self.sample_position()  # the stage position at the end of the exposure
+        time.sleep(self.readout_time)
+        return True, self.render_frame(position)
+
+    def _live_view_function(self):
+        """Stream frames at `frame_rate` (or as fast as exposure allows)."""
+        next_frame_time = time.time()
+        while not self._live_view_stop_event.is_set():
+            period = max(1.0 / self.frame_rate, self.exposure / 1000.0 + self.readout_time)
+            next_frame_time += period
+            delay = next_frame_time - time.time()
+            if delay < 0:
+                next_frame_time = time.time()  # we've fallen behind, don't try to catch up
+            elif self._live_view_stop_event.wait(timeout=delay):
+                break
+            timestamp = time.time()  # frames are exposed instantly, at this time
+            position = self.sample_position()
+            self.set_latest_raw_frame(self.render_frame(position), timestamp=timestamp)
@@ -8,6 +8,7 @@ from collections import deque
 
 from nplab.ui.ui_tools import UiTools
 from nplab.datafile import DataFile
+from nplab.utils.config_store import get_config_store
 from nplab.utils.notified_property import NotifiedProperty, DumbNotifiedProperty, register_for_property_changes
 import h5py
 from multiprocessing.pool import ThreadPool
@@ -63,13 +64,21 @@ class Spectrometer(Instrument):
         except AttributeError:
             pass #if it's not present, we get an exception - which doesn't matter.
 
+    def get_config_namespace(self):
+        """The name used to keep this spectrometer's settings apart from others'."""
+        return "{0}_{1}".format(self.__class__.__name__, self.serial_number)
+
     def open_config_file(self):
-        """Open the config file for the current spectrometer and return it, creating if it's not there"""
+        """Return the config store for the current spectrometer.
+
+        Settings are kept in a `ConfigStore` (one file per spectrometer, next
+        to the driver module), which is loaded lazily and written to disk in
+        the background a short time after the last change.  Values saved in
+        the old, shared `config.h5` are used if no store exists yet."""
         if self._config_file is None:
-            f = inspect.getfile(self.__class__)
-            d = os.path.dirname(f)
-            self._config_file = DataFile(h5py.File(os.path.join(d, 'config.h5')))
-            self._config_file.attrs['date'] = datetime.datetime.now().strftime("%H:%M %d/%m/%y")
+            d = os.path.dirname(inspect.getfile(self.__class__))
+            self._config_file = get_config_store(d, self.get_config_namespace(),
+                                                 legacy_filename=os.path.join(d, 'config.h5'))
         return self._config_file
 
     config_file = property(open_config_file)
@@ -79,14 +88,9 @@ class Spectrometer(Instrument):
         
         A file is created in the nplab directory that holds configuration
         data for the spectrometer, including reference/background.  This
-        function allows values to be stored in that file."""
-        f = self.config_file
-        if name not in f:
-            f.create_dataset(name, data=data ,attrs = attrs)
-        else:
-            dset = f[name]
-            dset[...] = data
-            f.flush()
+        function allows values to be stored in that file.  It returns
+        immediately; the file is written in the background."""
+        self.config_file.set(name, data)
 
     def get_model_name(self):
         """The model name of the spectrometer."""
@@ -149,10 +153,10 @@ class Spectrometer(Instrument):
                                                      'background_constant' : self.background_constant,
                                                      'background' : self.background,
                                                      'background_int': self.background_int}
-        self.update_config('background_gradient', self.background_gradient)
-        self.update_config('background_constant', self.background_constant)
-        self.update_config('background', self.background)
-        self.update_config('background_int', self.background_int)
+        self.config_file.update({'background_gradient': self.background_gradient,
+                                 'background_constant': self.background_constant,
+                                 'background': self.background,
+                                 'background_int': self.background_int})
 
     def clear_background(self):
         """Clear the current background reading."""
@@ -165,8 +169,8 @@ class Spectrometer(Instrument):
         """Acquire a new spectrum and use it as a reference."""
         self.reference = self.read_spectrum() 
         self.reference_int = self.integration_time
-        self.update_config('reference', self.reference)
-        self.update_config('reference_int',self.reference_int) 
+        self.config_file.update({'reference': self.reference,
+                                 'reference_int': self.reference_int})
         self.stored_references[self.reference_ID] = {'reference' : self.reference,
                                                     'reference_int' : self.reference_int}
     def load_reference(self,ID):
@@ -462,7 +466,7 @@ class SpectrometerControlUI(QtWidgets.QWidget,UiTools):
                 if 'background_gradient' in self.spectrometer.config_file:
                     self.spectrometer.background_gradient = self.spectrometer.config_file['background_gradient'][:]
                 if 'background_int' in self.spectrometer.config_file:
-                    self.spectrometer.background_int = self.spectrometer.config_file['background_constant'][...]
+                    self.spectrometer.background_int = self.spectrometer.config_file['background_int'][...]
                     
                 self.background_subtracted.blockSignals(True)
                 self.background_subtracted.setCheckState(QtCore.Qt.Checked)
@@ -197,15 +197,9 @@ class OceanOpticsSpectrometer(Spectrometer, Instrument):
             check_error(e)
             self._isOpen = False
 
-    def open_config_file(self):
-        if self._config_file is None:
-            f = inspect.getfile(self.__class__)
-            d = os.path.dirname(f)
-            self._config_file = DataFile(h5py.File(os.path.join(d, self.model_name+'_'+self.serial_number+'_config.h5')))
-            self._config_file.attrs['date'] = datetime.datetime.now().strftime("%H:%M %d/%m/%y")
-        return self._config_file
-
-    config_file = property(open_config_file)
+    def get_config_namespace(self):
+        """Settings are stored per model and serial number (as they always have been)."""
+        return self.model_name + '_' + self.serial_number
 
     def get_model_name(self):
         if self._model_name is None:
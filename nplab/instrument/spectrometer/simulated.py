@@ -0,0 +1,97 @@
+"""
+Simulated Spectrometer
+======================
+
+A spectrometer that measures a `SyntheticSample` at the current position of a
+stage.  `DummySpectrometer` returns uniform random numbers; this one returns
+particle spectra (with a dark level, shot noise and read noise) and takes the
+integration time plus a readout time to do so, which makes it suitable for
+benchmarking hyperspectral and grid scans without hardware.
+"""
+
+import time
+import numpy as np
+from nplab.instrument.spectrometer import Spectrometer
+from nplab.modelling.synthetic_sample import SyntheticSample, NoiseModel
+
+
+class SimulatedSpectrometer(Spectrometer):
+    """A spectrometer collecting light from a synthetic sample.
+
+    Arguments:
+    stage : Stage, optional
+        The stage that positions the sample.  If None, we always look at the
+        origin of the sample.
+    sample : SyntheticSample, optional
+        The sample to measure - a random one is created if none is given.
+    wavelengths : array, optional
+        The wavelength of each pixel (defaults to 1024 pixels, 400-1000nm).
+    spot_size : float
+        The size of the collection spot, in stage units.
+    readout_time : float
+        Time (in seconds) taken to read out each spectrum.
+    noise_model : NoiseModel, optional
+        Noise added to each spectrum.
+    """
+    metadata_property_names = ("model_name", "serial_number", "integration_time",
+                               "wavelengths", "reference", "background")
+
+    def __init__(self, stage=None, sample=None, wavelengths=None, spot_size=0.5,
+                 readout_time=0.005, noise_model=None, serial_number="simulated"):
+        super(SimulatedSpectrometer, self).__init__()
+        self.stage = stage
+        self.sample = sample if sample is not None else SyntheticSample.random()
+        self._wavelengths = wavelengths if wavelengths is not None else np.linspace(400, 1000, 1024)
+        self.spot_size = spot_size
+        self.readout_time = readout_time
+        self.noise_model = noise_model if noise_model is not None else NoiseModel()
+        self._model_name = "SimulatedSpectrometer"
+        self._serial_number = serial_number
+        self._integration_time = 10
+        self.spectra_acquired = 0
+
+    def get_serial_number(self):
+        return self._serial_number
+
+    serial_number = property(get_serial_number)
+
+    def get_integration_time(self):
+        """The integration time, in milliseconds."""
+        return self._integration_time
+
+    def set_integration_time(self, value):
+        self._integration_time = value
+
+    integration_time = property(get_integration_time, set_integration_time)
+
+    def get_wavelengths(self):
+        return self._wavelengths
+
+    wavelengths = property(get_wavelengths)
+
+    def sample_position(self):
+        """The position on the sample we're collecting from."""
+        if self.stage is None:
+            return np.zeros(3)
+        if hasattr(self.stage, "_true_position"):
+            return self.stage._true_position()  # avoid charging latency
+        return np.asarray(self.stage.position)
+
+    def simulate_spectrum(self, position=None, integration_time=None):
+        """Generate a spectrum at a given position, without waiting."""
+        if position is None:
+            position = self.sample_position()
+        if integration_time is None:
+            integration_time = self.integration_time
+        signal = self.sample.spectrum(position, self.wavelengths, self.spot_size)
+        self.spectra_acquired += 1
+        return self.noise_model.apply(signal * integration_time / 1000.0)
+
+    def read_spectrum(self, bundle_metadata=False):
+        """Wait for the integration and readout, then return a spectrum."""
+        start_position = self.sample_position()
+        time.sleep(self.integration_time / 1000.0)
+        position = (start_position + self.sample_position()) / 2.0  # crude motion averaging
+        time.sleep(self.readout_time)
+        self.latest_raw_spectrum = self.simulate_spectrum(position)
+        return self.bundle_metadata(self.latest_raw_spectrum, enable=bundle_metadata)
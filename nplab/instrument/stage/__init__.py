@@ -18,7 +18,9 @@ from nplab.ui.widgets.position_widgets import XYZPositionWidget
 import inspect
 from functools import partial
 from nplab.utils.formatting import engineering_format
+from nplab.utils import path_planning
 import collections
+import copy
 
 
 class Stage(Instrument):
@@ -38,8 +40,26 @@ class Stage(Instrument):
     
     In the future, a class factory method might be available, that will 
     simplify the emulation of various features.
+
+    Position caching and move completion
+    ------------------------------------
+    Reading the position usually means a round trip to the controller.  If
+    `position_cache_lifetime` is set (in seconds), `Stage.position` reuses a
+    reading that is younger than that, unless the stage has moved since.  For
+    this to work, drivers must call `self.begin_move()` when they start a
+    move (which also gives them a `MoveHandle` to return from
+    `move(..., wait=False)`), and `self.move_finished()` when it finishes.
+    Drivers that are told when a move has finished (e.g. by a status
+    callback from the controller) should set `signals_move_completion` so
+    that `wait_until_stopped` waits for `move_finished` instead of polling
+    `is_moving`.  If the driver knows where the stage stopped, it can pass
+    the position to `move_finished`, saving a round trip for the next read.
     """
     axis_names = ('x', 'y', 'z')
+    position_cache_lifetime = None # Maximum age (in seconds) of a cached position, None to disable the cache
+    signals_move_completion = False # Set to True if the driver calls move_finished() when moves finish
+    _position_cache = None # (position, time it was read, move count) or None
+    _move_count = 0 # incremented by every move, so readings that span a move aren't cached
     def __init__(self,unit = 'm'):
         Instrument.__init__(self)
         self.unit = unit
@@ -66,6 +86,66 @@ class Stage(Instrument):
         full_position[self.axis_names.index(axis)] = pos
         self.move(full_position, relative=relative, **kwargs)
 
+    def move_axes(self, positions, axes, relative=False):
+        """Move several axes, and wait until they have all stopped.
+
+        By default, this makes one move per axis, one after the other.  
+        Drivers that can move several axes at once should override it.
+        """
+        for position, axis in zip(positions, axes):
+            self.move(position, axis=axis, relative=relative)
+
+    def execute_trajectory(self, waypoints, axes=None, callback=None, dwell_time=0):
+        """Visit a list of positions in turn, optionally doing something at each one.
+
+        waypoints : array (n_points x n_axes)
+            The positions to visit, e.g. from `nplab.utils.path_planning.snake_raster`.
+        axes : list of str (optional)
+            The axes corresponding to the columns of `waypoints` (by default,
+            the first n_axes axes of the stage).
+        callback : function (optional)
+            Called as `callback(index, waypoint)` once the stage has stopped at
+            each waypoint.  The stage stays there until the callback returns;
+            if it returns False, the trajectory stops early.
+        dwell_time : float (optional)
+            Time (in seconds) to wait at each waypoint, before the callback.
+
+        Returns the number of waypoints visited.
+
+        This implementation emulates a trajectory by moving only the axes that 
+        change between successive waypoints (with `move_axes`), so it never 
+        needs to read the position.  Drivers whose controllers can buffer a 
+        trajectory, or start several axes with one command, should override it.
+        """
+        waypoints, axes = self._trajectory_waypoints(waypoints, axes)
+        previous = None
+        for i, waypoint in enumerate(waypoints):
+            changed = np.ones(len(axes), dtype=bool) if previous is None else waypoint != previous
+            if np.any(changed):
+                self.move_axes(waypoint[changed], [ax for ax, c in zip(axes, changed) if c])
+            previous = waypoint
+            if dwell_time > 0:
+                time.sleep(dwell_time)
+            if callback is not None and callback(i, waypoint) is False:
+                return i + 1
+        return len(waypoints)
+
+    def _trajectory_waypoints(self, waypoints, axes):
+        """Check the arguments to execute_trajectory, and return (waypoints, axes)."""
+        waypoints = np.asarray(waypoints, dtype=np.float64)
+        if waypoints.ndim == 1:
+            waypoints = waypoints[:, np.newaxis]
+        if axes is None:
+            axes = self.axis_names[:waypoints.shape[1]]
+        axes = list(axes)
+        if len(axes) != waypoints.shape[1]:
+            raise ValueError("Waypoints have {0} coordinates, but {1} axes were specified".format(
+                waypoints.shape[1], len(axes)))
+        for axis in axes:
+            if axis not in self.axis_names:
+                raise ValueError("{0} is not a valid axis, must be one of {1}".format(axis, self.axis_names))
+        return waypoints, axes
+
     def get_position(self, axis=None):
         raise NotImplementedError("You must override get_position in a Stage subclass.")
 
@@ -77,18 +157,107 @@ class Stage(Instrument):
     def _get_position_proxy(self):
         """Return self.get_position() (this is a convenience to avoid having
         to redefine the position property every time you subclass - don't call
-        it directly)"""
-        return self.get_position()
+        it directly).  The position may come from the cache, see 
+        `cached_position`."""
+        return self.cached_position()
     position = property(fget=_get_position_proxy, doc="Current position of the stage (all axes)")
 
+    def cached_position(self, axis=None, max_age=None):
+        """Return the position, reusing a recent reading if there is one.
+
+        A reading is reused if it is less than `max_age` seconds old (default
+        `position_cache_lifetime`) and the stage hasn't moved since.  If 
+        caching is disabled, this is the same as `get_position(axis)`.
+        """
+        if max_age is None:
+            max_age = self.position_cache_lifetime
+        if max_age is None:
+            return self.get_position(axis)
+        cache = self._position_cache
+        move_count = self._move_count
+        if cache is not None and cache[2] == move_count and time.time() - cache[1] <= max_age:
+            position = cache[0]
+        else:
+            read_time = time.time()
+            position = self.get_position()
+            self._store_position(position, read_time, move_count)
+        if axis is None:
+            return copy.copy(position)
+        elif isinstance(axis, collections.Sequence) and not isinstance(axis, str):
+            return [self.select_axis(position, ax) for ax in axis]
+        else:
+            return self.select_axis(position, axis)
+
+    def _store_position(self, position, read_time, move_count):
+        """Cache a position, unless the stage has moved since it was read."""
+        if move_count == self._move_count:
+            self._position_cache = (copy.copy(position), read_time, move_count)
+
+    def invalidate_position_cache(self):
+        """Make sure the next position reading comes from the stage."""
+        self._move_count += 1
+        self._position_cache = None
+
+    def begin_move(self, axes=None):
+        """Note that a move is starting, and return a `MoveHandle` for it.
+
+        Drivers should call this just before they tell the controller to 
+        move: it invalidates the position cache, and the handle can be
+        returned from `move(..., wait=False)`.
+        """
+        self.invalidate_position_cache()
+        handle = MoveHandle(self, axes)
+        # Moves that haven't finished yet will finish when this one does
+        self._pending_moves = [h for h in getattr(self, "_pending_moves", []) if not h.done] + [handle]
+        return handle
+
+    def move_finished(self, position=None):
+        """Signal that the stage has stopped: drivers call this when a move completes.
+
+        It is safe to call from any thread (e.g. a status callback).  If the 
+        final position is known, pass it in and it will be cached.
+        """
+        self.invalidate_position_cache()
+        if position is not None:
+            self._store_position(position, time.time(), self._move_count)
+        pending, self._pending_moves = getattr(self, "_pending_moves", []), []
+        for handle in pending:
+            handle._set_finished()
+
+    def plan_path(self, positions, velocity=None, **kwargs):
+        """Return a short order in which to visit `positions`, starting from here.
+
+        `positions` is an (n_points x n_axes) array, whose columns are the
+        first n_axes axes of the stage (e.g. just X and Y).  If `velocity`
+        (the maximum speed of each of those axes) is given, the path is
+        optimised for time rather than distance.  Other arguments are passed
+        to `nplab.utils.path_planning.plan_path`.
+        """
+        positions = np.asarray(positions, dtype=np.float64)
+        start = np.asarray(self.position, dtype=np.float64)[:positions.shape[1]]
+        return path_planning.plan_path(positions, start=start, velocity=velocity, **kwargs)
+
     def is_moving(self, axes=None):
         """Returns True if any of the specified axes are in motion."""
         raise NotImplementedError("The is_moving method must be subclassed and implemented before it's any use!")
 
-    def wait_until_stopped(self, axes=None):
-        """Block until the stage is no longer moving."""
+    def wait_until_stopped(self, axes=None, timeout=None):
+        """Block until the stage is no longer moving.
+
+        If the driver signals when moves finish, we wait for that, otherwise
+        we poll `is_moving`.  Returns False if we timed out.
+        """
+        if self.signals_move_completion:
+            for handle in list(getattr(self, "_pending_moves", [])):
+                if not handle.wait(timeout):
+                    return False
+            return True
+        expiry_time = None if timeout is None else time.time() + timeout
         while self.is_moving(axes=axes):
+            if expiry_time is not None and time.time() > expiry_time:
+                return False
             time.sleep(0.01)
+        return True
 
     def get_qt_ui(self):
         if self.unit =='m':
@@ -121,6 +290,49 @@ class Stage(Instrument):
     # TODO: stored dictionary of 'bookmarked' locations for fast travel
 
 
+class MoveHandle(object):
+    """A move that is (or was) in progress, as returned by `move(..., wait=False)`.
+
+    `wait()` blocks until the move has finished, and `done` says whether it
+    has.  If the stage signals when its moves finish (see 
+    `Stage.move_finished`), waiting doesn't talk to the stage at all;
+    otherwise, we poll `is_moving`.
+    """
+    poll_interval = 0.01
+
+    def __init__(self, stage, axes=None):
+        self.stage = stage
+        self.axes = axes
+        self.start_time = time.time()
+        self.finish_time = None
+        self._finished = threading.Event()
+
+    @property
+    def done(self):
+        """Whether the move has finished."""
+        return self._finished.is_set()
+
+    def _set_finished(self):
+        if not self._finished.is_set():
+            self.finish_time = time.time()
+            self._finished.set()
+
+    def wait(self, timeout=None):
+        """Wait for the move to finish, returning False if we time out."""
+        if self.stage.signals_move_completion:
+            self._finished.wait(timeout)
+            return self.done
+        expiry_time = None if timeout is None else time.time() + timeout
+        while not self.done:
+            if not self.stage.is_moving(axes=self.axes):
+                self._set_finished()
+            elif expiry_time is not None and time.time() > expiry_time:
+                return False
+            else:
+                time.sleep(self.poll_interval)
+        return True
+
+
 class PiezoStage(Stage):
 
     def __init__(self):
@@ -564,13 +776,19 @@ class DummyStage(Stage):
         self._position = np.zeros((len(self.axis_names)), dtype=np.float64)
         self.piezo_levels = [50,50,50,50,50,50]
 
-    def move(self, position, axis=None, relative=False):
+    signals_move_completion = True
+
+    def move(self, position, axis=None, relative=False, wait=True):
         def move_axis(position, axis):
             if relative:
                 self._position[self.axis_names.index(axis)] += position
             else:
                 self._position[self.axis_names.index(axis)] = position
+        handle = self.begin_move(axis)
         self.set_axis_param(move_axis, position, axis)
+        self.move_finished() # moves are instantaneous
+        if not wait:
+            return handle
         #i = self.axis_names.index(axis)
         #if relative:
         #    self._position[i] += position
@@ -584,8 +802,6 @@ class DummyStage(Stage):
     def get_position(self, axis=None):
         return self.get_axis_param(lambda axis: self._position[self.axis_names.index(axis)], axis)
 
-    position = property(get_position)
-
     def get_qt_ui(self):
         return PiezoStageUI(self,show_z_pos=False)
 
@@ -0,0 +1,227 @@
+"""
+Simulated Stage
+===============
+
+A stage that takes a realistic amount of time to move.  Unlike `DummyStage`,
+which teleports instantly, `SimulatedStage` follows a trapezoidal velocity
+profile on each axis, takes time to settle afterwards, and charges a
+round-trip delay for every call that would talk to a real controller.  It
+is meant for benchmarking scans and autofocus routines without hardware;
+pair it with `SimulatedCamera` and `SimulatedSpectrometer`.
+"""
+
+import time
+import threading
+import numpy as np
+from nplab.instrument.stage import Stage
+
+
+def trapezoidal_move_time(distance, velocity, acceleration):
+    """Time taken to travel `distance` from rest to rest (element-wise)."""
+    distance = np.abs(distance)
+    ramp_distance = velocity**2 / acceleration  # distance spent accelerating + decelerating
+    return np.where(distance < ramp_distance,
+                    2 * np.sqrt(distance / acceleration),
+                    distance / velocity + velocity / acceleration)
+
+
+def trapezoidal_position(start, end, elapsed, velocity, acceleration):
+    """Position (element-wise) at time `elapsed` after starting a trapezoidal move."""
+    distance = np.abs(end - start)
+    direction = np.sign(end - start)
+    total = trapezoidal_move_time(distance, velocity, acceleration)
+    t = np.clip(elapsed, 0, total)
+    v_peak = np.minimum(velocity, np.sqrt(distance * acceleration))
+    t_ramp = v_peak / acceleration
+    t_cruise = total - 2 * t_ramp
+    accel_part = 0.5 * acceleration * np.minimum(t, t_ramp)**2
+    cruise_part = v_peak * np.clip(t - t_ramp, 0, t_cruise)
+    t_decel = np.clip(t - t_ramp - t_cruise, 0, t_ramp)
+    decel_part = v_peak * t_decel - 0.5 * acceleration * t_decel**2
+    return start + direction * (accel_part + cruise_part + decel_part)
+
+
+class SimulatedStage(Stage):
+    """A stage with finite velocity, acceleration, settling time and latency.
+
+    Attributes:
+    velocity : array
+        Maximum speed of each axis (units per second).
+    acceleration : array
+        Acceleration of each axis (units per second squared).
+    settling_time : float
+        Time after arriving at the target before the stage reports that it
+        has stopped moving.
+    communication_latency : float
+        Time taken by each call that talks to the "controller" (reading the
+        position, starting a move, polling `is_moving`).
+    round_trips : int
+        The number of such calls made so far - useful for benchmarking.
+    signals_move_completion : bool
+        If True (the default), the "controller" tells us when each move has
+        settled, like a status callback, so waiting for a move costs no
+        round trips.  If False, `wait_until_stopped` polls `is_moving`.
+    position_cache_lifetime : float or None
+        See `Stage.cached_position`.
+
+    `move(..., wait=False)` returns a `MoveHandle` straight away.
+    """
+    def __init__(self, axis_names=('x', 'y', 'z'), velocity=1000.0, acceleration=1e4,
+                 settling_time=0.02, communication_latency=0.002, unit='u',
+                 signals_move_completion=True, position_cache_lifetime=None):
+        super(SimulatedStage, self).__init__(unit=unit)
+        self.signals_move_completion = signals_move_completion
+        self.position_cache_lifetime = position_cache_lifetime
+        self.axis_names = tuple(axis_names)
+        n = len(self.axis_names)
+        self.velocity = np.ones(n) * velocity
+        self.acceleration = np.ones(n) * acceleration
+        self.settling_time = settling_time
+        self.communication_latency = communication_latency
+        self.round_trips = 0
+        self._lock = threading.Lock()
+        self._start = np.zeros(n)
+        self._target = np.zeros(n)
+        self._move_started = 0.0
+        self._move_duration = 0.0
+        self._move_profile = (self.velocity.copy(), self.acceleration.copy())  # for the current move
+        self._completion_timer = None
+        self._current_move = None
+
+    def _communicate(self):
+        """Pretend to talk to the controller."""
+        self.round_trips += 1
+        if self.communication_latency > 0:
+            time.sleep(self.communication_latency)
+
+    def _true_position(self, t=None):
+        """The position of the stage at time `t` (default: now), without latency."""
+        if t is None:
+            t = time.time()
+        with self._lock:
+            velocity, acceleration = self._move_profile
+            return trapezoidal_position(self._start, self._target, t - self._move_started,
+                                        velocity, acceleration)
+
+    def _axis_indices(self, axis):
+        """Return a list of indices corresponding to an axis name or list of names."""
+        if axis is None:
+            return list(range(len(self.axis_names)))
+        if isinstance(axis, str):
+            axis = [axis]
+        for ax in axis:
+            if ax not in self.axis_names:
+                raise ValueError("{0} is not a valid axis, must be one of {1}".format(ax, self.axis_names))
+        return [self.axis_names.index(ax) for ax in axis]
+
+    def move(self, position, axis=None, relative=False, wait=True):
+        """Move the stage, and (by default) wait until it has settled.
+
+        Moves may be interrupted: a new move starts from wherever the stage
+        is at the time (for simplicity, we assume it starts from rest).  If
+        `wait` is False, return a `MoveHandle` without waiting.
+        """
+        handle = self.begin_move(axis)
+        self._communicate()
+        position = np.atleast_1d(np.asarray(position, dtype=np.float64))
+        if axis is None and position.size > 1:
+            indices = list(range(position.size))  # allow moves in e.g. just X and Y
+        else:
+            indices = self._axis_indices(axis)
+        self._start_move(position, indices, relative, handle)
+        if wait:
+            self.wait_until_stopped()
+        else:
+            return handle
+
+    def _start_move(self, position, indices, relative, handle):
+        """Start moving the axes with the given indices (this is the controller's side of a move)."""
+        now = time.time()
+        current = self._true_position(now)
+        target = current.copy() if relative else self._target.copy()
+        if relative:
+            target[indices] += np.broadcast_to(position, (len(indices),))
+        else:
+            target[indices] = np.broadcast_to(position, (len(indices),))
+        with self._lock:
+            self._start = current
+            self._target = target
+            self._move_started = now
+            # Changing velocity or acceleration affects the next move, not this one
+            self._move_profile = (self.velocity.copy(), self.acceleration.copy())
+            self._move_duration = np.max(trapezoidal_move_time(target - current, self.velocity,
+                                                               self.acceleration))
+            # The controller reports (with the final position) once the move has settled
+            self._current_move = handle
+            if self._completion_timer is not None:
+                self._completion_timer.cancel()
+            self._completion_timer = threading.Timer(self._move_duration + self.settling_time,
+                                                     self._report_move_finished, (handle, target))
+            self._completion_timer.daemon = True
+            self._completion_timer.start()
+
+    def move_axes(self, positions, axes, relative=False):
+        """Move several axes at once, with one command."""
+        self.move(positions, axis=axes, relative=relative)
+
+    def execute_trajectory(self, waypoints, axes=None, callback=None, dwell_time=0):
+        """Visit a list of positions in turn, like `Stage.execute_trajectory`.
+
+        The whole trajectory is sent to the (simulated) controller in one go.
+        Without a callback, the controller runs through it by itself, so it
+        takes just one round trip.  With a callback, the controller pauses at
+        each waypoint until the host tells it to carry on, once the callback
+        has returned (one round trip per waypoint).
+        """
+        waypoints, axes = self._trajectory_waypoints(waypoints, axes)
+        indices = self._axis_indices(axes)
+        self._communicate()  # upload the trajectory
+        for i, waypoint in enumerate(waypoints):
+            if i > 0 and callback is not None:
+                self._communicate()  # carry on to the next waypoint
+            self._start_move(waypoint, indices, False, self.begin_move(axes))
+            self.wait_until_stopped()
+            if dwell_time > 0:
+                time.sleep(dwell_time)
+            if callback is not None and callback(i, waypoint) is False:
+                return i + 1
+        return len(waypoints)
+
+    def _report_move_finished(self, handle, position):
+        """Called from a timer thread when a move has settled."""
+        with self._lock:
+            if handle is not self._current_move:
+                return # another move has started since
+        self.move_finished(position)
+
+    def get_position(self, axis=None):
+        self._communicate()
+        position = self._true_position()
+        if axis is None:
+            return position
+        elif isinstance(axis, str):
+            return position[self.axis_names.index(axis)]
+        else:
+            return position[self._axis_indices(axis)]
+
+    def time_until_stopped(self):
+        """The time until the current move finishes and settles (no latency)."""
+        with self._lock:
+            end = self._move_started + self._move_duration + self.settling_time
+        return max(end - time.time(), 0)
+
+    def is_moving(self, axes=None):
+        """Whether the stage is moving or settling."""
+        self._communicate()
+        return self.time_until_stopped() > 0
+
+    def wait_until_stopped(self, axes=None, timeout=None):
+        """Block until the stage has stopped and settled."""
+        if self.signals_move_completion:
+            return super(SimulatedStage, self).wait_until_stopped(axes, timeout)
+        # A real controller would be polled; we know when it will stop, so we
+        # sleep until then and make the final poll.
+        time.sleep(self.time_until_stopped())
+        while self.is_moving(axes=axes):
+            time.sleep(0.001)
+        return True
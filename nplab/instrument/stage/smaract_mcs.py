@@ -460,9 +460,10 @@ class SmaractMCS(PiezoStage):
             raise SmaractError('Unknown return value')
 
     def multi_move(self, positions, axes, relative=False): #?? doesn't this method include the simple move() method??
+        """Move several channels at once: every channel is started before we wait for any of them."""
         self.check_open_status()
 
-        positions = [c_int(1e9 * p) for p in positions]
+        positions = [c_int(int(1e9 * p)) for p in positions]
         channels = [c_int(int(axis)) for axis in axes]
 
         for i in range(len(axes)):
@@ -474,9 +475,13 @@ class SmaractMCS(PiezoStage):
             self.wait_until_stopped(axis)
 
     def multi_move_rel(self, step, axes):
-        steps = [1e9 * step for axis in axes]
+        steps = [step for axis in axes] # multi_move converts to nm
         self.multi_move(steps, axes, relative=True)
 
+    def move_axes(self, positions, axes, relative=False):
+        """Move several axes at once (see `Stage.move_axes`)."""
+        self.multi_move(positions, axes, relative=relative)
+
 
     ### ==================================== ###
     ### Method to control slip-stick motion ###
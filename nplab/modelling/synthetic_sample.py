@@ -0,0 +1,164 @@
+"""
+Synthetic Sample
+================
+
+A simple model of a microscope sample, used by the simulated instruments
+(`SimulatedCamera`, `SimulatedSpectrometer` and `SimulatedStage`) so that
+scans and acquisitions can be run, and timed, without any hardware.
+
+The sample is a collection of Gaussian particles lying in a plane.  Each
+particle has a spectrum made up of a few Lorentzian peaks.  Coordinates are in
+the same units as the stage that is used to look at the sample.
+"""
+
+import numpy as np
+
+
+class NoiseModel(object):
+    """Detector noise: dark level, shot noise and read noise.
+
+    Signals are in photoelectrons; `apply` returns counts after `gain`.
+    """
+    def __init__(self, dark_level=10.0, read_noise=2.0, shot_noise=True, gain=1.0, seed=None):
+        self.dark_level = dark_level
+        self.read_noise = read_noise
+        self.shot_noise = shot_noise
+        self.gain = gain
+        self.random_state = np.random.RandomState(seed)
+
+    def apply(self, signal):
+        """Return a noisy version of `signal` (which is not modified)."""
+        signal = np.clip(signal, 0, None) + self.dark_level
+        if self.shot_noise:
+            signal = self.random_state.poisson(signal).astype(np.float64)
+        if self.read_noise > 0:
+            signal = signal + self.random_state.normal(scale=self.read_noise, size=signal.shape)
+        return signal * self.gain
+
+
+class SyntheticSample(object):
+    """A plane of Gaussian particles, each with a spectrum of Lorentzian peaks.
+
+    Arguments:
+    positions : (N, 2) array
+        The x, y positions of the particles.
+    widths : (N,) array
+        The standard deviation of each particle's (in-focus) image.
+    brightness : (N,) array
+        The peak brightness of each particle, in photoelectrons per second.
+    peak_centres, peak_widths, peak_amplitudes : (N, M) arrays
+        Each particle's spectrum is the sum of M Lorentzian peaks.
+    focal_z : float
+        The stage Z position at which the sample is in focus.
+    defocus_blur : float
+        How quickly the particles blur as we move away from focus (the extra
+        width per unit of defocus).
+    background : float
+        A uniform background level (photoelectrons per second).
+    """
+    def __init__(self, positions, widths, brightness,
+                 peak_centres, peak_widths, peak_amplitudes,
+                 focal_z=0.0, defocus_blur=1.0, background=0.0):
+        self.positions = np.asarray(positions, dtype=np.float64).reshape(-1, 2)
+        n = self.positions.shape[0]
+        self.widths = np.broadcast_to(np.asarray(widths, dtype=np.float64), (n,))
+        self.brightness = np.broadcast_to(np.asarray(brightness, dtype=np.float64), (n,))
+        self.peak_centres = np.asarray(peak_centres, dtype=np.float64).reshape(n, -1)
+        self.peak_widths = np.broadcast_to(np.asarray(peak_widths, dtype=np.float64),
+                                           self.peak_centres.shape)
+        self.peak_amplitudes = np.broadcast_to(np.asarray(peak_amplitudes, dtype=np.float64),
+                                               self.peak_centres.shape)
+        self.focal_z = focal_z
+        self.defocus_blur = defocus_blur
+        self.background = background
+
+    @classmethod
+    def random(cls, n_particles=200, field_size=(100.0, 100.0), particle_width=0.3,
+               brightness=(2e4, 1e5), wavelength_range=(500.0, 900.0),
+               n_peaks=2, peak_width=(10.0, 40.0), seed=None, **kwargs):
+        """Create a sample with particles scattered at random.
+
+        Particles are placed uniformly over `field_size` (centred on the
+        origin), with brightnesses and peak widths drawn uniformly from the
+        given ranges.  Other keyword arguments are passed to the constructor.
+        """
+        rs = np.random.RandomState(seed)
+        field_size = np.asarray(field_size, dtype=np.float64)
+        positions = (rs.random_sample((n_particles, 2)) - 0.5) * field_size
+        return cls(positions=positions,
+                   widths=particle_width,
+                   brightness=rs.uniform(brightness[0], brightness[1], n_particles),
+                   peak_centres=rs.uniform(wavelength_range[0], wavelength_range[1],
+                                           (n_particles, n_peaks)),
+                   peak_widths=rs.uniform(peak_width[0], peak_width[1], (n_particles, n_peaks)),
+                   peak_amplitudes=rs.uniform(0.2, 1.0, (n_particles, n_peaks)),
+                   **kwargs)
+
+    def effective_widths(self, z):
+        """The width of each particle's image when the stage is at height z."""
+        defocus = self.defocus_blur * (z - self.focal_z)
+        return np.sqrt(self.widths**2 + defocus**2)
+
+    def render(self, centre, shape, pixel_size):
+        """Return an image (photoelectrons per second) of the sample.
+
+        Arguments:
+        centre : (x, y) or (x, y, z)
+            The sample position at the centre of the image.  If z is given,
+            particles are blurred according to how far out of focus they are.
+        shape : (rows, columns)
+            The size of the image.  Columns run along x, rows along y.
+        pixel_size : float
+            The distance in the sample that corresponds to one pixel.
+        """
+        centre = np.asarray(centre, dtype=np.float64)
+        z = centre[2] if centre.size > 2 else self.focal_z
+        rows, cols = shape
+        x = centre[0] + (np.arange(cols) - cols / 2.0) * pixel_size
+        y = centre[1] + (np.arange(rows) - rows / 2.0) * pixel_size
+        sigma = self.effective_widths(z)
+        # Conserve each particle's integrated brightness as it blurs
+        amplitude = self.brightness * (self.widths / sigma)**2
+        # Only render particles that can affect the field of view
+        margin = 4 * sigma
+        visible = ((self.positions[:, 0] > x[0] - margin) & (self.positions[:, 0] < x[-1] + margin) &
+                   (self.positions[:, 1] > y[0] - margin) & (self.positions[:, 1] < y[-1] + margin))
+        image = np.empty((rows, cols), dtype=np.float64)
+        image.fill(self.background)
+        if np.any(visible):
+            p, s, a = self.positions[visible], sigma[visible], amplitude[visible]
+            gx = np.exp(-(x[np.newaxis, :] - p[:, 0:1])**2 / (2 * s[:, np.newaxis]**2))
+            gy = np.exp(-(y[np.newaxis, :] - p[:, 1:2])**2 / (2 * s[:, np.newaxis]**2))
+            image += np.dot(gy.T, a[:, np.newaxis] * gx)  # separable Gaussians
+        return image
+
+    def particle_spectra(self, wavelengths, particles=slice(None)):
+        """Return an (N, len(wavelengths)) array with each particle's spectrum.
+
+        `particles` may be an index or boolean mask to select some particles.
+        """
+        wavelengths = np.asarray(wavelengths, dtype=np.float64)
+        centres = self.peak_centres[particles, :, np.newaxis]
+        hw = self.peak_widths[particles, :, np.newaxis] / 2.0
+        d = wavelengths[np.newaxis, np.newaxis, :] - centres
+        lorentzians = self.peak_amplitudes[particles, :, np.newaxis] * hw**2 / (d**2 + hw**2)
+        return np.sum(lorentzians, axis=1)
+
+    def spectrum(self, position, wavelengths, spot_size=0.5):
+        """Return the spectrum (photoelectrons per second) collected at a position.
+
+        The collection spot is Gaussian, with standard deviation `spot_size`.
+        If `position` includes a z coordinate, defocus spreads each particle
+        out, reducing the light collected from it.
+        """
+        position = np.asarray(position, dtype=np.float64)
+        z = position[2] if position.size > 2 else self.focal_z
+        sigma2 = self.effective_widths(z)**2 + spot_size**2
+        r2 = np.sum((self.positions - position[np.newaxis, :2])**2, axis=1)
+        weights = self.brightness * self.widths**2 / sigma2 * np.exp(-r2 / (2 * sigma2))
+        spectrum = np.empty(np.shape(wavelengths), dtype=np.float64)
+        spectrum.fill(self.background)
+        nearby = np.nonzero(weights > 1e-6 * weights.max())[0] if weights.size else []
+        if len(nearby) > 0:
+            spectrum += np.dot(weights[nearby], self.particle_spectra(wavelengths, nearby))
+        return spectrum
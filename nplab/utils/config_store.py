@@ -0,0 +1,185 @@
+"""
+Configuration Store
+===================
+
+Instruments often want to remember a few arrays between sessions (for example
+a spectrometer's background and reference).  Writing these straight into an
+open HDF5 file is slow, blocks the GUI thread, and breaks when two processes
+use the same instrument class.  A `ConfigStore` keeps the values in memory,
+loads the file lazily the first time a value is needed, and writes the whole
+store out atomically (to a temporary file that is then renamed over the old
+one) from a background thread, a short time after the last change.
+
+Stores are shared between instances that use the same file, so the usual way
+to get one is with `get_config_store`.
+"""
+
+import os
+import atexit
+import datetime
+import threading
+import logging
+import h5py
+import numpy as np
+
+LOGGER = logging.getLogger('nplab.utils.config_store')
+
+_stores = {}
+_stores_lock = threading.Lock()
+
+
+def _replace_file(source, destination):
+    """Atomically move `source` over `destination` (os.replace is Python 3 only)."""
+    try:
+        os.replace(source, destination)
+    except AttributeError:
+        if os.name == 'nt' and os.path.exists(destination):
+            os.remove(destination)  # rename can't overwrite on Windows
+        os.rename(source, destination)
+
+
+class ConfigStore(object):
+    """A small keyed store of arrays, persisted to an HDF5 file.
+
+    Values are read from the file the first time they are needed.  Calls to
+    `set` update the in-memory copy and schedule a write after `delay`
+    seconds; further changes within that window are written together.
+    """
+    def __init__(self, filename, delay=0.5, legacy_filename=None):
+        """Create a store backed by `filename`.
+
+        :param delay: time (in seconds) to wait after a change before writing.
+        :param legacy_filename: a file to read initial values from if
+            `filename` does not exist yet (e.g. an old, shared `config.h5`).
+        """
+        self.filename = filename
+        self.legacy_filename = legacy_filename
+        self.delay = delay
+        self._data = None
+        self._lock = threading.RLock()
+        self._write_lock = threading.Lock()
+        self._timer = None
+        self._dirty = False
+
+    def _load(self):
+        """Read the file into memory, if we haven't done so already."""
+        with self._lock:
+            if self._data is not None:
+                return self._data
+            self._data = {}
+            for fname in (self.filename, self.legacy_filename):
+                if fname is None or not os.path.isfile(fname):
+                    continue
+                try:
+                    with h5py.File(fname, 'r') as f:
+                        for key, dset in f.items():
+                            if isinstance(dset, h5py.Dataset):
+                                self._data[key] = dset[()]
+                    break
+                except (IOError, OSError) as e:
+                    LOGGER.warn("Could not read config file {0}: {1}".format(fname, e))
+            return self._data
+
+    def __contains__(self, key):
+        return key in self._load()
+
+    def __getitem__(self, key):
+        return np.asarray(self._load()[key])
+
+    def __setitem__(self, key, value):
+        self.set(key, value)
+
+    def keys(self):
+        return list(self._load().keys())
+
+    def get(self, key, default=None):
+        """Return the value stored under `key`, or `default` if there isn't one."""
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def set(self, key, value):
+        """Store a value and schedule a (debounced) write to disk."""
+        if value is None:
+            return self.remove(key)
+        with self._lock:
+            self._load()[key] = np.array(value)  # copy, so later changes don't leak in
+            self._schedule_write()
+
+    def update(self, values):
+        """Store several values at once, with a single write to disk."""
+        with self._lock:
+            for key, value in values.items():
+                if value is None:
+                    self._load().pop(key, None)
+                else:
+                    self._load()[key] = np.array(value)
+            self._schedule_write()
+
+    def remove(self, key):
+        """Delete a value from the store."""
+        with self._lock:
+            if self._load().pop(key, None) is not None:
+                self._schedule_write()
+
+    def _schedule_write(self):
+        """(Re)start the timer that writes the store to disk."""
+        self._dirty = True
+        if self._timer is not None:
+            self._timer.cancel()
+        self._timer = threading.Timer(self.delay, self.flush)
+        self._timer.daemon = True
+        self._timer.start()
+
+    def flush(self):
+        """Write the store to disk now, if there are unsaved changes.
+
+        The data are written to a temporary file in the same folder, which is
+        then renamed over the old file, so readers never see a partial file.
+        """
+        with self._write_lock:
+            with self._lock:
+                if self._timer is not None:
+                    self._timer.cancel()
+                    self._timer = None
+                if not self._dirty:
+                    return
+                snapshot = dict(self._data)
+                self._dirty = False
+            tmp_filename = "{0}.{1}.tmp".format(self.filename, os.getpid())
+            try:
+                with h5py.File(tmp_filename, 'w') as f:
+                    f.attrs['date'] = datetime.datetime.now().strftime("%H:%M %d/%m/%y")
+                    for key, value in snapshot.items():
+                        f.create_dataset(key, data=value)
+                _replace_file(tmp_filename, self.filename)
+            except (IOError, OSError) as e:
+                LOGGER.error("Could not write config file {0}: {1}".format(self.filename, e))
+                with self._lock:
+                    self._dirty = True  # try again next time
+
+    def close(self):
+        """Write any pending changes to disk."""
+        self.flush()
+
+
+def get_config_store(folder, namespace, legacy_filename=None):
+    """Return the shared `ConfigStore` for `namespace`, stored in `folder`.
+
+    The namespace (usually the instrument class and serial number) sets the
+    file name, so different instruments never write to the same file.
+    """
+    safe_name = "".join(c if c.isalnum() or c in "-_." else "_" for c in namespace)
+    filename = os.path.join(folder, "{0}_config.h5".format(safe_name))
+    with _stores_lock:
+        if filename not in _stores:
+            _stores[filename] = ConfigStore(filename, legacy_filename=legacy_filename)
+        return _stores[filename]
+
+
+@atexit.register
+def _flush_all_stores():
+    """Make sure nothing is lost if Python exits during the debounce delay."""
+    for store in list(_stores.values()):
+        store.flush()
@@ -0,0 +1,299 @@
+"""
+Frame Buffers
+=============
+
+Cameras produce frames faster than some consumers (a preview window, a
+writer saving to disk) can deal with them, and at irregular times.  A
+`FrameRingBuffer` holds the last N frames in one preallocated array, each
+tagged with a monotonically increasing sequence number and a timestamp.
+Producers write straight into the next slot (so a camera driver can read
+data directly into it) and then commit it; consumers ask for everything
+since the last sequence number they saw, and are told how many frames they
+missed if they fell too far behind.
+
+Each consumer uses a `FrameBufferReader` to keep track of where it has got
+to.  `FrameSpooler` is one such consumer: it runs in a background thread and
+appends frames from a ring buffer to a chunked, resizable HDF5 dataset, so
+that acquisitions longer than will fit in memory can be saved.
+"""
+
+import time
+import threading
+import logging
+import numpy as np
+
+LOGGER = logging.getLogger('nplab.utils.frame_buffer')
+
+
+class FrameRingBuffer(object):
+    """A fixed number of preallocated frames, with sequence numbers and timestamps.
+
+    There should be only one producer, which either calls `put(frame)` or
+    writes into `writable_frame()` and then calls `commit_frame()`.  Any
+    number of threads may read frames with `get_frames_since`, or more
+    conveniently with a `FrameBufferReader`.  Sequence numbers start from
+    `first_sequence_number`, so that a replacement buffer (e.g. after the
+    frame size changes) can carry on where an old one left off.
+
+    Reading does not block the producer: frames are copied without holding
+    the lock, and any that were overwritten while being copied are reported
+    as dropped rather than returned.
+    """
+    def __init__(self, length, frame_shape, dtype=np.uint8, first_sequence_number=0):
+        self.frames = np.zeros((length,) + tuple(frame_shape), dtype=dtype)
+        self.sequence_numbers = np.empty(length, dtype=np.int64)
+        self.sequence_numbers.fill(-1)
+        self.timestamps = np.zeros(length, dtype=np.float64)
+        self._first_sequence_number = first_sequence_number
+        self._next_sequence_number = first_sequence_number  # the frame being/to be written
+        self._condition = threading.Condition()
+
+    @property
+    def length(self):
+        """The number of frames the buffer can hold."""
+        return self.frames.shape[0]
+
+    @property
+    def frame_shape(self):
+        return self.frames.shape[1:]
+
+    @property
+    def dtype(self):
+        return self.frames.dtype
+
+    @property
+    def latest_sequence_number(self):
+        """The sequence number of the most recent frame (-1 if there are none yet)."""
+        with self._condition:
+            return self._next_sequence_number - 1
+
+    def writable_frame(self):
+        """Return the slot that the next frame should be written into.
+
+        The slot's previous contents are discarded straight away, so readers
+        will never see a partly-written frame.  Call `commit_frame` once the
+        data are in place.
+        """
+        with self._condition:
+            index = self._next_sequence_number % self.length
+            self.sequence_numbers[index] = -1
+            return self.frames[index]
+
+    def commit_frame(self, timestamp=None):
+        """Publish the frame in `writable_frame()`, and return its sequence number."""
+        with self._condition:
+            sequence_number = self._next_sequence_number
+            index = sequence_number % self.length
+            self.sequence_numbers[index] = sequence_number
+            self.timestamps[index] = time.time() if timestamp is None else timestamp
+            self._next_sequence_number += 1
+            self._condition.notify_all()
+        return sequence_number
+
+    def put(self, frame, timestamp=None):
+        """Copy a frame into the buffer, and return its sequence number."""
+        self.writable_frame()[...] = frame
+        return self.commit_frame(timestamp)
+
+    def wait_for_frames(self, sequence_number, timeout=None):
+        """Wait until there is a frame newer than `sequence_number`.
+
+        Returns True if there is one, or False if we timed out.
+        """
+        expiry_time = None if timeout is None else time.time() + timeout
+        with self._condition:
+            while self._next_sequence_number - 1 <= sequence_number:
+                remaining = None if expiry_time is None else expiry_time - time.time()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._condition.wait(remaining)
+            return True
+
+    def get_frames_since(self, sequence_number=-1, max_frames=None):
+        """Return copies of the frames that arrived after `sequence_number`.
+
+        Returns a tuple of (frames, sequence_numbers, timestamps, n_dropped),
+        where `n_dropped` is the number of frames that were overwritten before
+        they could be read.  Pass the last element of `sequence_numbers` (or
+        `sequence_number + n_dropped` if no frames were returned) as
+        `sequence_number` next time to receive each frame exactly once.  If
+        `max_frames` is given, at most that many (of the oldest) frames are
+        returned and the rest remain in the buffer.
+        """
+        with self._condition:
+            latest = self._next_sequence_number - 1
+            first = max(sequence_number + 1, latest - self.length + 1, self._first_sequence_number)
+        last = latest if max_frames is None else min(latest, first + max_frames - 1)
+        sequence_numbers = np.arange(first, last + 1, dtype=np.int64)
+        indices = sequence_numbers % self.length
+        frames = self.frames[indices]  # fancy indexing copies, without holding the lock
+        timestamps = self.timestamps[indices]
+        with self._condition:
+            # Any frame that has had its slot reused since we started may be corrupted
+            valid = self.sequence_numbers[indices] == sequence_numbers
+        if not np.all(valid):
+            n_invalid = np.count_nonzero(~valid)  # slots are reused oldest-first
+            frames, sequence_numbers, timestamps = (frames[n_invalid:], sequence_numbers[n_invalid:],
+                                                    timestamps[n_invalid:])
+        n_dropped = (sequence_numbers[0] if len(sequence_numbers) > 0 else last + 1) - (sequence_number + 1)
+        return frames, sequence_numbers, timestamps, max(int(n_dropped), 0)
+
+    def latest_frame(self):
+        """Return a copy of the most recent frame (or None), with its sequence number and timestamp."""
+        frames, sequence_numbers, timestamps, n_dropped = self.get_frames_since(self.latest_sequence_number - 1)
+        if len(sequence_numbers) == 0:
+            return None, -1, None
+        return frames[-1], sequence_numbers[-1], timestamps[-1]
+
+
+class FrameBufferReader(object):
+    """One consumer of the frames in a `FrameRingBuffer`.
+
+    Each call to `read` returns the frames that have arrived since the last
+    one, so every frame is seen once; frames that were overwritten before
+    they could be read are counted in `frames_dropped`.  Several readers
+    (e.g. a preview, a video recorder and an autofocus routine) can consume
+    the same buffer independently.
+
+    `ring_buffer` may also be a function returning the current buffer (or
+    None), for sources that replace their buffer from time to time.
+    """
+    def __init__(self, ring_buffer, start_after=None):
+        self._ring_buffer = ring_buffer
+        self.frames_read = 0
+        self.frames_dropped = 0
+        if start_after is None:
+            buf = self.ring_buffer
+            start_after = -1 if buf is None else buf.latest_sequence_number
+        self.last_sequence_number = start_after
+
+    @property
+    def ring_buffer(self):
+        """The buffer we are reading from (None if there isn't one yet)."""
+        if callable(self._ring_buffer):
+            return self._ring_buffer()
+        return self._ring_buffer
+
+    @property
+    def frames_waiting(self):
+        """The number of frames that have arrived but not yet been read."""
+        buf = self.ring_buffer
+        if buf is None:
+            return 0
+        return max(buf.latest_sequence_number - self.last_sequence_number, 0)
+
+    def wait(self, n_frames=1, timeout=None):
+        """Wait until at least `n_frames` frames are waiting to be read.
+
+        Returns True if they are, or False if we timed out.
+        """
+        expiry_time = None if timeout is None else time.time() + timeout
+        while True:
+            remaining = None if expiry_time is None else expiry_time - time.time()
+            buf = self.ring_buffer
+            if buf is not None:
+                # Wait in short steps, in case the buffer is replaced
+                step = 0.1 if remaining is None else min(remaining, 0.1)
+                if buf.wait_for_frames(self.last_sequence_number + n_frames - 1, timeout=max(step, 0)):
+                    return True
+            elif remaining is None or remaining > 0:
+                time.sleep(0.01)
+            if remaining is not None and remaining <= 0:
+                return False
+
+    def read(self, max_frames=None, timeout=0):
+        """Return (frames, sequence_numbers, timestamps) for the frames since the last read.
+
+        If there are no new frames, wait up to `timeout` seconds (None waits
+        forever) for one to arrive.  If `max_frames` is given, the oldest
+        `max_frames` frames are returned and the rest are left for next time.
+        """
+        if timeout != 0:
+            self.wait(1, timeout=timeout)
+        buf = self.ring_buffer
+        if buf is None:
+            return np.zeros((0,)), np.zeros((0,), dtype=np.int64), np.zeros((0,))
+        frames, sequence_numbers, timestamps, n_dropped = buf.get_frames_since(self.last_sequence_number,
+                                                                               max_frames=max_frames)
+        if n_dropped > 0:
+            self.frames_dropped += n_dropped
+            self.last_sequence_number += n_dropped
+        if len(sequence_numbers) > 0:
+            self.frames_read += len(sequence_numbers)
+            self.last_sequence_number = sequence_numbers[-1]
+        return frames, sequence_numbers, timestamps
+
+
+class FrameSpooler(threading.Thread):
+    """Save frames from a `FrameRingBuffer` to HDF5, in a background thread.
+
+    Frames are appended to a resizable dataset called "frames" in
+    `data_group`, with chunks of `chunk_frames` frames, and their timestamps
+    to a dataset called "timestamps".  Call `stop()` once the producer has
+    finished: the spooler then saves whatever is left in the buffer and
+    finishes.  Frames dropped because the spooler fell behind are counted in
+    `frames_dropped` (and saved as an attribute of the dataset).
+
+    `transform`, if given, is applied to each block of frames before saving
+    (it must not change their shape).
+    """
+    def __init__(self, ring_buffer, data_group, chunk_frames=16, compression=None,
+                 transform=None, attrs=None):
+        super(FrameSpooler, self).__init__()
+        self.daemon = True
+        self.ring_buffer = ring_buffer
+        self.chunk_frames = chunk_frames
+        self.transform = transform
+        self.frames_written = 0
+        self.reader = FrameBufferReader(ring_buffer)
+        self._stop_event = threading.Event()
+        shape = ring_buffer.frame_shape
+        self.dataset = data_group.create_dataset("frames", shape=(0,) + shape, maxshape=(None,) + shape,
+                                                 chunks=(chunk_frames,) + shape, dtype=ring_buffer.dtype,
+                                                 compression=compression, auto_increment=False,
+                                                 attrs=attrs, autoflush=False)
+        self.timestamps = data_group.create_dataset("timestamps", shape=(0,), maxshape=(None,),
+                                                    chunks=(max(chunk_frames, 1024),), dtype=np.float64,
+                                                    auto_increment=False, autoflush=False)
+
+    def stop(self, wait=True):
+        """Save any remaining frames, then stop the thread."""
+        self._stop_event.set()
+        if wait:
+            self.join()
+
+    def _write(self, frames, timestamps):
+        n = self.frames_written
+        if self.transform is not None:
+            frames = self.transform(frames)
+        self.dataset.resize(n + len(frames), axis=0)
+        self.dataset[n:n + len(frames), ...] = frames
+        self.timestamps.resize(n + len(frames), axis=0)
+        self.timestamps[n:n + len(frames)] = timestamps
+        self.frames_written += len(frames)
+
+    @property
+    def frames_dropped(self):
+        return self.reader.frames_dropped
+
+    def _save_available_frames(self, max_frames):
+        frames_dropped = self.reader.frames_dropped
+        frames, sequence_numbers, timestamps = self.reader.read(max_frames=max_frames)
+        if self.reader.frames_dropped > frames_dropped:
+            LOGGER.warning("Dropped %d frames while spooling to %s" % (self.reader.frames_dropped - frames_dropped,
+                                                                       self.dataset.name))
+        if len(sequence_numbers) > 0:
+            self._write(frames, timestamps)
+        return len(sequence_numbers)
+
+    def run(self):
+        try:
+            while not self._stop_event.is_set():
+                # Write whole chunks where we can, it's much more efficient
+                if self.reader.wait(self.chunk_frames, timeout=0.1):
+                    self._save_available_frames(self.chunk_frames)
+            while self._save_available_frames(self.chunk_frames) > 0:
+                pass
+        finally:
+            self.dataset.attrs['frames_dropped'] = self.frames_dropped
+            self.dataset.file.flush()
@@ -9,6 +9,16 @@ from nplab.utils.array_with_attrs import ArrayWithAttrs
 import numpy as np
 import cv2
 
+# OpenCV 3 moved these constants out of the old cv2.cv namespace
+try:
+    JPEG_QUALITY = cv2.IMWRITE_JPEG_QUALITY
+    PNG_COMPRESSION = cv2.IMWRITE_PNG_COMPRESSION
+    LOAD_IMAGE_COLOR = cv2.IMREAD_COLOR
+except AttributeError:
+    JPEG_QUALITY = cv2.cv.CV_IMWRITE_JPEG_QUALITY
+    PNG_COMPRESSION = cv2.cv.CV_IMWRITE_PNG_COMPRESSION
+    LOAD_IMAGE_COLOR = cv2.cv.CV_LOAD_IMAGE_COLOR
+
 def jpeg_encode(image, quality=90):
     """Encode an image from a numpy array to a JPEG.
     
@@ -20,7 +30,7 @@ def jpeg_encode(image, quality=90):
     it was saved as a JPEG.
     """
     ret, encoded_array = cv2.imencode('.jpeg',image, 
-                                      (cv2.cv.CV_IMWRITE_JPEG_QUALITY, quality))
+                                      (JPEG_QUALITY, quality))
     assert ret, "Error encoding image"
     jpeg = ArrayWithAttrs(encoded_array)
     jpeg.attrs.create("image_format", "jpeg")
@@ -29,11 +39,11 @@ def jpeg_encode(image, quality=90):
     
 def jpeg_decode(image):
     """Unpack a compressed jpeg image into an uncompressed numpy array."""
-    return cv2.imdecode(image, cv2.cv.CV_LOAD_IMAGE_COLOR)
+    return cv2.imdecode(image, LOAD_IMAGE_COLOR)
     
 def png_decode(image):
     """Unpack a compressed image into an uncompressed numpy array."""
-    return cv2.imdecode(image, cv2.cv.CV_LOAD_IMAGE_COLOR)
+    return cv2.imdecode(image, LOAD_IMAGE_COLOR)
     
 def png_encode(image, compression=3):
     """Encode an image from a numpy array to a JPEG.
@@ -46,7 +56,7 @@ def png_encode(image, compression=3):
     it was saved as a PNG.
     """
     ret, encoded_array = cv2.imencode('.png',image, 
-                                      (cv2.cv.CV_IMWRITE_PNG_COMPRESSION, compression))
+                                      (PNG_COMPRESSION, compression))
     assert ret, "Error encoding image"
     png = ArrayWithAttrs(encoded_array)
     png.attrs.create("image_format", "png")
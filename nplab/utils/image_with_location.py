@@ -208,13 +208,35 @@ def ensure_2d(vector):
         raise ValueError("Tried to ensure a vector was 2D, but it had neither 2 nor 3 elements!")
 
 
-def locate_feature_in_image(image, feature, margin=0, restrict=False):
+def _search_region(image, feature, margin=0, restrict=False):
+    """Check there's room to find `feature` in `image`, and crop the image if `restrict` is set.
+
+    Returns the (possibly cropped) image, and the position of its [0,0] pixel in the original image.
+    """
+    # The line below is superfluous if we keep the datum-aware code below it.
+    assert image.shape[0] > feature.shape[0] and image.shape[1] > feature.shape[1], "Image must be larger than feature!"
+    # Check that there's enough space around the feature image
+    lower_margin = datum_pixel(image) - datum_pixel(feature)
+    upper_margin = (image.shape[:2] - datum_pixel(image)) - (feature.shape[:2] - datum_pixel(feature))
+    assert np.all(np.array([lower_margin, upper_margin]) >= margin), "The feature image is too large."
+    #TODO: sensible auto-crop of the template if it's too large?
+    image_shift = np.array((0,0))
+    if restrict:
+        # if requested, crop the larger image so that our search area is (2*margin + 1) square.
+        image_shift = np.array(lower_margin - margin,dtype = int)
+        image = image[image_shift[0]:image_shift[0] + feature.shape[0] + 2 * margin + 1,
+                      image_shift[1]:image_shift[1] + feature.shape[1] + 2 * margin + 1, ...]
+    return image, image_shift
+
+
+def locate_feature_in_image(image, feature, margin=0, restrict=False, method="template"):
     """Find the given feature (small image) and return the position of its datum (or centre) in the image's pixels.
 
     image : numpy.array
         The image in which to look.
     feature : numpy.array
-        The feature to look for.  Ideally should be an `ImageWithLocation`.
+        The feature to look for.  Ideally should be an `ImageWithLocation`.  If you are looking for the same feature
+        many times, pass a `FeatureLocator` instead, so the work of preparing the feature is only done once.
     margin : int (optional)
         Make sure the feature image is at least this much smaller than the big image.  NB this will take account of the
         image datum points - if the datum points are superimposed, there must be at least margin pixels on each side of
@@ -222,6 +244,9 @@ def locate_feature_in_image(image, feature, margin=0, restrict=False):
     restrict : bool (optional, default False)
         If set to true, restrict the search area to a square of (margin * 2 + 1) pixels centred on the pixel that most
         closely overlaps the datum points of the two images.
+    method : string (optional, default "template")
+        "template" uses a full-resolution template match (see below), "pyramid" a coarse-to-fine template match and
+        "phase" FFT phase correlation - see `FeatureLocator`.  Ignored if `feature` is a `FeatureLocator`.
 
     The `image` must be larger than `feature` by a margin big enough to produce a meaningful search area.  We use the
     OpenCV `matchTemplate` method to find the feature.  The returned position is the position, relative to the corner of
@@ -229,19 +254,11 @@ def locate_feature_in_image(image, feature, margin=0, restrict=False):
     centre of the image.  The output of this function can be passed into the pixel_to_location() method of the larger
     image to yield the position in the sample of the feature you're looking for.
     """
-    # The line below is superfluous if we keep the datum-aware code below it.
-    assert image.shape[0] > feature.shape[0] and image.shape[1] > feature.shape[1], "Image must be larger than feature!"
-    # Check that there's enough space around the feature image
-    lower_margin = datum_pixel(image) - datum_pixel(feature)
-    upper_margin = (image.shape[:2] - datum_pixel(image)) - (feature.shape[:2] - datum_pixel(feature))
-    assert np.all(np.array([lower_margin, upper_margin]) >= margin), "The feature image is too large."
-    #TODO: sensible auto-crop of the template if it's too large?
-    image_shift = np.array((0,0))
-    if restrict:
-        # if requested, crop the larger image so that our search area is (2*margin + 1) square.
-        image_shift = np.array(lower_margin - margin,dtype = int)
-        image = image[image_shift[0]:image_shift[0] + feature.shape[0] + 2 * margin + 1,
-                      image_shift[1]:image_shift[1] + feature.shape[1] + 2 * margin + 1, ...]
+    if isinstance(feature, FeatureLocator):
+        return feature.locate(image, margin=margin, restrict=restrict)
+    if method != "template":
+        return FeatureLocator(feature, method=method).locate(image, margin=margin, restrict=restrict)
+    image, image_shift = _search_region(image, feature, margin, restrict)
 
     corr = cv2.matchTemplate(image, feature,
                              cv2.TM_SQDIFF_NORMED)  # correlate them: NB the match position is the MINIMUM
@@ -252,4 +269,148 @@ def locate_feature_in_image(image, feature, margin=0, restrict=False):
     assert np.sum(corr) > 0, "Error: the correlation image doesn't have any nonzero pixels."
     peak = ndimage.measurements.center_of_mass(corr)  # take the centroid (NB this is of grayscale values, not binary)
     pos = np.array(peak) + image_shift + datum_pixel(feature) # return the position of the feature's datum point.
-    return pos
\ No newline at end of file
+    return pos
+
+
+def _grayscale_float32(image):
+    """Return a 2D, float32 copy of an image (averaging colour channels if there are any)."""
+    image = np.asarray(image)
+    if len(image.shape) == 3:
+        return np.mean(image, axis=2, dtype=np.float32)
+    return image.astype(np.float32)
+
+
+def _subpixel_peak(corr, peak, wrap=False):
+    """Refine the position of a peak in `corr` by fitting a parabola through it and its neighbours, in each axis.
+
+    If `wrap` is true, `corr` is periodic (e.g. the output of an FFT); otherwise peaks at the edge aren't refined.
+    """
+    refined = np.array(peak, dtype=np.float64)
+    for axis in range(2):
+        step = np.zeros(2, dtype=int)
+        step[axis] = 1
+        before, after = np.array(peak) - step, np.array(peak) + step
+        if wrap:
+            before, after = before % corr.shape, after % corr.shape
+        elif before[axis] < 0 or after[axis] >= corr.shape[axis]:
+            continue
+        a, b, c = corr[tuple(before)], corr[tuple(peak)], corr[tuple(after)]
+        curvature = a - 2 * b + c
+        if curvature < 0: # only refine a maximum
+            refined[axis] += np.clip(0.5 * (a - c) / curvature, -0.5, 0.5)
+    return refined
+
+
+class FeatureLocator(object):
+    """Find the same feature repeatedly, in a series of images.
+
+    `locate_feature_in_image` does a full-resolution, colour template match each time it is called, which is slow for
+    big images.  A FeatureLocator does the work that depends only on the feature once, when it's created, and then
+    `locate(image)` does the same job as `locate_feature_in_image(image, feature)`, using one of these methods:
+
+    "template"
+        The same full-resolution match as `locate_feature_in_image`.
+    "pyramid"
+        Grayscale template matching on an image pyramid: the whole search area is searched at the coarsest level, then
+        only a few pixels around the match are searched at each finer level.  The final position is refined to a
+        fraction of a pixel by fitting a parabola to the match around the best pixel.
+    "phase"
+        FFT phase correlation (with the feature's edges tapered, and the spectrum partly whitened).  The feature's
+        Fourier transform is stored for each image size it has been used with, so each call needs just one forward and
+        one inverse FFT.  The peak is refined as for "pyramid".
+
+    Arguments:
+    feature : numpy.array
+        The feature to look for.  Ideally should be an `ImageWithLocation`.
+    method : string
+        "template", "pyramid" or "phase".
+    levels : int, optional
+        The number of times the images are halved in size for the "pyramid" method.  By default, we stop when the
+        feature would become smaller than `min_pyramid_size`.
+    """
+    methods = ("template", "pyramid", "phase")
+    min_pyramid_size = 16
+
+    def __init__(self, feature, method="pyramid", levels=None):
+        if method not in self.methods:
+            raise ValueError("method must be one of {0}".format(self.methods))
+        self.feature = feature
+        self.method = method
+        self.shape = feature.shape[:2]
+        self.datum_pixel = datum_pixel(feature)
+        gray = _grayscale_float32(feature)
+        if method == "pyramid":
+            if levels is None:
+                levels = 0
+                while min(self.shape) / 2 ** (levels + 1) >= self.min_pyramid_size:
+                    levels += 1
+            self.levels = levels
+            self._feature_pyramid = [gray]
+            for i in range(levels):
+                self._feature_pyramid.append(cv2.pyrDown(self._feature_pyramid[-1]))
+        elif method == "phase":
+            # Taper the edges of the feature, so they don't dominate the (whitened) correlation
+            window = cv2.createHanningWindow(tuple(gray.shape[::-1]), cv2.CV_32F)
+            self._zero_mean_feature = (gray - np.mean(gray)) * window
+            self._fft_cache = {}
+
+    def locate(self, image, margin=0, restrict=False):
+        """Return the position of the feature's datum (or centre) in the image's pixels.
+
+        The arguments are the same as `locate_feature_in_image`.
+        """
+        if self.method == "template":
+            return locate_feature_in_image(image, self.feature, margin=margin, restrict=restrict)
+        image, image_shift = _search_region(image, self.feature, margin, restrict)
+        gray = _grayscale_float32(image)
+        if self.method == "pyramid":
+            offset = self._match_pyramid(gray)
+        else:
+            offset = self._match_phase(gray)
+        return offset + image_shift + self.datum_pixel
+
+    def _match_pyramid(self, image, search_radius=2):
+        """Return the (sub-pixel) position of the feature's [0,0] pixel in `image`."""
+        image_pyramid = [image]
+        for i in range(self.levels):
+            image_pyramid.append(cv2.pyrDown(image_pyramid[-1]))
+        peak = None
+        for level in range(self.levels, -1, -1):
+            image, feature = image_pyramid[level], self._feature_pyramid[level]
+            n_positions = np.array(image.shape) - np.array(feature.shape) + 1
+            if peak is None:
+                start, stop = np.zeros(2, dtype=int), n_positions
+            else:
+                start = np.clip(2 * peak - search_radius, 0, n_positions - 1)
+                stop = np.clip(2 * peak + search_radius + 1, 1, n_positions)
+            window = image[start[0]:stop[0] + feature.shape[0] - 1, start[1]:stop[1] + feature.shape[1] - 1]
+            corr = -cv2.matchTemplate(window, feature, cv2.TM_SQDIFF_NORMED)
+            peak = np.array(np.unravel_index(np.argmax(corr), corr.shape))
+            if level == 0:
+                return _subpixel_peak(corr, peak) + start
+            peak += start
+
+    def _feature_fft(self, shape):
+        """The feature's Fourier transform (as returned by `cv2.dft`), zero-padded to `shape`."""
+        if shape not in self._fft_cache:
+            padded = np.zeros(shape, dtype=np.float32)
+            padded[:self.shape[0], :self.shape[1]] = self._zero_mean_feature
+            self._fft_cache[shape] = cv2.dft(padded, flags=cv2.DFT_COMPLEX_OUTPUT)
+        return self._fft_cache[shape]
+
+    def _match_phase(self, image):
+        """Return the (sub-pixel) position of the feature's [0,0] pixel in `image`."""
+        shape = tuple(cv2.getOptimalDFTSize(n) for n in image.shape)
+        padded = np.zeros(shape, dtype=np.float32)
+        padded[:image.shape[0], :image.shape[1]] = image - np.mean(image)
+        cross_power = cv2.mulSpectrums(cv2.dft(padded, flags=cv2.DFT_COMPLEX_OUTPUT), self._feature_fft(shape),
+                                       0, conjB=True)
+        # Dividing by the square root of the magnitude (rather than the magnitude itself) whitens the spectrum enough
+        # to give a sharp peak, without letting noise at high frequencies swamp it.
+        magnitude = cv2.magnitude(cross_power[..., 0], cross_power[..., 1])
+        cross_power /= np.sqrt(magnitude)[..., np.newaxis] + 1e-12
+        corr = cv2.idft(cross_power, flags=cv2.DFT_REAL_OUTPUT)
+        n_positions = np.array(image.shape) - np.array(self.shape) + 1
+        valid = corr[:n_positions[0], :n_positions[1]] # only positions where the feature is inside the image
+        peak = np.unravel_index(np.argmax(valid), valid.shape)
+        return _subpixel_peak(corr, peak, wrap=True)
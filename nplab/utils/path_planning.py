@@ -0,0 +1,362 @@
+"""
+Path Planning
+=============
+
+Particle-finding routines produce hundreds or thousands of positions to
+visit, in whatever order they were detected.  Visiting them in that order
+sends the stage zig-zagging back and forth across the sample; this module
+finds a much shorter route, by building a nearest-neighbour tour and then
+improving it with 2-opt moves (reversing a stretch of the tour wherever
+that makes it shorter).
+
+Distances are Euclidean by default.  If the stage's maximum velocity on each
+axis is given, the cost of each leg is instead the time it takes, assuming
+all the axes move at once, i.e. the largest of ``|displacement| / velocity``
+over the axes.
+
+The usual entry point is `plan_path`, or `Stage.plan_path`, which starts
+from the stage's current position.  For regular grids, `snake_raster` gives
+the waypoints in the usual back-and-forth order, ready for
+`Stage.execute_trajectory`.
+
+Other orders for visiting every point of a grid are made by `grid_path`:
+a spiral out from the centre, a Hilbert curve (which keeps points that are
+close on the sample close in time, so slow drift doesn't show up as stripes),
+or a random order.  These are built with numpy array operations, so even a
+grid of a million points takes well under a second.
+"""
+
+import time
+import logging
+import numpy as np
+from scipy.spatial import cKDTree
+
+LOGGER = logging.getLogger('nplab.utils.path_planning')
+
+
+def _scaled(positions, velocity):
+    """Return positions in units where the leg cost is a simple norm, and that norm's order."""
+    positions = np.asarray(positions, dtype=np.float64)
+    if velocity is None:
+        return positions, 2
+    return positions / np.asarray(velocity, dtype=np.float64), np.inf
+
+
+def _distances(a, b, p):
+    """The cost of moving from each row of `a` to the corresponding row of `b`."""
+    if p == 2:
+        return np.sqrt(np.sum((b - a)**2, axis=-1))
+    return np.max(np.abs(b - a), axis=-1)
+
+
+def leg_costs(positions, order=None, start=None, velocity=None):
+    """Return the cost (distance, or time if `velocity` is given) of each leg of a path.
+
+    Arguments:
+    positions : array (n_points x n_axes)
+        The points to visit.
+    order : array of int, optional
+        The order in which to visit them (default: the order they're in).
+    start : array (n_axes), optional
+        Where the stage starts; if given, the first leg is from here to the
+        first point.
+    velocity : array (n_axes), optional
+        The maximum speed of each axis.
+    """
+    scaled, p = _scaled(positions, velocity)
+    if order is not None:
+        scaled = scaled[np.asarray(order)]
+    if start is not None:
+        scaled = np.concatenate([_scaled(np.atleast_2d(start), velocity)[0], scaled])
+    return _distances(scaled[:-1], scaled[1:], p)
+
+
+def path_cost(positions, order=None, start=None, velocity=None):
+    """Return the total cost of a path, see `leg_costs`."""
+    return np.sum(leg_costs(positions, order, start, velocity))
+
+
+def nearest_neighbour_order(positions, start=None, velocity=None):
+    """Return an order for visiting `positions`, always going to the closest unvisited point.
+
+    The tour begins at the point closest to `start`, or at the first point
+    if `start` is None.  The tour is typically 25% longer than the best one,
+    but it's a good starting point for `two_opt`.
+    """
+    scaled, p = _scaled(positions, velocity)
+    n = len(scaled)
+    if n == 0:
+        return np.zeros(0, dtype=int)
+    visited = np.zeros(n, dtype=bool)
+    order = np.empty(n, dtype=int)
+    live = np.arange(n)  # the points in the tree, some of which may have been visited since
+    tree = cKDTree(scaled)
+    # Usually, one of a point's closest few neighbours is still unvisited, so look those up in one go
+    neighbours = np.atleast_2d(tree.query(scaled, k=min(9, n), p=p)[1].reshape(n, -1))[:, 1:]
+    if start is None:
+        current = 0
+    else:
+        current = int(tree.query(_scaled(np.atleast_2d(start), velocity)[0][0], p=p)[1])
+    for m in range(n):
+        order[m] = current
+        visited[current] = True
+        if m == n - 1:
+            break
+        unvisited = neighbours[current][~visited[neighbours[current]]]
+        if len(unvisited) > 0:
+            current = unvisited[0]
+            continue
+        if 2 * (m + 1 - (n - len(live))) > len(live):
+            # Most of the tree has been visited, so rebuild it from the unvisited points
+            live = np.flatnonzero(~visited)
+            tree = cKDTree(scaled[live])
+        k = 8
+        while True:
+            k = min(k, len(live))
+            indices = live[np.atleast_1d(tree.query(scaled[current], k=k, p=p)[1])]
+            unvisited = indices[~visited[indices]]
+            if len(unvisited) > 0:
+                current = unvisited[0]
+                break
+            k *= 4
+    return order
+
+
+def two_opt(positions, order, start=None, velocity=None, window=None, max_time=None):
+    """Shorten a path by reversing stretches of it, until no reversal helps.
+
+    Arguments:
+    positions : array (n_points x n_axes)
+        The points to visit.
+    order : array of int
+        The initial order (e.g. from `nearest_neighbour_order`).
+    start : array (n_axes), optional
+        Where the stage starts (it stays at the start of the path).  If this
+        is None, the first point in `order` stays first.
+    velocity : array (n_axes), optional
+        The maximum speed of each axis, see `leg_costs`.
+    window : int, optional
+        Only reverse stretches of up to this many points.  By default, this
+        is the whole path for up to a few hundred points, and shorter for
+        longer paths so that the time taken grows linearly.
+    max_time : float, optional
+        Stop improving the path after this many seconds.
+
+    Returns the improved order.  The path is open: it doesn't return to
+    the start.
+    """
+    t0 = time.time()
+    scaled, p = _scaled(positions, velocity)
+    path = np.array(order, dtype=int)
+    coords = scaled[path]
+    if start is not None:  # include the starting point, which doesn't move
+        coords = np.concatenate([_scaled(np.atleast_2d(start), velocity)[0], coords])
+        path = np.concatenate([[-1], path])
+    n = len(path)
+    if window is None:
+        window = max(100, int(5e5 / max(n, 1)))
+    window = min(window, n - 1)
+    improved = True
+    while improved:
+        improved = False
+        for k in range(2, window + 1):
+            # Reversing path[i+1:i+k+1] replaces edges (i, i+1) and (i+k, i+k+1)
+            # with (i, i+k) and (i+1, i+k+1).  The end of the path is open, so
+            # the edge after the last point costs nothing.
+            edges = np.zeros(n)
+            edges[:-1] = _distances(coords[:-1], coords[1:], p)
+            new_first = _distances(coords[:n - k], coords[k:], p)
+            new_second = np.zeros(n - k)
+            new_second[:-1] = _distances(coords[1:n - k], coords[k + 1:], p)
+            gains = edges[:n - k] + edges[k:] - new_first - new_second
+            candidates = np.flatnonzero(gains > 1e-9 * (1 + edges[:n - k]))
+            next_allowed = 0
+            for i in candidates:
+                if i < next_allowed:
+                    continue  # this would overlap a reversal we have just made
+                path[i + 1:i + k + 1] = path[i + 1:i + k + 1][::-1].copy()
+                coords[i + 1:i + k + 1] = coords[i + 1:i + k + 1][::-1].copy()
+                next_allowed = i + k + 1
+                improved = True
+            if max_time is not None and time.time() - t0 > max_time:
+                LOGGER.info("2-opt stopped after {0:.2f} s, before it had converged".format(time.time() - t0))
+                improved = False
+                break
+    if start is not None:
+        path = path[1:]
+    return path
+
+
+def plan_path(positions, start=None, velocity=None, window=None, max_time=0.5):
+    """Return a short order in which to visit `positions` (an n_points x n_axes array).
+
+    This builds a nearest-neighbour tour from `start` (if given) and
+    improves it with `two_opt`, for at most `max_time` seconds; see that
+    function for the other arguments.  The result is an array of indices
+    into `positions`.
+    """
+    positions = np.asarray(positions, dtype=np.float64)
+    if len(positions) < 3:
+        order = np.arange(len(positions))
+        if start is not None and len(positions) == 2 and \
+                path_cost(positions, order[::-1], start, velocity) < path_cost(positions, order, start, velocity):
+            order = order[::-1]
+        return order
+    order = nearest_neighbour_order(positions, start, velocity)
+    return two_opt(positions, order, start, velocity, window=window, max_time=max_time)
+
+
+PATH_KINDS = ('snake', 'raster', 'spiral', 'hilbert', 'random')
+
+
+def snake_indices(shape):
+    """Return the indices of the points of a grid, in snake order (see `snake_raster`)."""
+    shape = tuple(int(n) for n in shape)
+    counters = np.indices(shape).reshape(len(shape), -1)
+    indices = counters.copy()
+    for d in range(1, len(shape)):
+        # An axis runs backwards whenever the loops outside it have made an odd number of steps
+        outer_steps = np.ravel_multi_index(counters[:d], shape[:d])
+        indices[d] = np.where(outer_steps % 2 == 1, shape[d] - 1 - counters[d], counters[d])
+    return indices.T
+
+
+def _spiral_2d(shape):
+    """Indices of a 2D grid in a square spiral, anticlockwise out from the middle."""
+    i, j = np.indices(shape).reshape(2, -1)
+    y, x = i - (shape[0] - 1) // 2, j - (shape[1] - 1) // 2
+    ring = np.maximum(abs(x), abs(y))
+    # Each ring starts next to where the last one finished, just above its bottom right corner, and goes
+    # up the right side, along the top, down the left side and along the bottom.
+    position = np.select([(x == ring) & (y > -ring), (y == ring) & (x < ring), (x == -ring) & (y < ring)],
+                         [y + ring - 1, 3 * ring - 1 - x, 5 * ring - 1 - y],
+                         7 * ring - 1 + x)
+    order = np.argsort(ring * (8 * ring.max() + 1) + position, kind='mergesort') # by ring, then along it
+    return np.stack([i[order], j[order]], axis=1)
+
+
+def _hilbert_d2xy(n, d):
+    """The coordinates of the points at distances `d` along a Hilbert curve filling an n x n square.
+
+    The curve starts at (0, 0) and finishes at (n-1, 0).  `n` must be a power of 2.
+    """
+    x, y, t = np.zeros_like(d), np.zeros_like(d), d.copy()
+    s = 1
+    while s < n:
+        rx = (t >> 1) & 1
+        ry = (t ^ rx) & 1
+        swap = ry == 0
+        flip = swap & (rx == 1)
+        x[flip] = s - 1 - x[flip]
+        y[flip] = s - 1 - y[flip]
+        x[swap], y[swap] = y[swap], x[swap]
+        x += s * rx
+        y += s * ry
+        t >>= 2
+        s *= 2
+    return x, y
+
+
+def _hilbert_2d(shape):
+    """Indices of a 2D grid along a Hilbert curve.
+
+    The grid is covered by square blocks along its longer side, whose sides
+    are the power of 2 that covers the shorter side; each block is filled by
+    a Hilbert curve that finishes next to where the next one starts.  Points
+    of the blocks outside the grid are left out, so unless the shorter side
+    is a power of 2 there are some jumps along the edge of the grid.
+    """
+    long_axis = 0 if shape[0] >= shape[1] else 1
+    length, width = shape[long_axis], shape[1 - long_axis]
+    n = 1 << int(np.ceil(np.log2(max(width, 1))))
+    x, y = _hilbert_d2xy(n, np.arange(n * n, dtype=np.int64 if n > 2**15 else np.int32))
+    blocks = -(-length // n)
+    x = (x[np.newaxis, :] + n * np.arange(blocks)[:, np.newaxis]).ravel()
+    y = np.tile(y, blocks)
+    inside = (x < length) & (y < width)
+    x, y = x[inside], y[inside]
+    return np.stack([x, y] if long_axis == 0 else [y, x], axis=1)
+
+
+def _centre_out_1d(n):
+    """Indices of a line, alternating either side of the middle and working outwards."""
+    offset = np.arange(n) - (n - 1) // 2
+    return np.lexsort((offset < 0, abs(offset)))[:, np.newaxis]
+
+
+def grid_path_indices(shape, kind='snake', seed=None):
+    """Return the indices of every point of a grid, in the order to visit them (an n_points x n_axes array).
+
+    Arguments:
+    shape : tuple of int
+        The number of points along each axis of the grid.
+    kind : str
+        'snake' (back and forth along the last axis, see `snake_raster`),
+        'raster' (always forwards along each axis, i.e. C order), 'spiral'
+        (a square spiral out from the middle), 'hilbert' (along a Hilbert
+        curve, so that points visited close together in time are close
+        together on the grid), or 'random'.
+    seed : int, optional
+        The seed for the random order.
+
+    Spirals and Hilbert curves cover the last two axes; a grid with more
+    axes is covered one layer at a time, going back along the same path
+    on every other layer, and the outer axes snake.
+    """
+    shape = tuple(int(n) for n in shape)
+    n_points = int(np.prod(shape))
+    if kind == 'snake':
+        return snake_indices(shape)
+    elif kind == 'raster':
+        return np.indices(shape).reshape(len(shape), -1).T
+    elif kind == 'random':
+        order = np.random.RandomState(seed).permutation(n_points)
+        return np.stack(np.unravel_index(order, shape), axis=1)
+    elif kind in ('spiral', 'hilbert'):
+        if len(shape) == 1:
+            return _centre_out_1d(shape[0]) if kind == 'spiral' else np.arange(shape[0])[:, np.newaxis]
+        layer = _spiral_2d(shape[-2:]) if kind == 'spiral' else _hilbert_2d(shape[-2:])
+        if len(shape) == 2:
+            return layer
+        layers = snake_indices(shape[:-2])
+        # go back along the path on odd layers, so each layer starts where the last one finished
+        step = np.arange(len(layer))[np.newaxis, :]
+        step = np.where((np.arange(len(layers)) % 2 == 1)[:, np.newaxis], len(layer) - 1 - step, step)
+        return np.concatenate([np.repeat(layers, len(layer), axis=0), layer[step.ravel()]], axis=1)
+    raise ValueError("kind must be one of {0}".format(PATH_KINDS))
+
+
+def grid_path(*axis_values, **kwargs):
+    """Return the points of a grid, in the order given by `kind` (see `grid_path_indices`).
+
+    Each argument is a list of the positions along one axis; the keyword
+    arguments `kind` (default 'snake') and `seed` are passed on to
+    `grid_path_indices`.  Returns an (n_points x n_axes) array of positions
+    and the (n_points x n_axes) grid indices of each point.
+    """
+    kind = kwargs.pop('kind', 'snake')
+    seed = kwargs.pop('seed', None)
+    if kwargs:
+        raise TypeError("Unexpected keyword arguments {0}".format(list(kwargs.keys())))
+    axis_values = [np.asarray(values, dtype=np.float64) for values in axis_values]
+    indices = grid_path_indices(tuple(len(values) for values in axis_values), kind, seed)
+    points = np.stack([values[i] for values, i in zip(axis_values, indices.T)], axis=1)
+    return points, indices
+
+
+def snake_raster(*axis_values, **kwargs):
+    """Return the points of a grid, in "snake" (back-and-forth) order.
+
+    Each argument is a list of the positions along one axis; the first axis
+    changes most slowly.  Every other line (and plane) is reversed, so each
+    point is next to the one before, as in `GridScan`.  Returns an
+    (n_points x n_axes) array, or, if `return_indices=True`, a tuple of
+    that and the (n_points x n_axes) grid indices of each point.
+    """
+    return_indices = kwargs.pop('return_indices', False)
+    if kwargs:
+        raise TypeError("Unexpected keyword arguments {0}".format(list(kwargs.keys())))
+    points, indices = grid_path(*axis_values, kind='snake')
+    if return_indices:
+        return points, indices
+    return points
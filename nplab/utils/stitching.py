@@ -0,0 +1,332 @@
+"""
+Stitching
+=========
+
+Tiled acquisitions (`AcquireGridOfImages`, `CameraStageMapper.acquire_tiled_image`) save overlapping images, each
+with the position it was taken at.  This module assembles them into one large image (a mosaic):
+
+1. `nominal_tile_positions` works out where each tile should go, in pixels, from its metadata.
+2. `register_tiles` measures the offset between each pair of overlapping tiles, by cross-correlating their overlap.
+   This is done by a pool of processes, a batch of tile pairs at a time.
+3. `solve_tile_positions` finds the placement of all the tiles that best agrees with those offsets.  This is a sparse
+   least-squares problem, weakly anchored to the nominal positions so that tiles which couldn't be matched (e.g. in
+   empty parts of the sample) stay where the stage put them.
+4. `write_mosaic` blends the tiles, feathering across the overlaps, into a chunked HDF5 dataset.  It works one block
+   at a time, so neither the tiles nor the mosaic have to fit in memory, and then adds successively halved copies of
+   the mosaic to make an image pyramid, so it can be viewed quickly at any scale.
+
+`stitch_tiles` does all four.  Pixel positions are (row, column), and refer to the [0,0] pixel of each tile.
+"""
+
+import logging
+import multiprocessing
+import numpy as np
+import cv2
+import scipy.sparse
+import scipy.sparse.linalg
+from nplab.utils.image_with_location import _grayscale_float32, _subpixel_peak
+
+LOGGER = logging.getLogger('nplab.utils.stitching')
+
+
+def tile_datasets(group):
+    """Return the tiles in an HDF5 group, in the order they were taken (tile_0, tile_1, ...)."""
+    names = [name for name in group.keys() if name.startswith("tile_") and name[5:].isdigit()]
+    return [group[name] for name in sorted(names, key=lambda name: int(name[5:]))]
+
+
+def nominal_tile_positions(tiles, group_attrs=None):
+    """Work out where each tile belongs in the mosaic, in pixels, from the tiles' metadata.
+
+    Tiles saved by `CameraWithLocation` have a `pixel_to_sample_matrix`, which is used directly.  Tiles saved by
+    `CameraStageMapper` have a `camera_centre_position`, and the group they are in has the `camera_to_sample` matrix
+    (pass the group's attrs as `group_attrs`).  Positions are relative to the first tile.
+    """
+    tiles = list(tiles)
+    if all("pixel_to_sample_matrix" in tile.attrs for tile in tiles):
+        matrices = [np.asarray(tile.attrs["pixel_to_sample_matrix"], dtype=np.float64) for tile in tiles]
+        to_pixels = np.linalg.inv(matrices[0][:2, :2])  # a sample displacement (x, y) to pixels
+        positions = np.array([np.dot(M[3, :2] - matrices[0][3, :2], to_pixels) for M in matrices])
+    elif (group_attrs is not None and "camera_to_sample" in group_attrs and
+          all("camera_centre_position" in tile.attrs for tile in tiles)):
+        to_points = np.linalg.inv(np.asarray(group_attrs["camera_to_sample"], dtype=np.float64))
+        centres = np.array([tile.attrs["camera_centre_position"][:2] for tile in tiles], dtype=np.float64)
+        positions = np.dot(centres - centres[0], to_points) * np.array(tiles[0].shape[:2])
+    else:
+        raise ValueError("The tiles don't have the metadata needed to position them - supply positions instead.")
+    if len(tiles) > 1 and np.all(positions == positions[0]):
+        raise ValueError("All the tiles have the same position (is the camera calibrated?) - supply positions instead.")
+    return positions
+
+
+def overlapping_pairs(positions, shapes, min_overlap=0.05):
+    """Return an (N, 2) array of the indices (i < j) of tiles that overlap by at least `min_overlap` of their area."""
+    positions = np.asarray(positions, dtype=np.float64)
+    shapes = np.asarray(shapes, dtype=np.float64)
+    ends = positions + shapes
+    pairs = []
+    for i in range(len(positions) - 1):
+        overlap = np.clip(np.minimum(ends[i], ends[i + 1:]) - np.maximum(positions[i], positions[i + 1:]), 0, None)
+        area = np.prod(overlap, axis=1)
+        smaller = np.minimum(np.prod(shapes[i]), np.prod(shapes[i + 1:], axis=1))
+        for j in np.nonzero(area >= min_overlap * smaller)[0]:
+            pairs.append((i, i + 1 + j))
+    return np.array(pairs, dtype=int).reshape(-1, 2)
+
+
+def _overlap_regions(tile_i, tile_j, offset, max_shift):
+    """Crop the overlap between two tiles, for `_register_pair`.
+
+    `offset` is the nominal (integer) position of tile j relative to tile i.  Returns the overlap in tile i, and the
+    overlap in tile j shrunk by `max_shift` pixels on each side (or None if there's not enough overlap).
+    """
+    shape_i, shape_j = np.array(tile_i.shape[:2]), np.array(tile_j.shape[:2])
+    start = np.maximum(offset, 0)  # the overlap, in tile i's pixels
+    stop = np.minimum(shape_i, offset + shape_j)
+    if np.any(stop - start - 2 * max_shift < 8):
+        return None
+    search = tile_i[start[0]:stop[0], start[1]:stop[1], ...]
+    template_start = start - offset + max_shift  # in tile j's pixels
+    template_stop = stop - offset - max_shift
+    template = tile_j[template_start[0]:template_stop[0], template_start[1]:template_stop[1], ...]
+    return _grayscale_float32(search), _grayscale_float32(template)
+
+
+def _register_pair(regions):
+    """Find a template in a search region; return the template's (sub-pixel) position and the match quality.
+
+    This runs in a worker process, so it must be a module-level function.
+    """
+    search, template = regions
+    corr = cv2.matchTemplate(search, template, cv2.TM_CCOEFF_NORMED)
+    peak = np.unravel_index(np.argmax(corr), corr.shape)
+    return _subpixel_peak(corr, peak), float(corr[peak])
+
+
+def register_tiles(tiles, positions, max_shift=20, min_overlap=0.05, n_processes=None, batch_size=None):
+    """Measure the offset between each pair of overlapping tiles by cross-correlation.
+
+    Arguments:
+    tiles : list of arrays or HDF5 datasets
+        The tiles (only the overlapping parts are read).
+    positions : (N, 2) array
+        The nominal positions of the tiles, in pixels.
+    max_shift : int
+        The largest error in the nominal positions that we can correct.
+    min_overlap : float
+        Tiles overlapping by less than this fraction of their area are not compared.
+    n_processes : int, optional
+        The number of worker processes (default: the number of CPUs).  1 does everything in this process.
+    batch_size : int, optional
+        The number of pairs of overlaps read into memory at once (default: 16 per process).
+
+    Returns (pairs, offsets, scores): the indices (i, j) of each pair of tiles, the measured position of tile j
+    relative to tile i, and the correlation coefficient of the match (1 is perfect).  Pairs without enough overlap
+    to compare are left out.
+    """
+    positions = np.asarray(positions, dtype=np.float64)
+    shapes = [tile.shape[:2] for tile in tiles]
+    candidate_pairs = overlapping_pairs(positions, shapes, min_overlap)
+    if n_processes is None:
+        n_processes = multiprocessing.cpu_count()
+    if batch_size is None:
+        batch_size = 16 * n_processes
+    pool = multiprocessing.Pool(n_processes) if n_processes > 1 else None
+    pairs, offsets, scores = [], [], []
+    try:
+        for batch_start in range(0, len(candidate_pairs), batch_size):
+            batch, regions, nominal_offsets = [], [], []
+            for i, j in candidate_pairs[batch_start:batch_start + batch_size]:
+                offset = np.round(positions[j] - positions[i]).astype(int)
+                overlap = _overlap_regions(tiles[i], tiles[j], offset, max_shift)
+                if overlap is not None:
+                    batch.append((i, j))
+                    regions.append(overlap)
+                    nominal_offsets.append(offset)
+            results = pool.map(_register_pair, regions) if pool is not None else [_register_pair(r) for r in regions]
+            for (i, j), offset, (template_position, score) in zip(batch, nominal_offsets, results):
+                pairs.append((i, j))
+                # The template would be at (max_shift, max_shift) if the nominal positions were right
+                offsets.append(offset + template_position - max_shift)
+                scores.append(score)
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+    return (np.array(pairs, dtype=int).reshape(-1, 2), np.array(offsets, dtype=np.float64).reshape(-1, 2),
+            np.array(scores, dtype=np.float64))
+
+
+def solve_tile_positions(nominal_positions, pairs, offsets, scores, min_score=0.5, prior_weight=1e-3):
+    """Find tile positions that best agree with the measured offsets between pairs of tiles.
+
+    Each offset with a score of at least `min_score` contributes an equation `p[j] - p[i] = offset`, weighted by its
+    score; each tile also has a weak (`prior_weight`) equation `p[i] = nominal_position`, which fixes the position of
+    the mosaic as a whole and keeps tiles with no good matches where they were.  The weighted least-squares solution
+    is found with a sparse solver, so this is quick even for thousands of tiles.
+    """
+    nominal_positions = np.asarray(nominal_positions, dtype=np.float64)
+    n = len(nominal_positions)
+    good = np.asarray(scores) >= min_score
+    pairs, offsets, weights = np.asarray(pairs)[good], np.asarray(offsets)[good], np.asarray(scores)[good]
+    if np.count_nonzero(~good) > 0:
+        LOGGER.info("Ignoring %d of %d tile matches with scores below %g" % (np.count_nonzero(~good), len(good),
+                                                                           min_score))
+    m = len(pairs)
+    rows = np.concatenate([np.arange(m), np.arange(m), m + np.arange(n)])
+    columns = np.concatenate([pairs[:, 1], pairs[:, 0], np.arange(n)])
+    values = np.concatenate([weights, -weights, np.ones(n) * prior_weight])
+    A = scipy.sparse.csr_matrix((values, (rows, columns)), shape=(m + n, n))
+    b = np.concatenate([offsets * weights[:, np.newaxis], nominal_positions * prior_weight])
+    AT = A.T.tocsr()
+    normal_matrix = (AT * A).tocsc()
+    return np.column_stack([scipy.sparse.linalg.spsolve(normal_matrix, AT * b[:, axis]) for axis in range(2)])
+
+
+def _feather_weights(shape, feather):
+    """Blending weights for a tile: rising linearly from the edges over `feather` pixels (None: to the centre)."""
+    ramps = []
+    for n in shape[:2]:
+        distance = np.minimum(np.arange(n) + 1, n - np.arange(n)).astype(np.float32)
+        if feather is not None:
+            distance = np.minimum(distance, feather)
+        ramps.append(distance)
+    return np.minimum.outer(ramps[0], ramps[1])
+
+
+def _downsample_level(source, dest, block_size):
+    """Fill `dest` with `source`, halved in size (by averaging 2x2 blocks), one block at a time."""
+    for r0 in range(0, dest.shape[0], block_size):
+        for c0 in range(0, dest.shape[1], block_size):
+            r1, c1 = min(r0 + block_size, dest.shape[0]), min(c0 + block_size, dest.shape[1])
+            block = np.asarray(source[2 * r0:2 * r1, 2 * c0:2 * c1, ...])
+            if block.shape[0] % 2 or block.shape[1] % 2:  # repeat the last row/column of odd-sized images
+                pad = [(0, block.shape[0] % 2), (0, block.shape[1] % 2)] + [(0, 0)] * (block.ndim - 2)
+                block = np.pad(block, pad, mode='edge')
+            halved = block.astype(np.float32).reshape((r1 - r0, 2, c1 - c0, 2) + block.shape[2:]).mean(axis=(1, 3))
+            if np.dtype(dest.dtype).kind in 'iu':
+                halved = np.round(halved)
+            dest[r0:r1, c0:c1, ...] = halved.astype(dest.dtype)
+
+
+def write_mosaic(tiles, positions, dest, block_size=1024, chunk_size=256, levels=None, feather=None,
+                 compression="gzip"):
+    """Blend tiles into a mosaic, saved as an image pyramid in an HDF5 group.
+
+    Arguments:
+    tiles : list of arrays or HDF5 datasets
+        The tiles, which must all have the same number of colour channels (if any) and dtype.
+    positions : (N, 2) array
+        The position of each tile's [0,0] pixel.  Positions are rounded to the nearest pixel.
+    dest : nplab.datafile.Group
+        The group to write to.  The full-resolution mosaic is saved as "level_0", and "level_1", "level_2"...
+        are each half the size of the one before.
+    block_size : int
+        The mosaic is assembled in square blocks of this size, which is all that needs to be in memory.
+    chunk_size : int
+        The HDF5 chunk size (in pixels, along each side).
+    levels : int, optional
+        The number of levels in the pyramid.  By default, we stop when the image fits in one chunk.
+    feather : int, optional
+        Overlapping tiles are blended over this many pixels from their edges.  By default, each tile's weight rises
+        all the way to its centre, which hides differences in brightness best.
+    compression : string, optional
+        HDF5 compression for the mosaic.
+
+    Returns the full-resolution dataset.
+    """
+    positions = np.round(np.asarray(positions, dtype=np.float64)).astype(int)
+    shapes = np.array([tile.shape[:2] for tile in tiles])
+    origin = positions.min(axis=0)
+    positions = positions - origin
+    shape = tuple((positions + shapes).max(axis=0))
+    channels = tuple(tiles[0].shape[2:])
+    dtype = tiles[0].dtype
+    chunks = (min(chunk_size, shape[0]), min(chunk_size, shape[1])) + channels
+    level_0 = dest.create_dataset("level_0", shape=shape + channels, dtype=dtype, chunks=chunks,
+                                  compression=compression, auto_increment=False, autoflush=False)
+    dest.attrs['origin'] = origin  # the nominal position of the mosaic's [0,0] pixel
+    dest.create_dataset("tile_positions", data=positions, auto_increment=False, autoflush=False)
+
+    weights = {}
+    ends = positions + shapes
+    for r0 in range(0, shape[0], block_size):
+        for c0 in range(0, shape[1], block_size):
+            r1, c1 = min(r0 + block_size, shape[0]), min(c0 + block_size, shape[1])
+            total = np.zeros((r1 - r0, c1 - c0) + channels, dtype=np.float32)
+            total_weight = np.zeros((r1 - r0, c1 - c0), dtype=np.float32)
+            in_block = np.nonzero((positions[:, 0] < r1) & (ends[:, 0] > r0) &
+                                  (positions[:, 1] < c1) & (ends[:, 1] > c0))[0]
+            for i in in_block:
+                top, left = max(r0, positions[i, 0]), max(c0, positions[i, 1])
+                bottom, right = min(r1, ends[i, 0]), min(c1, ends[i, 1])
+                tile_shape = tuple(shapes[i])
+                if tile_shape not in weights:
+                    weights[tile_shape] = _feather_weights(tile_shape, feather)
+                w = weights[tile_shape][top - positions[i, 0]:bottom - positions[i, 0],
+                                        left - positions[i, 1]:right - positions[i, 1]]
+                data = np.asarray(tiles[i][top - positions[i, 0]:bottom - positions[i, 0],
+                                           left - positions[i, 1]:right - positions[i, 1], ...], dtype=np.float32)
+                total[top - r0:bottom - r0, left - c0:right - c0, ...] += data * w.reshape(w.shape + (1,) * len(channels))
+                total_weight[top - r0:bottom - r0, left - c0:right - c0] += w
+            covered = total_weight > 0
+            total[covered] /= total_weight[covered].reshape((-1,) + (1,) * len(channels))
+            if np.dtype(dtype).kind in 'iu':
+                total = np.round(total)
+            level_0[r0:r1, c0:c1, ...] = total.astype(dtype)
+
+    previous = level_0
+    level = 1
+    while (levels is None and max(previous.shape[:2]) > chunk_size) or (levels is not None and level < levels):
+        level_shape = tuple((np.array(previous.shape[:2]) + 1) // 2)
+        current = dest.create_dataset("level_%d" % level, shape=level_shape + channels, dtype=dtype,
+                                      chunks=(min(chunk_size, level_shape[0]), min(chunk_size, level_shape[1]))
+                                      + channels, compression=compression, auto_increment=False, autoflush=False)
+        _downsample_level(previous, current, block_size)
+        previous = current
+        level += 1
+    dest.attrs['levels'] = level
+    dest.file.flush()
+    return level_0
+
+
+def stitch_tiles(tiles, dest=None, positions=None, max_shift=20, min_score=0.5, n_processes=None, **kwargs):
+    """Register and blend a set of overlapping tiles into a mosaic (see the module documentation).
+
+    Arguments:
+    tiles : nplab.datafile.Group or list
+        A group containing datasets called tile_0, tile_1..., or a list of tiles (arrays or datasets).
+    dest : nplab.datafile.Group, optional
+        Where to save the mosaic.  By default, a new group called "mosaic_%d" in the current datafile.
+    positions : (N, 2) array, optional
+        The approximate position of each tile in pixels.  By default, they are worked out from the tiles' metadata.
+    max_shift : int
+        The largest error in those positions that we can correct.
+    min_score : float
+        Matches between tiles with a correlation coefficient below this are ignored.
+    n_processes : int, optional
+        The number of processes used to register the tiles.
+
+    Other keyword arguments are passed to `write_mosaic`.  Returns the full-resolution mosaic dataset; the fitted
+    tile positions are saved alongside it, as are the measured offsets between tiles and their scores.
+    """
+    group_attrs = None
+    if hasattr(tiles, "keys"):
+        group_attrs = tiles.attrs
+        tiles = tile_datasets(tiles)
+    if positions is None:
+        positions = nominal_tile_positions(tiles, group_attrs)
+    positions = np.asarray(positions, dtype=np.float64)
+    if dest is None:
+        import nplab
+        dest = nplab.current_datafile().create_group("mosaic_%d")
+    pairs, offsets, scores = register_tiles(tiles, positions, max_shift=max_shift, n_processes=n_processes)
+    fitted_positions = solve_tile_positions(positions, pairs, offsets, scores, min_score=min_score)
+    LOGGER.info("Registered %d tiles using %d pairs; mean correction %.2f pixels" %
+                (len(tiles), len(pairs), np.mean(np.sqrt(np.sum((fitted_positions - positions)**2, axis=1)))))
+    dest.create_dataset("nominal_positions", data=positions, auto_increment=False, autoflush=False)
+    dest.create_dataset("fitted_positions", data=fitted_positions, auto_increment=False, autoflush=False)
+    dest.create_dataset("pair_offsets", data=np.column_stack([pairs, offsets, scores]).reshape(-1, 5),
+                        attrs={"columns": "i, j, row offset, column offset, score"},
+                        auto_increment=False, autoflush=False)
+    return write_mosaic(tiles, fitted_positions, dest, **kwargs)
@@ -16,12 +16,23 @@ Decorating a function with the @locked_action decorator means that only one such
 Decorating a function with @background_action means that it will happen in a thread.  Often you should lock the action to stop multiple threads conflicting.  NB that you should put the @background_action decorator *before* the @locked_action decorator, otherwise the lock won't work.  
 
 A function running in the background returns a thread object; to find the return value, you can call t.join_and_return_result() (you may want to check if the thread has finished first with t.is_alive()).
+
+OrderedWorker
+
+A thread that calls a function on a queue of items, one at a time and in the order they were queued - useful for moving slow processing and saving out of an acquisition loop.
 """
 
 import time
 import threading
 import functools
+import logging
 import numpy as np
+try:
+    import Queue as queue # Python 2
+except ImportError:
+    import queue
+
+LOGGER = logging.getLogger('nplab.utils.thread_utils')
 
 def locked_action_decorator(wait_for_lock=True):
     """This decorates a function, to prevent it being called simultaneously from
@@ -112,6 +123,105 @@ def background_actions_running(obj):
             return True
     return False
 
+class OrderedWorker(threading.Thread):
+    """Call a function in a background thread, once for each item put in its queue.
+
+    `put(*args)` queues a call to `function(*args)` and returns straight
+    away, unless `max_pending` calls are already waiting, in which case it
+    waits for a space (so a fast producer can't fill up the memory).  Calls
+    are made one at a time, in the order they were queued.  If a call raises
+    an exception, the remaining items are discarded and the exception is
+    raised again by the next call to `put` or `finish`.
+
+    Call `start()` before putting items, and `finish()` at the end.
+    """
+    def __init__(self, function, max_pending=16, name=None):
+        super(OrderedWorker, self).__init__(name=name)
+        self.daemon = True
+        self.function = function
+        self.items_done = 0
+        self.error = None
+        self._queue = queue.Queue(max_pending)
+
+    def put(self, *args):
+        """Queue a call to the function with the given arguments."""
+        self.check_for_error()
+        self._queue.put(args)
+
+    @property
+    def items_pending(self):
+        """The (approximate) number of items waiting to be processed."""
+        return self._queue.qsize()
+
+    def run(self):
+        while True:
+            args = self._queue.get()
+            if args is None:
+                return
+            if self.error is not None:
+                continue # discard items after an error
+            try:
+                self.function(*args)
+                self.items_done += 1
+            except Exception as e:
+                LOGGER.exception("Error in background worker {0}".format(self.name))
+                self.error = e
+
+    def finish(self):
+        """Wait for the queued calls to be made, then stop the thread."""
+        self._queue.put(None)
+        self.join()
+        self.check_for_error()
+
+    def check_for_error(self):
+        """Raise the exception from the background thread, if there was one."""
+        if self.error is not None:
+            raise self.error
+
+
+class LatestValueChannel(object):
+    """Pass the latest value of something from one thread to others, e.g. from a scan to its GUI.
+
+    The writer calls `publish(value)` as often as it likes; it never waits,
+    and the value isn't copied.  Each value gets a version number, and a
+    reader that remembers the last version it saw can call
+    `get_if_newer(version)` to get the latest value only if it has changed,
+    skipping any that were published in between.  Nothing is locked: the
+    version and value are replaced together in a single assignment, so
+    readers always see a matching pair.
+
+    Values are passed by reference, so a reader may see changes the writer
+    makes to them afterwards.  That is fine for displaying an array that is
+    being filled in, but if the reader needs a consistent snapshot, the
+    writer should publish a new object each time rather than modifying the
+    old one.
+    """
+    def __init__(self):
+        self._latest = (0, None)
+
+    def publish(self, value):
+        """Make `value` the latest value, and return its version number."""
+        version = self._latest[0] + 1 # only one thread publishes, so this can't race
+        self._latest = (version, value)
+        return version
+
+    @property
+    def version(self):
+        """The version number of the latest value (0 if nothing has been published)."""
+        return self._latest[0]
+
+    def get(self):
+        """Return the latest (version, value)."""
+        return self._latest
+
+    def get_if_newer(self, version):
+        """Return the latest (version, value) if it is newer than `version`, otherwise None."""
+        latest = self._latest
+        if latest[0] > version:
+            return latest
+        return None
+
+
 if __file__ == "__main__":
     import time
     
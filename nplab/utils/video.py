@@ -0,0 +1,215 @@
+"""
+Video Writer
+============
+
+Saving a camera stream to HDF5 one frame at a time, as separate datasets,
+is slow and makes a mess of the file.  `HDF5VideoWriter` appends frames to a
+single dataset, with their timestamps (and sequence numbers) alongside, and
+can compress them on the way.  Compression is done by a pool of worker
+threads (zlib and OpenCV both release the GIL), so that it can keep up with
+the camera; frames are always written in the order they were given.
+
+Codecs:
+
+None
+    Frames are stored uncompressed, in a (frames x height x width [x colour])
+    dataset.
+'gzip'
+    The same layout, with one lossless, deflate-compressed chunk per frame.
+    Chunks are compressed by the worker pool and written directly, so files
+    can be read with any HDF5 software.
+'lzf'
+    The same layout, compressed by h5py's (fast, lossless) LZF filter.  This
+    is done by h5py in the writing thread, not the worker pool.
+'jpeg', 'png'
+    Each frame is encoded with `nplab.utils.image.jpeg_encode` or
+    `png_encode` and stored as one element of a variable-length uint8
+    dataset.  Use `decode_frame` to get the image back.
+"""
+
+import zlib
+import collections
+import threading
+from multiprocessing.pool import ThreadPool
+import numpy as np
+import h5py
+
+CODECS = (None, 'gzip', 'lzf', 'jpeg', 'png')
+
+
+def _gzip_encode(frame, level):
+    return np.frombuffer(zlib.compress(np.ascontiguousarray(frame).tobytes(), level), dtype=np.uint8)
+
+
+def _jpeg_encode(frame, quality):
+    from nplab.utils.image import jpeg_encode
+    return jpeg_encode(frame, quality)
+
+
+def _png_encode(frame, compression):
+    from nplab.utils.image import png_encode
+    return png_encode(frame, compression)
+
+
+def decode_frame(dataset, index):
+    """Return frame `index` from a dataset written by `HDF5VideoWriter`, as an image."""
+    image_format = dataset.attrs.get('image_format', 'raw')
+    if isinstance(image_format, bytes):
+        image_format = image_format.decode()
+    if image_format == 'jpeg':
+        from nplab.utils.image import jpeg_decode
+        return jpeg_decode(dataset[index])
+    elif image_format == 'png':
+        from nplab.utils.image import png_decode
+        return png_decode(dataset[index])
+    else:
+        return dataset[index]
+
+
+class HDF5VideoWriter(object):
+    """Append video frames to a "frames" dataset in an HDF5 group.
+
+    Arguments:
+    data_group : nplab.datafile.Group
+        The group to write into; it gets datasets called "frames",
+        "timestamps" and "sequence_numbers".
+    frame_shape : tuple
+        The shape of each frame, e.g. (height, width, 3).
+    dtype : numpy dtype
+        The type of the frames (JPEG and PNG need uint8).
+    codec : None, 'gzip', 'lzf', 'jpeg' or 'png'
+        How to compress the frames (see the module documentation).
+    quality : int, optional
+        The JPEG quality (default 90), PNG compression (default 3) or gzip
+        level (default 4).
+    n_workers : int
+        The number of threads used for compression.
+    chunk_frames : int
+        Frames per chunk for uncompressed and LZF video.
+    attrs : dict, optional
+        Metadata saved on the "frames" dataset.
+
+    Call `write` with each frame (or block of frames) and `close` at the end.
+    """
+    def __init__(self, data_group, frame_shape, dtype=np.uint8, codec=None, quality=None,
+                 n_workers=4, chunk_frames=8, attrs=None):
+        if codec not in CODECS:
+            raise ValueError("codec must be one of {0}".format(CODECS))
+        frame_shape = tuple(frame_shape)
+        dtype = np.dtype(dtype)
+        if codec in ('jpeg', 'png') and dtype != np.uint8:
+            raise ValueError("Only 8-bit images can be saved as {0}".format(codec))
+        self.codec = codec
+        self.frame_shape = frame_shape
+        self.frames_written = 0
+        self._pending = collections.deque()
+        self._pool = None
+        if codec in ('gzip', 'jpeg', 'png'):
+            self._pool = ThreadPool(n_workers)
+            self._max_pending = 4 * n_workers
+        if codec == 'gzip':
+            self.quality = 4 if quality is None else quality
+            self._encode = _gzip_encode
+        elif codec == 'jpeg':
+            self.quality = 90 if quality is None else quality
+            self._encode = _jpeg_encode
+        elif codec == 'png':
+            self.quality = 3 if quality is None else quality
+            self._encode = _png_encode
+
+        if codec in ('jpeg', 'png'):
+            self.frames = data_group.create_dataset("frames", shape=(0,), maxshape=(None,),
+                                                    dtype=h5py.special_dtype(vlen=np.dtype(np.uint8)),
+                                                    chunks=(64,), auto_increment=False, autoflush=False,
+                                                    attrs=attrs)
+            self.frames.attrs['image_format'] = codec
+            self.frames.attrs['frame_shape'] = frame_shape
+        else:
+            chunk_frames = 1 if codec == 'gzip' else chunk_frames
+            self.frames = data_group.create_dataset("frames", shape=(0,) + frame_shape,
+                                                    maxshape=(None,) + frame_shape,
+                                                    chunks=(chunk_frames,) + frame_shape, dtype=dtype,
+                                                    compression=codec,
+                                                    compression_opts=self.quality if codec == 'gzip' else None,
+                                                    auto_increment=False, autoflush=False, attrs=attrs)
+        self.timestamps = data_group.create_dataset("timestamps", shape=(0,), maxshape=(None,), chunks=(1024,),
+                                                    dtype=np.float64, auto_increment=False, autoflush=False)
+        self.sequence_numbers = data_group.create_dataset("sequence_numbers", shape=(0,), maxshape=(None,),
+                                                          chunks=(1024,), dtype=np.int64,
+                                                          auto_increment=False, autoflush=False)
+        self._lock = threading.Lock()
+        self._closed = False
+
+    def write(self, frames, timestamps, sequence_numbers=None):
+        """Add a block of frames (the first axis indexes the frames) to the video.
+
+        With a compressing codec, this returns as soon as the frames have been
+        queued for compression (unless the queue is full); they are written
+        once compressed.  Frames are always saved in order.
+        """
+        frames = np.asarray(frames)
+        timestamps = np.atleast_1d(timestamps)
+        if frames.shape == self.frame_shape:
+            frames = frames[np.newaxis, ...]
+        if sequence_numbers is None:
+            sequence_numbers = -np.ones(len(frames), dtype=np.int64)
+        with self._lock:
+            if self._closed:
+                raise ValueError("Can't write to a video that has been closed")
+            if self._pool is None:
+                self._write_frames(frames, timestamps, sequence_numbers)
+                return
+            for frame, timestamp, sequence_number in zip(frames, timestamps, sequence_numbers):
+                result = self._pool.apply_async(self._encode, (frame, self.quality))
+                self._pending.append((result, timestamp, sequence_number))
+            self._write_encoded_frames(block=False)
+            while len(self._pending) > self._max_pending:
+                self._write_encoded_frames(block=True, max_frames=len(self._pending) - self._max_pending)
+
+    def _write_frames(self, frames, timestamps, sequence_numbers):
+        n = self.frames_written
+        self.frames.resize(n + len(frames), axis=0)
+        self.frames[n:n + len(frames), ...] = frames
+        self._write_timestamps(timestamps, sequence_numbers)
+
+    def _write_timestamps(self, timestamps, sequence_numbers):
+        n = self.frames_written
+        self.timestamps.resize(n + len(timestamps), axis=0)
+        self.timestamps[n:] = timestamps
+        self.sequence_numbers.resize(n + len(timestamps), axis=0)
+        self.sequence_numbers[n:] = sequence_numbers
+        self.frames_written += len(timestamps)
+
+    def _write_encoded_frames(self, block=False, max_frames=None):
+        """Write compressed frames, in order, as long as they are ready (or until max_frames if block)."""
+        encoded, timestamps, sequence_numbers = [], [], []
+        while self._pending and (max_frames is None or len(encoded) < max_frames):
+            result, timestamp, sequence_number = self._pending[0]
+            if not block and not result.ready():
+                break
+            encoded.append(result.get())
+            timestamps.append(timestamp)
+            sequence_numbers.append(sequence_number)
+            self._pending.popleft()
+        if len(encoded) == 0:
+            return
+        n = self.frames_written
+        self.frames.resize(n + len(encoded), axis=0)
+        if self.codec == 'gzip':
+            for i, chunk in enumerate(encoded):
+                self.frames.id.write_direct_chunk((n + i,) + (0,) * len(self.frame_shape), chunk.tobytes())
+        else:
+            for i, image in enumerate(encoded):
+                self.frames[n + i] = np.asarray(image).ravel() # OpenCV returns an Nx1 array
+        self._write_timestamps(timestamps, sequence_numbers)
+
+    def close(self):
+        """Wait for all the frames to be written, then stop the worker threads."""
+        with self._lock:
+            self._closed = True
+            self._write_encoded_frames(block=True)
+            if self._pool is not None:
+                self._pool.close()
+                self._pool.join()
+                self._pool = None
+            self.frames.file.flush()
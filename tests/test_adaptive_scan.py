@@ -0,0 +1,53 @@
+import numpy as np
+import nplab.datafile as df
+from nplab.instrument.stage import DummyStage
+from nplab.experiment.scanning_experiment import AdaptiveScan
+
+PARTICLES = np.array([[2.1e-6, -3.3e-6], [-4.0e-6, 1.6e-6]]) # (y, x), in the order of the grid's dimensions
+
+
+class ParticleScan(AdaptiveScan):
+    """A few Gaussian particles on a noisy background."""
+    def __init__(self):
+        AdaptiveScan.__init__(self)
+        self.set_stage(DummyStage(), axes=('x1', 'y1'))
+        self.size[:] = 10e-6 / 1e-6 # 11 x 11 coarse points, 1um apart
+        self.step[:] = 1
+        self.init[:] = 0
+        self.random = np.random.RandomState(0)
+
+    def open_scan(self):
+        self.processed = np.zeros(self.grid_shape, dtype=bool)
+
+    def acquire(self, *indices):
+        position = np.array([self.scan_axes[d][i] for d, i in enumerate(indices)])
+        distances = np.sqrt(np.sum((PARTICLES - position)**2, axis=1))
+        return 1 + np.sum(np.exp(-distances**2 / (2 * 0.4e-6**2))) + 0.01 * self.random.randn(4)
+
+    def process_and_store(self, data, *indices):
+        self.processed[indices] = True
+
+
+def test_adaptive_scan(tmpdir):
+    scan = ParticleScan()
+    for pipelined in (False, True):
+        scan.pipelined = pipelined
+        scan.scan(scan.axes, scan.size, scan.step, scan.init)
+        assert scan.coarse_shape == (11, 11) and scan.grid_shape == (41, 41)
+        assert np.all(scan.processed == scan.measured)
+        n_points = len(scan.interest)
+        assert np.sum(scan.levels == 0) == 121
+        assert n_points < 41 * 41 / 5.0, "Most of the fine grid should be skipped"
+        assert len(np.unique(scan.point_indices, axis=0)) == n_points, "Points shouldn't be measured twice"
+        for particle in PARTICLES: # each particle should have been found at the finest resolution
+            nearest = np.argmin(np.sum((scan.positions - particle)**2, axis=1))
+            assert np.all(abs(scan.positions[nearest] - particle) <= 0.125e-6 + 1e-12)
+            assert scan.levels[nearest] > 0
+        resampled = scan.resampled_interest()
+        assert resampled.shape == scan.grid_shape and np.all(np.isfinite(resampled))
+        assert np.allclose(resampled[scan.measured], scan.interest_map[scan.measured])
+
+    f = df.DataFile(str(tmpdir.join("adaptive.h5")), mode='w')
+    scan.save_points(f)
+    assert f['positions'].shape == (n_points, 2) and f['resampled_interest'].shape == (41, 41)
+    f.close()
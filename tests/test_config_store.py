@@ -0,0 +1,28 @@
+import os
+import numpy as np
+from nplab.utils.config_store import ConfigStore, get_config_store
+
+def test_debounced_write(tmpdir):
+    fname = str(tmpdir.join("test_config.h5"))
+    store = ConfigStore(fname, delay=10)
+    store.set('background', np.arange(5))
+    store.set('background_int', 100)
+    assert not os.path.exists(fname), "The store was written before the debounce delay"
+    store.flush()
+    assert os.path.exists(fname), "flush() didn't write the file"
+
+    reloaded = ConfigStore(fname)
+    assert 'background' in reloaded
+    assert np.all(reloaded['background'] == np.arange(5))
+    assert reloaded['background_int'][...] == 100
+
+def test_legacy_file_and_namespaces(tmpdir):
+    legacy = ConfigStore(str(tmpdir.join("config.h5")))
+    legacy['reference'] = np.ones(3)
+    legacy.flush()
+
+    a = get_config_store(str(tmpdir), "Spectrometer_A", legacy_filename=legacy.filename)
+    b = get_config_store(str(tmpdir), "Spectrometer_B")
+    assert a is get_config_store(str(tmpdir), "Spectrometer_A"), "Stores should be shared"
+    assert np.all(a['reference'] == 1), "Values weren't read from the legacy file"
+    assert 'reference' not in b, "Namespaces should be kept separate"
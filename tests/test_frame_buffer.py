@@ -0,0 +1,78 @@
+import threading
+import numpy as np
+import nplab.datafile as df
+from nplab.utils.frame_buffer import FrameRingBuffer, FrameBufferReader, FrameSpooler
+
+def test_ring_buffer_drops_old_frames():
+    buf = FrameRingBuffer(4, (2, 3), dtype=np.intc)
+    assert buf.latest_sequence_number == -1
+    for i in range(10):
+        assert buf.put(np.full((2, 3), i)) == i
+    frames, seqs, timestamps, n_dropped = buf.get_frames_since(-1)
+    assert list(seqs) == [6, 7, 8, 9], "The buffer should hold the last 4 frames"
+    assert n_dropped == 6, "Overwritten frames should be counted as dropped"
+    assert np.all(frames[:, 0, 0] == seqs)
+    assert np.all(np.diff(timestamps) >= 0)
+
+    frames, seqs, timestamps, n_dropped = buf.get_frames_since(7, max_frames=1)
+    assert list(seqs) == [8] and n_dropped == 0
+    frames, seqs, timestamps, n_dropped = buf.get_frames_since(9)
+    assert len(seqs) == 0 and n_dropped == 0
+
+    frame, seq, timestamp = buf.latest_frame()
+    assert seq == 9 and np.all(frame == 9)
+
+def test_writing_in_place():
+    buf = FrameRingBuffer(2, (5,))
+    slot = buf.writable_frame()
+    slot[:] = 7
+    assert len(buf.get_frames_since(-1)[1]) == 0, "Uncommitted frames shouldn't be visible"
+    assert buf.commit_frame(timestamp=1.5) == 0
+    frames, seqs, timestamps, n_dropped = buf.get_frames_since(-1)
+    assert np.all(frames[0] == 7) and timestamps[0] == 1.5
+
+def test_readers_count_dropped_frames():
+    buf = FrameRingBuffer(4, (1,))
+    fast, slow = FrameBufferReader(buf), FrameBufferReader(buf)
+    for i in range(6):
+        buf.put(i)
+        frames, seqs, timestamps = fast.read()
+        assert list(seqs) == [i]
+    frames, seqs, timestamps = slow.read()
+    assert list(seqs) == [2, 3, 4, 5]
+    assert slow.frames_dropped == 2 and fast.frames_dropped == 0
+    assert len(slow.read(timeout=0.01)[1]) == 0, "Frames should only be read once"
+
+    # a replacement buffer carries on the sequence numbers
+    new_buf = FrameRingBuffer(4, (2,), first_sequence_number=8)
+    reader = FrameBufferReader(lambda: new_buf, start_after=5)
+    new_buf.put([1, 2])
+    frames, seqs, timestamps = reader.read()
+    assert list(seqs) == [8] and reader.frames_dropped == 2
+
+def test_spooler(tmpdir):
+    f = df.DataFile(str(tmpdir.join("spool.h5")), mode='w')
+    buf = FrameRingBuffer(64, (8, 8), dtype=np.uint16)
+    spooler = FrameSpooler(buf, f.create_group("series"), chunk_frames=4,
+                           transform=lambda frames: frames[..., ::-1])
+
+    def produce():
+        for i in range(50):
+            frame = buf.writable_frame()
+            frame[...] = np.arange(8)
+            frame[0, 0] = i
+            buf.commit_frame()
+    spooler.start()
+    producer = threading.Thread(target=produce)
+    producer.start()
+    producer.join()
+    spooler.stop()
+
+    frames = f['series/frames']
+    assert frames.shape == (50, 8, 8), "All the frames should have been saved"
+    assert frames.chunks == (4, 8, 8)
+    assert np.all(frames[:, 0, -1] == np.arange(50)), "Frames were saved out of order"
+    assert np.all(frames[:, 1, :] == np.arange(8)[::-1]), "The transform wasn't applied"
+    assert f['series/timestamps'].shape == (50,)
+    assert frames.attrs['frames_dropped'] == 0
+    f.close()
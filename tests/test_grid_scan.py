@@ -0,0 +1,278 @@
+import threading
+import time
+import numpy as np
+import pytest
+from nplab.utils.thread_utils import OrderedWorker, LatestValueChannel
+from nplab.instrument.stage import DummyStage
+from nplab.experiment.scanning_experiment import GridScan
+from nplab.experiment.scanning_experiment import StepProfiler
+
+
+def test_ordered_worker():
+    results = []
+    worker = OrderedWorker(lambda i, x: results.append((i, x, threading.current_thread().name)),
+                           max_pending=2, name="worker")
+    worker.start()
+    for i in range(20):
+        worker.put(i, 2 * i)
+        assert worker.items_pending <= 2
+    worker.finish()
+    assert [r[:2] for r in results] == [(i, 2 * i) for i in range(20)], "Items were processed out of order"
+    assert all(r[2] == "worker" for r in results)
+    assert worker.items_done == 20 and not worker.is_alive()
+
+    def fail(i):
+        if i == 3:
+            raise ValueError("bad item")
+        results.append(i)
+    del results[:]
+    worker = OrderedWorker(fail)
+    worker.start()
+    with pytest.raises(ValueError): # from put, if the error happens before we've queued all the items
+        for i in range(10):
+            worker.put(i)
+        worker.finish()
+    assert results == [0, 1, 2], "Items after an error should be discarded"
+
+
+def test_latest_value_channel():
+    channel = LatestValueChannel()
+    assert channel.get() == (0, None) and channel.get_if_newer(0) is None
+    data = np.zeros(3)
+    assert channel.publish(data) == 1
+    version, value = channel.get_if_newer(0)
+    assert version == 1 and value is data, "Values shouldn't be copied"
+    assert channel.get_if_newer(version) is None, "Readers should only get values that have changed"
+    channel.publish('b')
+    channel.publish('c')
+    assert channel.get_if_newer(version) == (3, 'c'), "Readers should skip straight to the latest value"
+
+    # one writer and several readers, none of which should ever wait or see values out of order
+    def write():
+        for i in range(1, 20001):
+            channel.publish(i)
+    def read(seen):
+        version = channel.version
+        while writer.is_alive() or channel.version > version:
+            latest = channel.get_if_newer(version)
+            if latest is not None:
+                assert latest[1] == latest[0] - 3 and latest[0] > version
+                version = latest[0]
+                seen.append(version)
+    writer = threading.Thread(target=write)
+    seen = [[], []]
+    readers = [threading.Thread(target=read, args=(s,)) for s in seen]
+    writer.start()
+    for reader in readers:
+        reader.start()
+    writer.join()
+    for reader in readers:
+        reader.join()
+    assert all(s[-1] == 20003 for s in seen)
+
+
+class PipelinedScan(GridScan):
+    def __init__(self, processing_time=0.0):
+        GridScan.__init__(self)
+        self.processing_time = processing_time
+        self.set_stage(DummyStage(), axes=('x1', 'y1'))
+        self.size[:] = 3e-6
+        self.step[:] = 1e-6
+        self.init[:] = 0
+        self.abort_at = None
+
+    def open_scan(self):
+        self.data = np.full(self.grid_shape, np.nan)
+        self.acquired = []
+        self.processed = []
+        self.processing_threads = set()
+
+    def acquire(self, *indices):
+        self.acquired.append(indices)
+        if len(self.acquired) == self.abort_at:
+            self.abort_requested = True
+        return 10 * indices[0] + indices[1]
+
+    def process_and_store(self, data, *indices):
+        with self.profile_phase('write', *indices):
+            time.sleep(self.processing_time)
+        self.processing_threads.add(threading.current_thread().name)
+        self.processed.append(indices)
+        self.data[indices] = data
+        self.check_for_data_request(self.data, indices)
+
+    def analyse_scan(self):
+        self.points_processed_before_analysis = len(self.processed)
+
+
+def test_pipelined_grid_scan():
+    scan = PipelinedScan()
+    scan.scan(scan.axes, scan.size, scan.step, scan.init)
+    expected = 10 * np.arange(4)[:, np.newaxis] + np.arange(4)[np.newaxis, :]
+    assert np.all(scan.data == expected)
+    assert scan.processing_threads == {threading.current_thread().name}, "Unpipelined scans shouldn't use a thread"
+    data, indices = scan.request_data()
+    assert data is scan.data and indices == (3, 3), "The GUI should get the latest data straight away"
+    assert scan.request_data() is False, "The GUI should only get data when there's something new"
+
+    scan.pipelined = True
+    scan.processing_time = 0.005
+    scan.scan(scan.axes, scan.size, scan.step, scan.init)
+    assert np.all(scan.data == expected), "Data was lost or misplaced by the pipeline"
+    assert scan.processed == scan.acquired, "Points were processed out of order"
+    assert threading.current_thread().name not in scan.processing_threads
+    assert scan.points_processed_before_analysis == 16, "The pipeline should be drained before analysis"
+
+    scan.abort_at = 6  # abort while points are still waiting to be processed
+    scan.processing_time = 0.02
+    scan.scan(scan.axes, scan.size, scan.step, scan.init)
+    assert 6 <= len(scan.acquired) < 16
+    assert scan.processed == scan.acquired, "Points acquired before an abort should still be saved"
+    assert scan.points_processed_before_analysis == len(scan.acquired)
+
+
+def test_step_profiler(tmpdir):
+    profiler = StepProfiler()
+    profiler.reset(3)
+    profiler.start_step(0)
+    with profiler.phase('acquire', 0):
+        time.sleep(0.02)
+        with profiler.phase('process', 0):
+            time.sleep(0.01)
+    profiler.add('move', 1, 0.5)
+    profiler.add('move', 1, 0.25)
+    profiler.add('move', None, 1) # no point - ignored
+    steps = profiler.steps
+    assert 0.015 < steps['acquire'][0] < 0.03, "Nested phases should be subtracted"
+    assert 0.01 <= steps['process'][0] < 0.02
+    assert steps['move'][1] == 0.75 and np.isnan(steps['move'][0]) and np.isnan(steps['start'][1])
+    assert profiler.steps_started == 1 and np.isnan(profiler.step_interval())
+    assert set(profiler.summary().keys()) == {'move', 'acquire', 'process'}
+    assert 'move' in profiler.format_summary()
+
+    profiler.steps['start'] = [0, 1, 3]
+    assert profiler.step_interval() == 1.5
+    assert profiler.estimated_time_remaining(10) == 15
+
+    import nplab.datafile as df
+    f = df.DataFile(str(tmpdir.join("profile.h5")), mode='w')
+    profiler.save(f)
+    assert f['step_profile'].dtype == profiler.dtype
+    assert f['step_profile'][1]['move'] == 0.75
+    f.close()
+
+
+def test_grid_scan_is_profiled():
+    scan = PipelinedScan(processing_time=0.002)
+    for pipelined in (False, True):
+        scan.pipelined = pipelined
+        scan.scan(scan.axes, scan.size, scan.step, scan.init)
+        steps = scan.profiler.steps
+        assert len(steps) == 16 and np.all(np.isfinite(steps['start']))
+        assert np.all(np.isfinite(steps['acquire'])) and np.all(steps['write'] >= 0.002)
+        assert np.median(steps['process']) < 0.002, "Time spent writing shouldn't count as processing"
+        assert np.sum(np.isfinite(steps['move'])) >= 15
+        assert scan.get_estimated_time_remaining() == 0
+
+
+class ResumedScan(PipelinedScan):
+    """Pretend the first few points were done by an earlier scan."""
+    def open_scan(self):
+        PipelinedScan.open_scan(self)
+        self.completed.flat[:6] = True
+
+
+def test_grid_scan_skips_completed_points():
+    scan = ResumedScan()
+    for pipelined in (False, True):
+        scan.pipelined = pipelined
+        scan.scan(scan.axes, scan.size, scan.step, scan.init)
+        assert len(scan.acquired) == 10 and all(scan.completed[i] for i in scan.acquired)
+        assert (0, 0) not in scan.acquired and (1, 1) not in scan.acquired
+        assert scan.acquired[0] == (1, 2), "The snaking pattern should be the same as for a full scan"
+        assert np.all(scan.completed)
+
+
+class HookedScan(PipelinedScan):
+    def open_scan(self):
+        PipelinedScan.open_scan(self)
+        self.layers = []
+
+    def outer_loop_start(self):
+        self.layers.append(self.indices)
+
+
+def test_scan_paths():
+    scan = HookedScan()
+    scan.scan_path_seed = 3
+    scan.scan(scan.axes, scan.size, scan.step, scan.init)
+    assert len(scan.layers) == 4 and scan.acquired[:5] == [(0, 3), (0, 2), (0, 1), (0, 0), (1, 0)]
+    expected = 10 * np.arange(4)[:, np.newaxis] + np.arange(4)[np.newaxis, :]
+    for path in ('hilbert', 'spiral', 'random'):
+        scan.scan_path = path
+        scan.scan(scan.axes, scan.size, scan.step, scan.init)
+        assert scan.acquired == [tuple(p) for p in scan.path_indices()]
+        assert np.all(scan.data == expected)
+    scan.scan_path = np.array([[2, 2], [0, 1], [3, 0]])
+    scan.scan(scan.axes, scan.size, scan.step, scan.init)
+    assert scan.acquired == [(2, 2), (0, 1), (3, 0)] and np.sum(scan.completed) == 3
+    assert scan.layers == [(2, 2), (0, 1), (3, 0)]
+    scan.scan_path = np.array([[4, 0]])
+    with pytest.raises(ValueError):
+        scan.path_indices()
+
+
+def test_bin_onto_axis():
+    from nplab.experiment.scanning_experiment.fly_scan import bin_onto_axis
+    axis = np.arange(5.0)[::-1] # the points may be in either order
+    positions = np.array([-0.4, 0.1, 0.45, 2.2, 2.4, 4.3, 4.6, 5.0])
+    data = np.stack([positions, -positions], axis=1)
+    binned, counts = bin_onto_axis(positions, data, axis)
+    assert list(counts) == [1, 0, 2, 0, 3], "Acquisitions beyond half a step from the ends should be ignored"
+    assert np.allclose(binned[4], [0.05, -0.05]) and np.allclose(binned[2], [2.3, -2.3])
+    assert np.allclose(binned[3], (binned[4] + binned[2]) / 2), "Empty points should be interpolated"
+    assert np.allclose(binned[0], [4.3, -4.3]) and np.allclose(binned[1], (binned[0] + binned[2]) / 2)
+    binned, counts = bin_onto_axis(positions, data, axis, fill=False)
+    assert np.all(np.isnan(binned[counts == 0]))
+
+
+class FlyScan(GridScan):
+    """Each acquisition measures the X position of the stage."""
+    def __init__(self):
+        from nplab.instrument.stage.simulated import SimulatedStage
+        GridScan.__init__(self)
+        self.set_stage(SimulatedStage(axis_names=('x', 'y'), settling_time=0, communication_latency=0.0005),
+                       axes=('x', 'y'))
+        self.stage_units = 1e-6
+        self.size[:] = (10, 2)
+        self.step[:] = 1
+        self.init[:] = 0
+        self.fly_scan = True
+        self.fly_samples_per_point = 4
+
+    def open_scan(self):
+        self.data = np.full(self.grid_shape, np.nan)
+
+    def acquire(self, *indices):
+        time.sleep(0.001)
+        position = self.stage._true_position()[0] * self.stage_units # in the middle of the "exposure"
+        time.sleep(0.001)
+        return position
+
+    def process_and_store(self, data, *indices):
+        self.data[indices] = data
+
+
+def test_fly_scan():
+    scan = FlyScan()
+    for pipelined, position_source in ((False, 'poll'), (True, 'trajectory')):
+        scan.pipelined = pipelined
+        scan.fly_position_source = position_source
+        scan.scan(scan.axes, scan.size, scan.step, scan.init)
+        assert scan.data.shape == (3, 11) and np.all(scan.completed)
+        x = scan.scan_axes[1]
+        error = abs(scan.data - x[np.newaxis, :])
+        assert np.all(error < 1e-6) and np.median(error) < 0.2e-6, "Acquisitions were binned in the wrong place"
+        assert np.mean(scan.acquisitions_per_point) > 1.5, "The stage should sweep slowly enough to sample each point"
+        assert np.all(np.isfinite(scan.profiler.steps['acquire']))
+        assert scan.stage.velocity[0] == 1000.0, "The stage's speed should be restored"
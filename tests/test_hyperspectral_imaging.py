@@ -0,0 +1,134 @@
+import gc
+import numpy as np
+import nplab.datafile as df
+from nplab.utils.gui import get_qt_app
+from nplab.instrument.stage.simulated import SimulatedStage
+from nplab.instrument.spectrometer.simulated import SimulatedSpectrometer
+from nplab.experiment.hyperspectral_imaging import HyperspectralScan
+
+
+class LabelledSpectraScan(HyperspectralScan):
+    """Every spectrum is filled with a number that says where it was taken."""
+    abort_at = None
+
+    def acquire(self, *indices):
+        self.points_acquired += 1
+        if self.points_acquired == self.abort_at:
+            self.abort_requested = True
+        return np.full(self.spectrometer.wavelengths.size, 100.0 * indices[0] + indices[1])
+
+    def open_scan(self):
+        self.points_acquired = 0
+        HyperspectralScan.open_scan(self)
+
+
+def make_scan(tmpdir, scan_class=LabelledSpectraScan, **kwargs):
+    get_qt_app()
+    spectrometer = SimulatedSpectrometer(wavelengths=np.linspace(400, 900, 64), readout_time=0)
+    spectrometer.background = np.ones(64)
+    df.set_current(str(tmpdir.join("hyperspectral.h5")), mode='a')
+    scan = scan_class()
+    scan.num_axes = 2
+    scan.set_stage(SimulatedStage(settling_time=0, communication_latency=0), axes=('x', 'y'))
+    scan.set_spectrometers(spectrometer)
+    scan.stage_units = 1e-6
+    scan.size[:] = (4, 5)
+    scan.step[:] = 1
+    for key, value in kwargs.items():
+        setattr(scan, key, value)
+    return scan
+
+
+def teardown_function(function):
+    gc.collect() # the scan thread refers back to the scan, so it's not freed straight away
+
+
+def test_spectra_are_saved_by_line(tmpdir):
+    expected = 100.0 * np.arange(6)[:, np.newaxis] + np.arange(5)[np.newaxis, :]
+    for line_buffered in (False, True):
+        scan = make_scan(tmpdir, line_buffered=line_buffered, storage_dtype=np.float32)
+        scan.run()
+        scan.acquisition_thread.join()
+        raw, processed = scan.data['raw_data/hs_image'], scan.data['hs_image']
+        assert raw.shape == (6, 5, 64)
+        if line_buffered:
+            assert raw.chunks == (1, 5, 64), "Chunks should hold one line"
+        assert raw.dtype == np.float32
+        assert np.all(raw[...] == expected[..., np.newaxis])
+        assert np.all(processed[...] == expected[..., np.newaxis] - 1)
+        profile = scan.data['step_profile']
+        assert profile.shape == (30,) and np.all(np.isfinite(profile['acquire']))
+        assert np.sum(np.isfinite(profile['write'])) == (6 if line_buffered else 30)
+
+
+def test_aborted_scan_saves_partial_line(tmpdir):
+    scan = make_scan(tmpdir, abort_at=8)
+    scan.run()
+    scan.acquisition_thread.join()
+    raw = scan.data['raw_data/hs_image'][..., 0]
+    assert np.all(raw[0] == 100 * 0 + np.arange(5))
+    # lines alternate direction, starting backwards, so the first three points of line 2 were scanned
+    assert np.all(raw[1] == [100, 101, 102, 0, 0])
+    assert np.all(raw[2:] == 0)
+
+
+class SlopingSpectraScan(LabelledSpectraScan):
+    """The spectra also increase with wavelength."""
+    def acquire(self, *indices):
+        return LabelledSpectraScan.acquire(self, *indices) + self.spectrometer.wavelengths / 1000.0
+
+
+def test_preview_is_kept_in_memory(tmpdir):
+    scan = make_scan(tmpdir, SlopingSpectraScan, preview_bands=[(500, 600)], view_wavelength=650)
+    scan.run()
+    scan.acquisition_thread.join()
+    wavelengths = scan.spectrometer.wavelengths
+    labels = 100.0 * np.arange(6)[:, np.newaxis] + np.arange(5)[np.newaxis, :] - 1 # the background is 1
+    w = np.argmin(abs(wavelengths - 650))
+    assert np.allclose(scan.preview_images[0], labels + wavelengths[w] / 1000.0)
+    band = (wavelengths >= 500) & (wavelengths <= 600)
+    assert np.allclose(scan.band_images[0][..., 0],
+                       np.trapz(labels[..., np.newaxis] + wavelengths[band] / 1000.0, wavelengths[band]))
+
+    image, preview_wavelengths, spectrum = scan.set_latest_view(*scan.indices)
+    assert image is scan.preview_images[0], "The preview shouldn't be copied"
+    published = scan.request_data()
+    assert published[0] is scan.preview_images[0] and np.all(published[2] == spectrum)
+    assert np.allclose(spectrum, scan.data['hs_image'][scan.indices])
+
+    scan.data = None # make sure the preview isn't redrawn from the file
+    scan.view_wavelength = wavelengths[17]
+    # spectra are averaged over bins of 8 points, and the 17th point is in the third bin
+    assert np.allclose(scan.preview_images[0], labels + np.mean(wavelengths[16:24]) / 1000.0)
+
+
+def test_aborted_scan_can_be_resumed(tmpdir):
+    scan = make_scan(tmpdir, abort_at=8)
+    scan.run()
+    scan.acquisition_thread.join()
+    group = scan.data
+    assert np.sum(group['completed'][...]) == 8
+    assert group.attrs['size_unit'] == 'um' and np.all(group.attrs['grid_shape'] == (6, 5))
+
+    scan.abort_at = None
+    scan.size[:] = 1 # the parameters should come from the file
+    scan.resume(group)
+    scan.acquisition_thread.join()
+    assert scan.data == group and scan.grid_shape == (6, 5)
+    assert scan.points_acquired == 30 - 8, "Only the points that weren't finished should be scanned"
+    expected = 100.0 * np.arange(6)[:, np.newaxis] + np.arange(5)[np.newaxis, :]
+    assert np.all(group['raw_data/hs_image'][...] == expected[..., np.newaxis])
+    assert np.all(group['completed'][...])
+    assert np.allclose(scan.preview_images[0], expected - 1), "The preview should include the earlier points"
+
+
+def test_fly_scan(tmpdir):
+    scan = make_scan(tmpdir, fly_scan=True)
+    scan.spectrometer.integration_time = 1
+    scan.run()
+    scan.acquisition_thread.join()
+    hs_image = scan.data['hs_image']
+    assert hs_image.shape == (6, 5, 64), "Fly scans should be saved like stepped scans"
+    assert np.all(np.isfinite(hs_image[...])) and np.all(scan.data['completed'][...])
+    assert scan.points_acquired == 0, "Fly scans shouldn't wait to acquire at each point"
+    assert np.sum(scan.acquisitions_per_point) > 30
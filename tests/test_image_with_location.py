@@ -32,6 +32,25 @@ def test_metadata_slicing():
     assert np.all(sliced_iwl.datum_location == sample_iwl.datum_location), \
         "The position shift was incorrect for step==2"
 
+def test_feature_locator_methods():
+    from scipy import ndimage
+    from nplab.utils.image_with_location import FeatureLocator, locate_feature_in_image
+    rs = np.random.RandomState(0)
+    texture = ndimage.gaussian_filter(rs.random_sample((200, 240)), 3)
+    texture = (255 * (texture - texture.min()) / (texture.max() - texture.min())).astype(np.uint8)
+    feature = ImageWithLocation(texture[50:150, 60:180])
+    feature.datum_pixel = np.array([50.0, 60.0])
+    shift = np.array([7.3, -12.6])
+    image = np.clip(ndimage.shift(texture.astype(np.float64), shift), 0, 255).astype(np.uint8)
+    expected = np.array([100.0, 120.0]) + shift
+    for method in FeatureLocator.methods:
+        locator = FeatureLocator(feature, method=method)
+        for margin in [0, 20]:
+            position = locator.locate(image, margin=margin, restrict=margin > 0)
+            assert np.all(np.abs(position - expected) < 0.3), \
+                "{0} found the feature at {1}, not {2}".format(method, position, expected)
+        assert np.all(np.abs(locate_feature_in_image(image, feature, method=method) - expected) < 0.3)
+
 if __name__ == "__main__":
     try:
         test_metadata_slicing()
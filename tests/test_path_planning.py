@@ -0,0 +1,62 @@
+import itertools
+import numpy as np
+import pytest
+from nplab.utils.path_planning import plan_path, nearest_neighbour_order, two_opt, path_cost, snake_raster, \
+    grid_path, grid_path_indices
+
+def test_small_paths_are_nearly_optimal():
+    rng = np.random.RandomState(0)
+    ratios = []
+    for trial in range(20):
+        points = rng.uniform(0, 100, (7, 2))
+        start = np.zeros(2)
+        best = min(path_cost(points, order, start) for order in itertools.permutations(range(7)))
+        order = plan_path(points, start=start)
+        assert sorted(order) == list(range(7))
+        ratios.append(path_cost(points, order, start) / best)
+    assert np.mean(ratios) < 1.03 and np.max(ratios) < 1.15, "2-opt should find a near-optimal path"
+
+def test_large_path_is_much_shorter():
+    rng = np.random.RandomState(1)
+    points = rng.uniform(0, 400, (3000, 2))
+    nn = nearest_neighbour_order(points, start=[0, 0])
+    assert sorted(nn) == list(range(3000))
+    improved = two_opt(points, nn, start=[0, 0])
+    assert sorted(improved) == list(range(3000))
+    assert path_cost(points, improved, [0, 0]) < path_cost(points, nn, [0, 0])
+    assert path_cost(points, nn, [0, 0]) < 0.05 * path_cost(points, None, [0, 0])
+
+def test_velocity_limits_change_the_path():
+    # A column of points: with a slow Y axis, sweeping along X first is quicker
+    points = np.array([[x, y] for x in range(5) for y in range(5)], dtype=float)
+    velocity = [100.0, 1.0]
+    order = plan_path(points, start=[0, 0], velocity=velocity)
+    assert path_cost(points, order, [0, 0], velocity) <= 4.2 + 1e-9 # 4 steps in Y, 20 in X
+    assert np.count_nonzero(np.diff(points[order][:, 1])) == 4, "Y should only change 4 times"
+
+def test_snake_raster():
+    points, indices = snake_raster([0, 1], [10, 20, 30], return_indices=True)
+    assert points.tolist() == [[0, 10], [0, 20], [0, 30], [1, 30], [1, 20], [1, 10]]
+    assert indices.tolist() == [[0, 0], [0, 1], [0, 2], [1, 2], [1, 1], [1, 0]]
+    points = snake_raster(range(3), range(4), range(5))
+    assert points.shape == (60, 3)
+    assert np.all(np.sum(np.abs(np.diff(points, axis=0)), axis=1) == 1), "Each point should neighbour the last"
+
+def test_grid_paths():
+    def jumps(indices):
+        return np.count_nonzero(np.sum(np.abs(np.diff(indices, axis=0)), axis=1) != 1)
+    for shape in [(5, 5), (6, 11), (16, 3), (3, 4, 8), (7,)]:
+        for kind in ('snake', 'raster', 'spiral', 'hilbert', 'random'):
+            indices = grid_path_indices(shape, kind, seed=0)
+            assert indices.shape == (np.prod(shape), len(shape))
+            assert len(np.unique(np.ravel_multi_index(indices.T, shape))) == np.prod(shape), \
+                "Every point should be visited once"
+    assert jumps(grid_path_indices((8, 16), 'hilbert')) == 0
+    assert jumps(grid_path_indices((3, 8, 8), 'hilbert')) == 0, "Each layer should start where the last finished"
+    assert jumps(grid_path_indices((7, 7), 'spiral')) == 0
+    assert grid_path_indices((7, 7), 'spiral')[0].tolist() == [3, 3], "Spirals should start in the middle"
+    assert np.all(grid_path_indices((4, 5), 'random', seed=1) == grid_path_indices((4, 5), 'random', seed=1))
+    points, indices = grid_path([0, 1], [10, 20, 30], kind='raster')
+    assert points.tolist() == [[0, 10], [0, 20], [0, 30], [1, 10], [1, 20], [1, 30]]
+    with pytest.raises(ValueError):
+        grid_path_indices((3, 3), 'zigzag')
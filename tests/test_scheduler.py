@@ -0,0 +1,113 @@
+import threading
+import numpy as np
+import nplab.datafile as df
+from nplab.instrument import Instrument
+from nplab.instrument.stage import DummyStage
+from nplab.experiment import Experiment, ExperimentScheduler
+from nplab.experiment.scanning_experiment import GridScan
+
+
+class Holder(Experiment):
+    """Holds on to its instruments until it's released (or stopped)."""
+    def __init__(self, *instruments):
+        Experiment.__init__(self)
+        self.instruments = list(instruments)
+        self.started = threading.Event()
+        self.release = threading.Event()
+        self.calls = []
+
+    def run(self, label=None, fail=False):
+        self.calls.append(label)
+        self.started.set()
+        while not self.release.is_set():
+            self.wait_or_stop(0.005)
+        if fail:
+            raise ValueError("failed on purpose")
+
+
+def test_runs_share_instruments_safely(tmpdir):
+    camera, card, stage = Instrument(), Instrument(), Instrument()
+    mosaic, dls, map_ = Holder(camera, stage), Holder(card), Holder(camera)
+    assert set(mosaic.required_instruments()) == {camera, stage}
+    f = df.DataFile(str(tmpdir.join("scheduler.h5")), mode='w')
+    scheduler = ExperimentScheduler(record_group=f.create_group('queue'))
+    runs = [scheduler.submit(e) for e in (mosaic, dls, map_)]
+    assert mosaic.started.wait(5) and dls.started.wait(5), "Runs that share nothing should run at once"
+    assert runs[2].status == 'queued', "A run should wait for the instruments it needs"
+    mosaic.release.set()
+    assert map_.started.wait(5)
+    dls.release.set()
+    map_.release.set()
+    assert scheduler.wait(5)
+    assert [r.status for r in runs] == ['finished'] * 3
+    assert runs[2].started >= runs[0].finished and runs[1].started < runs[0].finished
+
+    records = f['queue']
+    assert len(records) == 3
+    record = records[runs[0].record.name.split('/')[-1]]
+    assert record.attrs['status'] == 'finished' and record.attrs['experiment'] == 'Holder'
+    assert record.attrs['duration'] > 0
+    f.close()
+
+
+def test_priorities_pause_and_outcomes():
+    camera, card, stage = Instrument(), Instrument(), Instrument()
+    blocker, low, high, other = Holder(camera), Holder(card), Holder(camera, card), Holder(stage)
+    scheduler = ExperimentScheduler(record_group=False)
+    scheduler.submit(blocker)
+    assert blocker.started.wait(5)
+    scheduler.pause()
+    low_run = scheduler.submit(low, priority=0)
+    high_run = scheduler.submit(high, priority=5)
+    other_run = scheduler.submit(other, priority=-1)
+    assert scheduler.queued == [high_run, low_run, other_run]
+    assert not scheduler.wait(0.05) and other_run.status == 'queued', "Nothing should start while paused"
+    scheduler.resume()
+    assert other.started.wait(5), "Runs should use instruments that nothing else wants"
+    assert low_run.status == 'queued', "The card should be kept for the higher-priority run that needs it"
+    blocker.release.set()
+    assert high.started.wait(5)
+    assert low_run.status == 'queued'
+    for e in (high, other, low):
+        e.release.set()
+    assert scheduler.wait(5) and low_run.started >= high_run.finished
+
+    # failures, stopping and cancelling
+    failing = Holder(card)
+    failing.release.set()
+    failed_run = scheduler.submit(failing, kwargs=dict(fail=True))
+    assert failed_run.wait(5) == 'failed' and 'failed on purpose' in failed_run.error
+    blocker.release.clear()
+    blocker.started.clear()
+    stopped_run = scheduler.submit(blocker, args=('first',))
+    cancelled_run = scheduler.submit(blocker, args=('second',)) # the same experiment can't run twice at once
+    assert blocker.started.wait(5)
+    scheduler.stop()
+    assert stopped_run.wait(5) == 'stopped' and cancelled_run.status == 'cancelled'
+    assert blocker.calls[-1] == 'first' and scheduler.wait(5)
+
+
+class StageScan(GridScan):
+    def __init__(self):
+        GridScan.__init__(self)
+        self.set_stage(DummyStage(), axes=('x1', 'y1'))
+        self.size[:] = 2e-6
+        self.step[:] = 1e-6
+        self.init[:] = 0
+
+    def open_scan(self):
+        self.data = np.zeros(self.grid_shape)
+
+    def acquire(self, *indices):
+        return 1.0
+
+    def process_and_store(self, data, *indices):
+        self.data[indices] = data
+
+
+def test_scans_can_be_scheduled():
+    scan = StageScan()
+    assert scan.required_instruments() == [scan.stage]
+    scheduler = ExperimentScheduler(record_group=False)
+    run = scheduler.submit(scan)
+    assert run.wait(10) == 'finished' and np.all(scan.data == 1)
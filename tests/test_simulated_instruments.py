@@ -0,0 +1,189 @@
+import numpy as np
+from nplab.modelling.synthetic_sample import SyntheticSample
+from nplab.instrument.stage.simulated import SimulatedStage, trapezoidal_move_time, trapezoidal_position
+
+def test_trapezoidal_profile():
+    for distance in [0.01, 10.0, 1000.0]:
+        t = trapezoidal_move_time(distance, 1000.0, 1e4)
+        assert np.isclose(trapezoidal_position(0.0, distance, t, 1000.0, 1e4), distance)
+        assert np.isclose(trapezoidal_position(0.0, distance, t/2, 1000.0, 1e4), distance/2)
+
+def test_simulated_stage_moves():
+    stage = SimulatedStage(communication_latency=0, settling_time=0)
+    stage.move([1.0, 2.0])
+    assert np.allclose(stage.position, [1.0, 2.0, 0.0])
+    stage.move(0.5, axis='z', relative=True)
+    assert np.isclose(stage.get_position('z'), 0.5)
+    assert not stage.is_moving()
+
+def test_position_cache_and_move_handles():
+    stage = SimulatedStage(communication_latency=0, settling_time=0.01, position_cache_lifetime=10)
+    stage.move([1.0, 2.0])
+    stage.round_trips = 0
+    assert np.allclose(stage.position, [1.0, 2.0, 0.0])
+    assert np.isclose(stage.cached_position('y'), 2.0)
+    assert stage.round_trips == 0, "The position reported at the end of the move should be cached"
+    stage.position[0] = 7 # mustn't change the cached value
+    assert np.allclose(stage.position, [1.0, 2.0, 0.0])
+
+    handle = stage.move(100.0, axis='x', wait=False)
+    assert not handle.done
+    assert stage.position[0] < 100.0, "A move should invalidate the cache"
+    assert handle.wait(timeout=5) and handle.done
+    assert handle.finish_time - handle.start_time >= trapezoidal_move_time(99.0, 1000.0, 1e4)
+    assert np.isclose(stage.position[0], 100.0)
+    round_trips = stage.round_trips
+    stage.move(0.0, axis='x')
+    assert stage.round_trips == round_trips + 1, "Waiting for the move shouldn't poll the stage"
+
+    stage.signals_move_completion = False # fall back to polling
+    handle = stage.move(1.0, axis='x', wait=False)
+    assert handle.wait(timeout=5) and not stage.is_moving()
+
+def test_trajectories():
+    from nplab.instrument.stage import Stage
+    from nplab.utils.path_planning import snake_raster
+    waypoints = snake_raster([0.0, 10.0, 20.0], [0.0, 5.0])
+    stage = SimulatedStage(communication_latency=0, settling_time=0)
+    visited = []
+    def record(i, waypoint):
+        assert np.allclose(stage._true_position()[:2], waypoint), "The callback came before the stage arrived"
+        visited.append(i)
+    assert stage.execute_trajectory(waypoints, axes=['x', 'y'], callback=record) == len(waypoints)
+    assert visited == list(range(len(waypoints)))
+    stage.round_trips = 0
+    stage.execute_trajectory(waypoints[::-1], dwell_time=0.001)
+    assert stage.round_trips == 1, "Without callbacks, the whole trajectory should be one round trip"
+    assert np.allclose(stage.position[:2], waypoints[0])
+
+    # The emulation only moves the axes that change, and can be stopped by the callback
+    stage.round_trips = 0
+    n = Stage.execute_trajectory(stage, waypoints, callback=lambda i, waypoint: i < 3)
+    assert stage.round_trips == 4, "One move per waypoint, without polling"
+    assert n == 4 and np.allclose(stage.position[:2], waypoints[3])
+
+def test_sample_is_sharpest_in_focus():
+    sample = SyntheticSample.random(n_particles=50, field_size=(20, 20), seed=0)
+    in_focus = sample.render((0, 0, sample.focal_z), (64, 64), 0.2)
+    out_of_focus = sample.render((0, 0, sample.focal_z + 2), (64, 64), 0.2)
+    assert in_focus.max() > out_of_focus.max()
+
+def test_camera_frame_stream():
+    from nplab.instrument.camera.simulated import SimulatedCamera
+    camera = SimulatedCamera(shape=(32, 48), frame_rate=100, readout_time=0, monochrome=True)
+    camera.exposure = 1
+    reader = camera.get_frame_reader()
+    camera.live_view = True
+    try:
+        frame = camera.get_next_frame(timeout=5)
+        assert frame.shape == (32, 48)
+        frames, seqs, timestamps = reader.read(timeout=5)
+        assert len(seqs) > 0 and frames.shape[1:] == (32, 48)
+        assert np.all(np.diff(seqs) == 1), "Sequence numbers should increase by one"
+        assert seqs[-1] <= camera.latest_sequence_number
+    finally:
+        camera.live_view = False
+    frames, seqs, timestamps, n_dropped = camera.get_frames_since(-1)
+    assert len(seqs) + n_dropped == camera.latest_sequence_number + 1
+
+def test_preview_is_rate_limited():
+    import time
+    from weakref import WeakSet
+    from nplab.instrument.camera.simulated import SimulatedCamera
+    sample = SyntheticSample.random(n_particles=10, seed=0)
+    camera = SimulatedCamera(sample=sample, shape=(32, 1024), frame_rate=100, readout_time=0,
+                             monochrome=True)
+    camera.exposure = 1
+    camera.preview_frame_rate = 10
+    camera.preview_max_size = 512
+
+    class PreviewRecorder(object):
+        def __init__(self):
+            self.updates = []
+        def update_image(self, image, downsampling):
+            self.updates.append((image.shape, downsampling))
+    widget = PreviewRecorder()
+    camera._preview_widgets = WeakSet([widget])
+    camera._start_preview_thread()
+    camera.live_view = True
+    time.sleep(0.5)
+    camera.live_view = False
+    assert camera.latest_sequence_number > 20, "The preview shouldn't slow down acquisition"
+    assert 0 < len(widget.updates) <= 7, "The preview should be updated at preview_frame_rate"
+    assert widget.updates[0] == ((16, 512), 2), "Large frames should be downsampled"
+    del widget
+    camera._preview_thread.join(2)
+    assert not camera._preview_thread.is_alive(), "The preview thread should stop with no widgets"
+
+def test_camera_records_video(tmpdir):
+    import nplab.datafile as df
+    from nplab.instrument.camera.simulated import SimulatedCamera
+    sample = SyntheticSample.random(n_particles=10, seed=0)
+    camera = SimulatedCamera(sample=sample, shape=(32, 48), frame_rate=50, readout_time=0)
+    camera.exposure = 1
+    f = df.DataFile(str(tmpdir.join("video.h5")), mode='w')
+    frames = camera.record(n_frames=10, codec='gzip', data_group=f.create_group("video"))
+    assert frames.shape == (10, 32, 48, 3)
+    assert not camera.live_view, "Live view should be stopped again after recording"
+    timestamps = f['video/timestamps'][...]
+    assert np.all(np.diff(timestamps) > 0)
+    sequence_numbers = f['video/sequence_numbers'][...]
+    assert sequence_numbers[-1] - sequence_numbers[0] == 9 + frames.attrs['frames_dropped']
+    f.close()
+
+def test_camera_parameters_are_discovered_without_reading():
+    from nplab.instrument.camera import CameraParameter
+    from nplab.instrument.camera.simulated import SimulatedCamera
+
+    class CountingCamera(SimulatedCamera):
+        temperature = CameraParameter("temperature", "Not supported by this camera.")
+        def get_camera_parameter(self, name):
+            self.parameter_reads += 1
+            return super(CountingCamera, self).get_camera_parameter(name)
+
+    CountingCamera.parameter_reads = 0
+    camera = CountingCamera(shape=(8, 8))
+    assert CountingCamera.parameter_reads == 0, "Creating the camera shouldn't read any parameters"
+    assert sorted(camera.camera_parameter_names()) == ['exposure', 'gain', 'temperature']
+    values = camera.probe_camera_parameters().join_and_return_result()
+    assert values == {'exposure': 10.0, 'gain': 0.2}
+    assert camera.unavailable_camera_parameters == set(['temperature'])
+    assert sorted(camera.camera_parameter_names()) == ['exposure', 'gain']
+    assert hasattr(CountingCamera, 'temperature'), "Probing shouldn't modify the class"
+    metadata = camera.get_metadata()
+    assert metadata['exposure'] == 10.0 and 'temperature' not in metadata
+
+def test_fast_autofocus_finds_focus():
+    from nplab.instrument.camera.simulated import SimulatedCamera
+    from nplab.instrument.camera.camera_with_location import CameraWithLocation
+    sample = SyntheticSample.random(n_particles=200, field_size=(40, 40), seed=1, defocus_blur=0.5)
+    stage = SimulatedStage(velocity=1000, acceleration=1e5, settling_time=0, communication_latency=0)
+    camera = SimulatedCamera(stage=stage, sample=sample, shape=(120, 160), pixel_size=0.1, readout_time=0)
+    cwl = CameraWithLocation(camera, stage)
+    for start in [0.6, -1.7]:
+        stage.move(np.array([0, 0, start]))
+        cwl.autofocus()
+        reference = stage.position[2]
+        stage.move(np.array([0, 0, start]))
+        shift, positions, merits = cwl.fast_autofocus()
+        assert abs(stage.position[2] - sample.focal_z) < 0.2, "Fast autofocus didn't find the focus"
+        assert abs(stage.position[2] - reference) < 0.4, "Fast autofocus disagrees with autofocus"
+        assert len(positions) <= 10
+        assert cwl.last_autofocus_report['moves'] == len(positions) + 1
+
+def test_fly_autofocus_finds_focus():
+    from nplab.instrument.camera.simulated import SimulatedCamera
+    from nplab.instrument.camera.camera_with_location import CameraWithLocation
+    sample = SyntheticSample.random(n_particles=200, field_size=(40, 40), seed=1, defocus_blur=0.5)
+    stage = SimulatedStage(velocity=1000, acceleration=1e5, settling_time=0, communication_latency=0)
+    camera = SimulatedCamera(stage=stage, sample=sample, shape=(120, 160), pixel_size=0.1,
+                             frame_rate=50, readout_time=0)
+    cwl = CameraWithLocation(camera, stage)
+    for position_source in ["poll", "trajectory"]:
+        stage.move(np.array([0, 0, 0.8]))
+        shift, z, merits = cwl.fly_autofocus(dz=2, position_source=position_source)
+        assert abs(stage.position[2] - sample.focal_z) < 0.2, "Fly-through autofocus didn't find the focus"
+        assert len(z) >= 10, "Too few frames were taken during the sweep"
+        assert np.all(np.diff(z) > 0), "Frames should be in order through the sweep"
+    assert np.all(stage.velocity == 1000), "The stage's speed should be restored"
+    assert not camera.live_view
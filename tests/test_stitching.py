@@ -0,0 +1,49 @@
+import numpy as np
+from scipy import ndimage
+import nplab.datafile as df
+from nplab.utils.stitching import register_tiles, solve_tile_positions, write_mosaic, stitch_tiles
+
+def make_tiles(n_tiles=(3, 4), tile_shape=(60, 80), step=(40, 55), jitter=2, seed=0):
+    """Cut tiles from a random texture; return the tiles, their true positions, and the grid positions."""
+    rs = np.random.RandomState(seed)
+    texture = ndimage.gaussian_filter(rs.random_sample((n_tiles[0] * step[0] + 100, n_tiles[1] * step[1] + 100)), 2)
+    texture = (255 * (texture - texture.min()) / (texture.max() - texture.min())).astype(np.uint8)
+    grid = np.array([(i * step[0], j * step[1]) for i in range(n_tiles[0]) for j in range(n_tiles[1])]) + 20
+    true_positions = grid + rs.randint(-jitter, jitter + 1, grid.shape)
+    tiles = [texture[r:r + tile_shape[0], c:c + tile_shape[1]] for r, c in true_positions]
+    return texture, tiles, true_positions, grid
+
+def test_registration_recovers_tile_positions():
+    texture, tiles, true_positions, grid = make_tiles()
+    pairs, offsets, scores = register_tiles(tiles, grid, max_shift=4, n_processes=2)
+    assert len(pairs) >= 17, "Each tile should be compared with its neighbours"
+    assert np.all(scores > 0.9)
+    for (i, j), offset in zip(pairs, offsets):
+        assert np.all(np.abs(offset - (true_positions[j] - true_positions[i])) < 0.2)
+    fitted = solve_tile_positions(grid, pairs, offsets, scores)
+    error = (fitted - fitted[0]) - (true_positions - true_positions[0])
+    assert np.all(np.abs(error) < 0.2), "The fitted positions were wrong"
+
+def test_mosaic_pyramid(tmpdir):
+    texture, tiles, true_positions, grid = make_tiles()
+    f = df.DataFile(str(tmpdir.join("mosaic.h5")), mode='w')
+    level_0 = write_mosaic(tiles, true_positions, f.create_group("mosaic"), block_size=64, chunk_size=32)
+    top, left = true_positions.min(axis=0)
+    bottom, right = (true_positions + (60, 80)).max(axis=0)
+    assert level_0.shape == (bottom - top, right - left)
+    assert np.all(level_0[10:-10, 10:-10] == texture[top + 10:bottom - 10, left + 10:right - 10]), \
+        "Overlapping tiles of the same image should blend seamlessly"
+    group = f['mosaic']
+    levels = group.attrs['levels']
+    for level in range(1, levels):
+        assert group['level_%d' % level].shape == tuple((np.array(group['level_%d' % (level - 1)].shape) + 1) // 2)
+    assert max(group['level_%d' % (levels - 1)].shape) <= 32 < max(group['level_%d' % (levels - 2)].shape)
+    assert abs(np.mean(group['level_1'][...]) - np.mean(level_0[...])) < 2
+
+    # The whole process, starting from tiles in a group
+    tile_group = f.create_group("tiles")
+    for tile in tiles:
+        tile_group.create_dataset("tile_%d", data=tile)
+    mosaic = stitch_tiles(tile_group, dest=f.create_group("stitched"), positions=grid, max_shift=4, n_processes=1)
+    assert abs(mosaic.shape[0] - (bottom - top)) <= 1 and abs(mosaic.shape[1] - (right - left)) <= 1
+    f.close()
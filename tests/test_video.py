@@ -0,0 +1,43 @@
+import numpy as np
+import nplab.datafile as df
+from nplab.utils.video import HDF5VideoWriter, decode_frame
+
+def make_frames(n=10, shape=(48, 64, 3)):
+    frames = np.zeros((n,) + shape, dtype=np.uint8)
+    for i in range(n):
+        frames[i, 10:30, 5 + i:25 + i, :] = 200
+    return frames
+
+def test_lossless_codecs(tmpdir):
+    f = df.DataFile(str(tmpdir.join("video.h5")), mode='w')
+    frames = make_frames()
+    for codec in [None, 'gzip', 'lzf']:
+        writer = HDF5VideoWriter(f.create_group(str(codec)), frames.shape[1:], codec=codec, n_workers=2)
+        writer.write(frames[:4], np.arange(4), np.arange(4))
+        for i in range(4, 10):
+            writer.write(frames[i], i)
+        writer.close()
+        g = f[str(codec)]
+        assert g['frames'].shape == frames.shape
+        assert np.all(g['frames'][...] == frames), "{0} video didn't match the frames".format(codec)
+        assert np.all(g['timestamps'][...] == np.arange(10)), "Frames were written out of order"
+    assert f['gzip/frames'].compression == 'gzip'
+    f.close()
+
+def test_image_codecs(tmpdir):
+    f = df.DataFile(str(tmpdir.join("video.h5")), mode='w')
+    frames = make_frames()
+    for codec in ['png', 'jpeg']:
+        writer = HDF5VideoWriter(f.create_group(codec), frames.shape[1:], codec=codec, n_workers=2)
+        writer.write(frames, np.arange(10))
+        writer.close()
+        dset = f[codec + '/frames']
+        assert dset.shape == (10,)
+        for i in range(10):
+            decoded = decode_frame(dset, i)
+            assert decoded.shape == frames.shape[1:]
+            if codec == 'png':
+                assert np.all(decoded == frames[i]), "PNG should be lossless"
+            else:
+                assert np.mean(np.abs(decoded.astype(float) - frames[i])) < 5
+    f.close()